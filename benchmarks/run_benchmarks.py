@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Benchmarks for the kadi commands, states and events query paths.
+
+All benchmarks run against a synthetic commands archive and events database
+(see ``synthetic.py``), so no network or flight data are needed.  The wall
+clock time of each benchmark is recorded for ``--repeat`` runs (after one
+warm-up run) and the peak memory allocated during one further run is recorded
+with ``tracemalloc``.  Results are written as JSON and can be compared with
+the results from another commit::
+
+  % git checkout master
+  % python benchmarks/run_benchmarks.py --output master.json
+  % git checkout my-branch
+  % python benchmarks/run_benchmarks.py --output my-branch.json --compare master.json
+
+The kadi package in the same source tree as this script is benchmarked.
+Benchmarks of functions that are not in that version of kadi are skipped, so
+results can be compared with commits from before they were added.
+"""
+import argparse
+import datetime
+import gc
+import json
+import logging
+import os
+import pickle
+import platform
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).absolute().parents[1]
+sys.path.insert(0, str(ROOT))
+
+import synthetic  # noqa (after sys.path setup)
+
+# Time spans in days for query workloads (None => full archive)
+SPANS = {'1day': 1, '30day': 30, '1year': 365, 'mission': None}
+
+logger = logging.getLogger('kadi_benchmarks')
+
+
+class Benchmark(object):
+    """
+    Benchmark of one workload.
+
+    :param name: benchmark name (unique)
+    :param func: function to benchmark, called as ``func(*setup())``
+    :param setup: function returning args for ``func`` (not timed, default=None)
+    :param params: dict of workload parameters (for the JSON output)
+    """
+    def __init__(self, name, func, setup=None, params=None):
+        self.name = name
+        self.group = name.split('[')[0]
+        self.func = func
+        self.setup = setup
+        self.params = params or {}
+
+    def run_once(self, trace_memory=False):
+        """
+        Run the benchmark once.
+
+        :returns: elapsed time (sec), peak memory (bytes) or None
+        """
+        args = self.setup() if self.setup else ()
+        gc.collect()
+        if trace_memory:
+            tracemalloc.start()
+        try:
+            t0 = time.perf_counter()
+            self.func(*args)
+            dt = time.perf_counter() - t0
+            peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+        finally:
+            if trace_memory:
+                tracemalloc.stop()
+        return dt, peak
+
+    def run(self, repeat):
+        """
+        Run the benchmark ``repeat`` times (after a warm-up run) and once more to
+        get the peak memory.
+
+        :returns: dict of results
+        """
+        out = {'group': self.group,
+               'params': {key: repr(val) for key, val in self.params.items()}}
+        try:
+            self.run_once()
+            times = [self.run_once()[0] for _ in range(repeat)]
+            _, peak = self.run_once(trace_memory=True)
+        except Exception as err:
+            out['error'] = f'{err.__class__.__name__}: {err}'
+            return out
+
+        out.update(times=times,
+                   min=min(times),
+                   median=statistics.median(times),
+                   peak_mem=peak)
+        return out
+
+
+def get_benchmarks(manifest, work_dir):
+    """
+    Get list of benchmarks for the synthetic data described by ``manifest``.
+
+    :param manifest: dict describing synthetic data (from ``synthetic.make_data()``)
+    :param work_dir: scratch directory for benchmarks that write files
+    :returns: list of Benchmark
+    """
+    from Chandra.Time import DateTime
+    from kadi import commands, events, update_cmds
+    from kadi.commands import states
+
+    # Leave some margin at the ends of the archive so that state continuity is
+    # available for all queries.
+    archive_start = DateTime(manifest['start']) + 10
+    archive_stop = DateTime(manifest['stop']) - 1
+    spans = {name: ((archive_stop - days).date if days else archive_start.date,
+                    archive_stop.date)
+             for name, days in SPANS.items()}
+    benchmarks = []
+
+    def add(name, func, setup=None, **params):
+        benchmarks.append(Benchmark(name, func, setup, params))
+
+    # Commands archive load.  Older kadi versions have no archive handle and
+    # load the archive into the LazyVal globals of kadi.commands instead.
+    if hasattr(commands, 'ARCHIVE'):
+        def reset_archive():
+            commands.ARCHIVE.reset()
+            return ()
+        add('load_archive', commands.ARCHIVE.get, reset_archive)
+        add('load_archive_pars_index', lambda: commands.ARCHIVE.get().pars_index, reset_archive)
+    else:
+        def reset_archive():
+            for lazy_val in (commands.idx_cmds, commands.pars_dict, commands.rev_pars_dict):
+                # Plain attribute access would load the value
+                object.__getattribute__(lazy_val, '__dict__').pop('_val', None)
+            return ()
+        add('load_archive', lambda: (commands.idx_cmds._val, commands.pars_dict._val),
+            reset_archive)
+
+    # Commands queries
+    cmds_filters = {'none': {},
+                    'type': {'type': 'simtrans'},
+                    'tlmsid': {'tlmsid': 'aomanuvr'},
+                    'param': {'msid': 'aflcrset'},
+                    'param_range': {'pos__gt': 74000}}
+    for span, (start, stop) in spans.items():
+        for filter_name, kwargs in cmds_filters.items():
+            add(f'get_cmds[{span},{filter_name}]',
+                lambda start=start, stop=stop, kwargs=kwargs:
+                    commands.get_cmds(start, stop, **kwargs),
+                start=start, stop=stop, **kwargs)
+    for key in ('pos', 'msid'):
+        add(f'get_cmds_param_column[30day,{key}]',
+            lambda cmds, key=key: cmds[key],
+            lambda start=spans['30day'][0], stop=spans['30day'][1]: (
+                commands.get_cmds(start, stop),),
+            key=key)
+
+    # States
+    all_keys = list(states.STATE_KEYS)
+    for span, state_keys in (('1day', None), ('1day', all_keys),
+                             ('30day', None), ('30day', all_keys),
+                             ('1year', None), ('1year', all_keys),
+                             ('mission', ['obsid', 'simpos'])):
+        start, stop = spans[span]
+        keys_name = ('default' if state_keys is None
+                     else 'all' if state_keys is all_keys
+                     else '+'.join(state_keys))
+        add(f'get_states[{span},{keys_name}]',
+            lambda start=start, stop=stop, state_keys=state_keys:
+                states.get_states(start, stop, state_keys=state_keys),
+            start=start, stop=stop, state_keys=state_keys)
+
+    for state_keys in (None, all_keys):
+        keys_name = 'default' if state_keys is None else 'all'
+        add(f'get_continuity[{keys_name}]',
+            lambda state_keys=state_keys:
+                states.get_continuity(archive_stop.date, state_keys),
+            date=archive_stop.date, state_keys=state_keys)
+
+    # Events intervals
+    event_queries = {'dumps': events.dumps,
+                     'obsids': events.obsids,
+                     'dumps|eclipses': events.dumps | events.eclipses,
+                     '~dumps&obsids': ~events.dumps & events.obsids}
+    for span in ('30day', '1year', 'mission'):
+        start, stop = spans[span]
+        for query_name, query in event_queries.items():
+            add(f'events_intervals[{span},{query_name}]',
+                lambda query=query, start=start, stop=stop: query.intervals(start, stop),
+                start=start, stop=stop, query=query_name)
+
+    # Daily update of the commands archive: add the last 42 days of commands to
+    # an archive without the last 21 days.
+    h5_file = Path(manifest['data_dir'], 'cmds.h5')
+    h5_base = Path(work_dir, 'cmds_base.h5')
+    h5_test = Path(work_dir, 'cmds.h5')
+    new_idx_cmds = []
+
+    def setup_add_h5_cmds():
+        if not h5_base.exists():
+            with update_cmds.tables.open_file(str(h5_file), mode='r') as h5:
+                cmds = h5.root.data[:]
+            dates = [(archive_stop - days).date.encode('ascii') for days in (21, 42)]
+            i21, i42 = np.searchsorted(cmds['date'], dates)
+            with update_cmds.tables.open_file(str(h5_base), mode='w') as h5:
+                h5.create_table(h5.root, 'data', cmds[:i21], 'cmds', expectedrows=2e6)
+                # Include the indexes as written by update_cmds, so that the
+                # benchmark times the incremental index update.
+                if hasattr(update_cmds, 'write_h5_indexes'):
+                    update_cmds.write_h5_indexes(h5, update_cmds.get_indexes(cmds[:i21]), i21)
+            # Same format as update_cmds.get_idx_cmds() output
+            new_idx_cmds.extend(
+                tuple(val.decode('ascii') if isinstance(val, bytes) else val for val in row)
+                for row in cmds[i42:].tolist())
+        shutil.copy(h5_base, h5_test)
+        return (str(h5_test), new_idx_cmds)
+
+    add('add_h5_cmds[42day]', update_cmds.add_h5_cmds, setup_add_h5_cmds, days=42)
+
+    if hasattr(update_cmds, 'write_npy_cmds'):
+        def setup_write_npy_cmds():
+            with open(Path(manifest['data_dir'], 'cmds.pkl'), 'rb') as fh:
+                pars_dict = pickle.load(fh)
+            return (h5_file, pars_dict, Path(work_dir, 'cmds_npy'))
+
+        add('write_npy_cmds', update_cmds.write_npy_cmds, setup_write_npy_cmds)
+
+    return benchmarks
+
+
+def get_git_info():
+    """Get git commit and description for the source tree."""
+    out = {}
+    for key, cmd in (('git_commit', ['git', 'rev-parse', 'HEAD']),
+                     ('git_describe', ['git', 'describe', '--always', '--dirty'])):
+        try:
+            out[key] = subprocess.check_output(cmd, cwd=ROOT, stderr=subprocess.DEVNULL,
+                                               universal_newlines=True).strip()
+        except (OSError, subprocess.CalledProcessError):
+            out[key] = None
+    return out
+
+
+def compare_results(results, base_results, threshold):
+    """
+    Print a comparison of ``results`` with ``base_results``.
+
+    :param threshold: ratio of median time or peak memory (new / base) above
+        which a benchmark is flagged as a regression
+    :returns: list of names of regressed benchmarks
+    """
+    regressions = []
+    print(f'{"Benchmark":<45s} {"Base (s)":>10s} {"New (s)":>10s} {"Ratio":>7s}'
+          f' {"Base MB":>9s} {"New MB":>9s} {"Ratio":>7s}')
+    for name, result in results['benchmarks'].items():
+        base = base_results['benchmarks'].get(name)
+        if base is None or 'error' in base or 'error' in result:
+            status = 'new' if base is None else (base.get('error') or result.get('error'))
+            print(f'{name:<45s} {status}')
+            continue
+        time_ratio = result['median'] / base['median']
+        mem_ratio = (result['peak_mem'] / base['peak_mem']) if base['peak_mem'] else 1.0
+        flag = ''
+        if time_ratio > threshold or mem_ratio > threshold:
+            flag = ' !'
+            regressions.append(name)
+        print(f'{name:<45s} {base["median"]:10.4f} {result["median"]:10.4f} {time_ratio:7.2f}'
+              f' {base["peak_mem"] / 1e6:9.1f} {result["peak_mem"] / 1e6:9.1f}'
+              f' {mem_ratio:7.2f}{flag}')
+    return regressions
+
+
+def get_opt(args=None):
+    parser = argparse.ArgumentParser(description='Run kadi benchmarks')
+    parser.add_argument('--output',
+                        default='benchmarks.json',
+                        help='Output JSON file (default=benchmarks.json)')
+    parser.add_argument('--data-dir',
+                        default=str(Path(tempfile.gettempdir(), 'kadi_benchmarks')),
+                        help='Directory for synthetic data (reused between runs)')
+    parser.add_argument('--start',
+                        default='2000:001',
+                        help='Start date of synthetic commands (default=2000:001)')
+    parser.add_argument('--stop',
+                        default='2020:001',
+                        help='Stop date of synthetic commands (default=2020:001)')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=0,
+                        help='Random seed for synthetic data (default=0)')
+    parser.add_argument('--regenerate',
+                        action='store_true',
+                        help='Regenerate synthetic data')
+    parser.add_argument('--repeat',
+                        type=int,
+                        default=3,
+                        help='Number of timed runs of each benchmark (default=3)')
+    parser.add_argument('--select',
+                        help='Only run benchmarks with name matching this regex')
+    parser.add_argument('--list',
+                        action='store_true',
+                        help='List benchmarks and exit')
+    parser.add_argument('--compare',
+                        help='JSON results file to compare against')
+    parser.add_argument('--threshold',
+                        type=float,
+                        default=1.2,
+                        help='Ratio (new / base) flagged as a regression (default=1.2)')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    opt = get_opt(args)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    # The data directory must be set before importing kadi.events, which
+    # configures the Django events database on import.
+    data_dir = Path(opt.data_dir).absolute()
+    os.environ['KADI'] = str(data_dir)
+    from kadi import __version__, update_cmds
+    # update_cmds.main() normally sets up the logger
+    update_cmds.logger = logging.getLogger('kadi_benchmarks.update_cmds')
+    update_cmds.logger.setLevel(logging.WARNING)
+
+    if opt.regenerate:
+        try:
+            (data_dir / 'synthetic.json').unlink()
+        except FileNotFoundError:
+            pass
+    manifest = synthetic.make_data(data_dir, opt.start, opt.stop, opt.seed, logger=logger)
+    manifest['data_dir'] = str(data_dir)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        benchmarks = get_benchmarks(manifest, work_dir)
+        if opt.select:
+            benchmarks = [bm for bm in benchmarks if re.search(opt.select, bm.name)]
+        if opt.list:
+            for bm in benchmarks:
+                print(bm.name)
+            return
+
+        results = {'meta': {'kadi_version': __version__,
+                            **get_git_info(),
+                            'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                            'python': platform.python_version(),
+                            'numpy': np.__version__,
+                            'platform': platform.platform(),
+                            'repeat': opt.repeat,
+                            'data': manifest},
+                   'benchmarks': {}}
+        for bm in benchmarks:
+            result = bm.run(opt.repeat)
+            results['benchmarks'][bm.name] = result
+            if 'error' in result:
+                logger.info(f'{bm.name}: {result["error"]}')
+            else:
+                logger.info(f'{bm.name}: {result["median"]:.4f} s '
+                            f'{result["peak_mem"] / 1e6:.1f} MB')
+
+    with open(opt.output, 'w') as fh:
+        json.dump(results, fh, indent=2)
+    logger.info(f'Wrote results to {opt.output}')
+
+    if opt.compare:
+        with open(opt.compare) as fh:
+            base_results = json.load(fh)
+        regressions = compare_results(results, base_results, opt.threshold)
+        if regressions:
+            print(f'\n{len(regressions)} benchmark(s) slower or larger than '
+                  f'{opt.threshold} x {opt.compare}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Synthetic commands archive and events database for the kadi benchmarks.
+
+The commands follow the usual pattern of an observation (target quaternion
+update, maneuver, obsid, SIM moves, ACIS setup, dither) repeated throughout the
+mission, plus orbit events, eclipses and generic hardware / software commands.
+The output is entirely determined by the ``seed``, ``start`` and ``stop``
+arguments, so results from different commits are comparable.
+
+The archive is written with the ``kadi.update_cmds`` functions that write the
+flight archive (``cmds.h5``, ``cmds.pkl`` and ``cmds_npy`` if that version of
+kadi has it), so it always has the format of the commit being benchmarked.
+"""
+import json
+import os
+import pickle
+from pathlib import Path
+
+import numpy as np
+
+# Increment this if the synthetic data change, so that existing data
+# directories get regenerated.
+SYNTHETIC_VERSION = 1
+
+ORBIT_PERIOD = 63.5 * 3600
+TIMELINE_PERIOD = 7 * 86400
+
+ACIS_POWER = ['WSPOW00000', 'WSPOW0002A', 'WSPOW08E1E', 'WSPOW3F03F', 'WSPOW1EC3F']
+ACIS_SI_MODES = ['WT000B5024', 'WT000B7024', 'WT00C62014', 'WC00012345', 'WT00D96014']
+SIM_POS = [75624, 73176, -99616, -50504, 92904]
+SIMFA_POS = [-468, -536, -1100, -988]
+HW_MSIDS = ['CIMODESL', 'CTXAON', 'CTXBON', 'CTXAOF', 'CTXBOF', 'CNOOP', 'CIU1024X']
+SW_MSIDS = ['COACTSX', 'COSCSEND', 'CMDSVCT', 'AOACRSTE', 'AFLCRSET']
+EPHEM_KEYS = ['aoephem1', 'aoephem2', 'aoratio', 'aoargper', 'aoeccent', 'ao1minus', 'ao1plus',
+              'aomotion', 'aoiterat', 'aoorbang', 'aoperige', 'aoascend', 'aosini', 'aoslr',
+              'aosqrtmu']
+
+# Number of distinct targets, to keep the number of unique parameter sets in
+# the range of the flight archive (the parameter index is uint16).
+N_TARGETS = 3000
+
+
+def make_data(data_dir, start='2000:001', stop='2020:001', seed=0, logger=None):
+    """
+    Make synthetic commands archive and events database in ``data_dir``.
+
+    Existing data in ``data_dir`` are kept if they were made with the same
+    arguments (and ``SYNTHETIC_VERSION``).
+
+    :param data_dir: output directory (used as $KADI)
+    :param start: start date of commands
+    :param stop: stop date of commands
+    :param seed: random seed
+    :param logger: logger for progress messages (default=None)
+    :returns: dict with description of the synthetic data
+    """
+    data_dir = Path(data_dir)
+    manifest_path = data_dir / 'synthetic.json'
+    manifest = {'version': SYNTHETIC_VERSION, 'start': start, 'stop': stop, 'seed': seed}
+
+    if manifest_path.exists():
+        with open(manifest_path) as fh:
+            existing = json.load(fh)
+        if all(existing.get(key) == val for key, val in manifest.items()):
+            return existing
+
+    data_dir.mkdir(parents=True, exist_ok=True)
+    for name in ('cmds.h5', 'cmds.pkl', 'events3.db3', 'synthetic.json'):
+        if (data_dir / name).exists():
+            (data_dir / name).unlink()
+
+    cmds = make_cmds(start, stop, seed)
+    if logger:
+        logger.info(f'Made {len(cmds)} synthetic commands from {start} to {stop}')
+    manifest['n_cmds'] = write_cmds_archive(data_dir, cmds)
+    manifest['n_events'] = write_events_db(data_dir, cmds, seed)
+
+    with open(manifest_path, 'w') as fh:
+        json.dump(manifest, fh, indent=2)
+
+    return manifest
+
+
+def make_cmds(start, stop, seed=0):
+    """
+    Make synthetic commands between ``start`` and ``stop``.
+
+    :returns: list of dict in the ``update_cmds.get_cmds()`` format, sorted by date
+    """
+    from Chandra.Time import DateTime
+
+    rng = np.random.RandomState(seed)
+    tstart = DateTime(start).secs
+    tstop = DateTime(stop).secs
+
+    targets = rng.normal(size=(N_TARGETS, 4))
+    targets /= np.sqrt(np.sum(targets ** 2, axis=1))[:, np.newaxis]
+    targets[targets[:, 3] < 0] *= -1
+    targets = np.round(targets, 8)
+
+    cmds = []
+
+    def add(time, cmd_type, tlmsid, scs=131, **params):
+        params = {key.upper(): val for key, val in params.items()}
+        if tlmsid is not None:
+            params['TLMSID'] = tlmsid
+        cmds.append({'time': time, 'type': cmd_type, 'tlmsid': tlmsid,
+                     'scs': scs, 'params': params})
+
+    # Observations
+    time = tstart
+    obsid = 1000
+    while time < tstop:
+        q1, q2, q3, q4 = targets[rng.randint(N_TARGETS)].tolist()
+        add(time, 'MP_TARGQUAT', 'AOUPTARQ', q1=q1, q2=q2, q3=q3, q4=q4)
+        add(time + 0.5, 'ACISPKT', 'AA00000000', cmds=3, words=3)
+        add(time + 1.5, 'ACISPKT', 'WSVIDALLDN', cmds=3, words=3)
+        add(time + 10, 'COMMAND_SW', 'AODSDITH', hex='8034200', msid='AODSDITH')
+        add(time + 20, 'COMMAND_SW', 'AONMMODE', hex='8030402', msid='AONMMODE')
+        add(time + 20.26, 'COMMAND_SW', 'AONM2NPE', hex='8030601', msid='AONM2NPE')
+        add(time + 24.36, 'COMMAND_SW', 'AOMANUVR', hex='8034101', msid='AOMANUVR')
+
+        time_obs = time + 1800
+        obsid = obsid + 1 if obsid < 59999 else 1000
+        add(time_obs, 'MP_OBSID', 'COAOSQID', id=obsid)
+        add(time_obs + 60, 'SIMTRANS', None, pos=int(rng.choice(SIM_POS)))
+        add(time_obs + 65, 'SIMFOCUS', None, pos=int(rng.choice(SIMFA_POS)))
+        if rng.uniform() < 0.15:
+            grating = rng.choice(['HETG', 'LETG'])
+            add(time_obs + 120, 'COMMAND_HW', f'4O{grating[0]}ETGIN',
+                hex='6A00000', msid=f'4O{grating[0]}ETGIN')
+            add(time_obs + 180, 'COMMAND_HW', f'4O{grating[0]}ETGRE',
+                hex='6A00001', msid=f'4O{grating[0]}ETGRE')
+        add(time_obs + 300, 'ACISPKT', str(rng.choice(ACIS_POWER)), cmds=3, words=3)
+        add(time_obs + 305, 'ACISPKT', str(rng.choice(ACIS_SI_MODES)), cmds=3, words=3)
+        add(time_obs + 310, 'ACISPKT', 'XTZ0000005', cmds=3, words=3)
+        add(time_obs + 600, 'COMMAND_SW', 'AODITPAR',
+            angp=float(rng.choice([0.0, 0.5])), angy=0.0,
+            coefp=float(rng.choice([3.9e-05, 7.8e-05])), coefy=3.9e-05,
+            ratep=0.0056, ratey=0.0088, msid='AODITPAR')
+        add(time_obs + 610, 'COMMAND_SW', 'AOENDITH', hex='8034201', msid='AOENDITH')
+
+        # Background hardware and software commands during the observation
+        dur = rng.uniform(10000, 60000)
+        for time_cmd in np.sort(rng.uniform(time_obs + 700, time + dur, int(dur / 1500))):
+            if rng.uniform() < 0.5:
+                msid = str(rng.choice(HW_MSIDS))
+                add(time_cmd, 'COMMAND_HW', msid, hex=f'{rng.randint(16):07X}', msid=msid)
+            else:
+                msid = str(rng.choice(SW_MSIDS))
+                add(time_cmd, 'COMMAND_SW', msid, hex=f'{rng.randint(16):07X}', msid=msid)
+        time += dur
+
+    # Orbit events, radiation zones and (seasonal) eclipses
+    for time in np.arange(tstart + 1000, tstop, ORBIT_PERIOD):
+        add(time, 'ORBPOINT', None, scs=0, event_type='EPERIGEE')
+        add(time - 20000, 'ORBPOINT', None, scs=0, event_type='XEF1000')
+        add(time + 20000, 'ORBPOINT', None, scs=0, event_type='EEF1000')
+        add(time - 21000, 'COMMAND_SW', 'OORMPDS', hex='8000001', msid='OORMPDS')
+        add(time + 21000, 'COMMAND_SW', 'OORMPEN', hex='8000002', msid='OORMPEN')
+        add(time + ORBIT_PERIOD / 2, 'ORBPOINT', None, scs=0, event_type='EAPOGEE')
+        add(time + 30000, 'COMMAND_SW', 'COENASX', coenas1=int(rng.choice([84, 98])),
+            msid='COENASX')
+        add(time + 30100, 'COMMAND_SW', 'AOFUNCDS', aopcadsd=30, msid='AOFUNCDS')
+        add(time + 30200, 'COMMAND_SW', 'AOFUNCEN', aopcadse=30, msid='AOFUNCEN')
+        add(time - 22000, 'COMMAND_HW', 'CSELFMT4', hex='8000004', msid='CSELFMT4')
+        add(time + 22000, 'COMMAND_HW', 'CSELFMT2', hex='8000002', msid='CSELFMT2')
+        add(time + 22010, 'COMMAND_SW', 'OFMTSNRM', hex='8000005', msid='OFMTSNRM')
+        ephem = {key: round(float(val), 6) for key, val in zip(EPHEM_KEYS, rng.uniform(size=15))}
+        add(time + 40000, 'COMMAND_SW', 'AOEPHUPS', msid='AOEPHUPS', **ephem)
+        if (time - tstart) % (182.6 * 86400) < 30 * 86400:
+            time_ecl = time + ORBIT_PERIOD / 2 + rng.uniform(-5000, 5000)
+            add(time_ecl - 1000, 'COMMAND_SW', 'EOECLETO', timecnt=int(rng.randint(1000, 2000)),
+                msid='EOECLETO')
+            add(time_ecl - 100, 'COMMAND_SW', 'EOESTECN', hex='8000003', msid='EOESTECN')
+            add(time_ecl, 'ORBPOINT', None, scs=0, event_type='PENTRY')
+            add(time_ecl + 60, 'ORBPOINT', None, scs=0, event_type='EONIGHT')
+            add(time_ecl + 3600, 'ORBPOINT', None, scs=0, event_type='EODAY')
+            add(time_ecl + 3660, 'ORBPOINT', None, scs=0, event_type='PEXIT')
+
+    cmds = [cmd for cmd in cmds if tstart <= cmd['time'] < tstop]
+    cmds.sort(key=lambda cmd: cmd['time'])
+
+    times = np.round([cmd['time'] for cmd in cmds], 3)
+    dates = DateTime(times).date
+    step = 0
+    for cmd, time, date in zip(cmds, times, dates):
+        cmd['date'] = date
+        cmd['timeline_id'] = 100000000 + int((time - tstart) // TIMELINE_PERIOD)
+        cmd['vcdu'] = int(time / 0.25625) % 2 ** 24
+        if cmd['scs'] == 0:
+            cmd['step'] = 0
+        else:
+            step = step + 1 if step < 2999 else 1
+            cmd['step'] = step
+        cmd['params']['SCS'] = cmd['scs']
+        cmd['params']['STEP'] = cmd['step']
+        del cmd['time']
+
+    return cmds
+
+
+def write_cmds_archive(data_dir, cmds):
+    """
+    Write commands ``cmds`` as the kadi commands archive in ``data_dir``.
+
+    :returns: number of commands in the archive
+    """
+    from kadi import update_cmds
+
+    data_dir = Path(data_dir)
+    pars_dict = {}
+    idx_cmds = update_cmds.get_idx_cmds(cmds, pars_dict)
+    update_cmds.add_h5_cmds(str(data_dir / 'cmds.h5'), idx_cmds)
+    with open(data_dir / 'cmds.pkl', 'wb') as fh:
+        pickle.dump(pars_dict, fh, protocol=2)
+    # Older kadi versions have only the HDF5 / pickle archive
+    if hasattr(update_cmds, 'write_npy_cmds'):
+        update_cmds.write_npy_cmds(data_dir / 'cmds.h5', pars_dict, data_dir / 'cmds_npy')
+
+    return len(idx_cmds)
+
+
+def write_events_db(data_dir, cmds, seed=0):
+    """
+    Write events database in ``data_dir`` with obsid, dump and eclipse events
+    consistent with the commands ``cmds``.
+
+    This needs to be called before anything has imported ``kadi.events``, since
+    the Django database is configured from $KADI on import.
+
+    :returns: number of events
+    """
+    from Chandra.Time import DateTime
+
+    db_path = Path(data_dir, 'events3.db3')
+    db_path.touch()
+    os.environ['KADI'] = str(Path(data_dir).absolute())
+
+    from django.db import connection
+    import kadi.events  # noqa (sets up Django)
+    from kadi.events import models
+
+    def make_events(starts, stops, **kwargs):
+        tstarts = DateTime(starts).secs
+        tstops = DateTime(stops).secs
+        out = []
+        for start, stop, tstart, tstop in zip(starts, stops, tstarts, tstops):
+            event = dict(start=start, stop=stop, tstart=tstart, tstop=tstop,
+                         dur=tstop - tstart, obsid=0)
+            event.update({key: val[len(out)] for key, val in kwargs.items()})
+            out.append(event)
+        return out
+
+    obsid_cmds = [cmd for cmd in cmds if cmd['type'] == 'MP_OBSID']
+    obsids = make_events([cmd['date'] for cmd in obsid_cmds[:-1]],
+                         [cmd['date'] for cmd in obsid_cmds[1:]],
+                         obsid=[cmd['params']['ID'] for cmd in obsid_cmds[:-1]])
+
+    entries = [cmd['date'] for cmd in cmds if cmd['params'].get('EVENT_TYPE') == 'PENTRY']
+    exits = [cmd['date'] for cmd in cmds if cmd['params'].get('EVENT_TYPE') == 'PEXIT']
+    eclipses = make_events(entries, exits[:len(entries)])
+
+    rng = np.random.RandomState(seed)
+    tstart = DateTime(cmds[0]['date']).secs
+    tstop = DateTime(cmds[-1]['date']).secs
+    dump_tstarts = np.arange(tstart, tstop - 1000, 3 * 86400) + rng.uniform(0, 86400)
+    dump_tstarts = dump_tstarts[dump_tstarts < tstop - 1000]
+    dumps = make_events(DateTime(dump_tstarts).date, DateTime(dump_tstarts + 600).date)
+
+    model_events = ((models.Obsid, obsids),
+                    (models.Eclipse, eclipses),
+                    (models.Dump, dumps))
+    with connection.schema_editor() as editor:
+        for model, _ in model_events:
+            editor.create_model(model)
+    for model, events in model_events:
+        model.objects.bulk_create([model(**event) for event in events], batch_size=500)
+
+    return sum(len(events) for _, events in model_events)
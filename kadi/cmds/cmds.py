@@ -1,64 +1,46 @@
 # Licensed under a 3-clause BSD style license - see LICENSE.rst
-import tables
+import warnings
 
 import numpy as np
 
 from astropy.table import Table
-from Chandra.Time import DateTime
-import pickle
 
-from ..paths import IDX_CMDS_PATH, PARS_DICT_PATH
+from ..commands import commands
+from ..commands.commands import ARCHIVE, ArchiveVal, LazyVal  # noqa
 
 __all__ = ['filter']
 
 
-class LazyVal(object):
-    def __init__(self, load_func):
-        self._load_func = load_func
-
-    def __getattribute__(self, name):
-        try:
-            val = object.__getattribute__(self, '_val')
-        except AttributeError:
-            val = object.__getattribute__(self, '_load_func')()
-            self._val = val
-
-        if name == '_val':
-            return val
-        else:
-            return val.__getattribute__(name)
-
-    def __getitem__(self, item):
-        return self._val[item]
-
-    def __repr__(self):
-        return repr(self._val)
-
-    def __str__(self):
-        return str(self._val)
-
-    def __len__(self):
-        return self._val.__len__()
+# Globals that contain the entire commands table, the parameters store (which
+# maps idx code => parameters tuple) and the parameters index dictionary.  These
+# are the same archive arrays as for ``kadi.commands`` (see
+# ``kadi.commands.ARCHIVE``), so the archive is loaded once for both.
+idx_cmds = ArchiveVal('idx_cmds')
+rev_pars_dict = ArchiveVal('pars_store')
+pars_dict = ArchiveVal('pars_dict')
+pars_index = ArchiveVal('pars_index')
 
 
 def load_idx_cmds():
-    h5 = tables.open_file(IDX_CMDS_PATH(), mode='r')
-    idx_cmds = Table(h5.root.data[:])
-    h5.close()
-    return idx_cmds
+    """
+    Load the commands archive table from the archive files.
+
+    Deprecated, use ``kadi.commands.ARCHIVE.get().idx_cmds`` for the loaded archive.
+    """
+    warnings.warn('kadi.cmds.load_idx_cmds is deprecated, '
+                  'use kadi.commands.ARCHIVE.get().idx_cmds', DeprecationWarning)
+    return commands.load_idx_cmds()
 
 
 def load_pars_dict():
-    with open(PARS_DICT_PATH(), 'rb') as fh:
-        pars_dict = pickle.load(fh, encoding='ascii')
-    return pars_dict
-
+    """
+    Load the parameters dict (parameters tuple => idx code) from the archive files.
 
-# Globals that contain the entire commands table and the parameters index
-# dictionary.
-idx_cmds = LazyVal(load_idx_cmds)
-pars_dict = LazyVal(load_pars_dict)
-rev_pars_dict = LazyVal(lambda: {v: k for k, v in pars_dict.items()})
+    Deprecated, use ``kadi.commands.ARCHIVE.get().pars_dict`` for the loaded archive.
+    """
+    warnings.warn('kadi.cmds.load_pars_dict is deprecated, '
+                  'use kadi.commands.ARCHIVE.get().pars_dict', DeprecationWarning)
+    return commands.load_pars_dict()
 
 
 def filter(start=None, stop=None, **kwargs):
@@ -128,30 +110,16 @@ def _find(start=None, stop=None, **kwargs):
 
     Returns
     -------
-    cmds : astropy Table of commands
+    cmds : astropy Table of commands (a view into the archive if only
+        ``start`` and ``stop`` are given)
     """
-    ok = np.ones(len(idx_cmds), dtype=bool)
-    par_ok = np.zeros(len(idx_cmds), dtype=bool)
-
-    if start:
-        ok &= idx_cmds['date'] >= DateTime(start).date
-    if stop:
-        ok &= idx_cmds['date'] < DateTime(stop).date
-    for key, val in kwargs.items():
-        key = key.lower()
-        if isinstance(val, str):
-            val = val.upper()
-        if key in idx_cmds.dtype.names:
-            ok &= idx_cmds[key] == val
-        else:
-            par_ok[:] = False
-            for pars_tuple, idx in pars_dict.items():
-                pars = dict(pars_tuple)
-                if pars.get(key) == val:
-                    par_ok |= (idx_cmds['idx'] == idx)
-            ok &= par_ok
-    cmds = idx_cmds[ok]
-    return cmds
+    # The archive is sorted by date, so find the contiguous block of rows with
+    # start <= date < stop by binary search.  Slicing the table gives views of
+    # the archive columns, and all other filters are applied only within it.
+    # Use one generation of the archive throughout even if it gets reloaded.
+    archive = ARCHIVE.get()
+    i0, i1 = archive.get_row_range(start, stop)
+    return archive.filter_rows(i0, i1, **kwargs)
 
 
 class Cmd(dict):
@@ -170,6 +138,8 @@ class Cmd(dict):
 
         if self['tlmsid'] == 'None':
             colnames.remove('tlmsid')
+        if 'time' in colnames:
+            colnames.remove('time')
 
         self._ordered_keys = (colnames[1:]
                               + [par[0] for par in rev_pars_dict[cmd['idx']]])
@@ -205,12 +175,14 @@ class CmdList(object):
             if item in cmds.colnames:
                 return cmds[item]
 
-            out = []
-            for idx in cmds['idx']:
-                # Find the parameters dict for this command from the reverse
-                # lookup table which maps index to the params tuple.
-                out.append(dict(rev_pars_dict[idx]).get(item))
-            out = np.array(out)
+            # Map the idx codes through the values of the parameter for every
+            # code in the parameters store.
+            values, has_key = rev_pars_dict.get_key_values(item)
+            idxs = np.asarray(cmds['idx'])
+            if np.all(has_key[idxs]):
+                out = values[idxs]
+            else:
+                out = np.where(has_key[idxs], values[idxs], None)
 
         elif isinstance(item, int):
             out = Cmd(cmds[item])
@@ -59,3 +59,33 @@ def test_filter():
 
     assert cmd['pos'] == 73176
     assert cmd['step'] == 161
+
+
+def test_shared_with_commands():
+    """kadi.cmds uses the same archive arrays as kadi.commands"""
+    from ... import commands
+
+    assert cmds.idx_cmds._val is commands.idx_cmds._val
+    assert cmds.rev_pars_dict._val is commands.pars_store._val
+
+    cs = cmds.filter('2012:029', '2012:030')
+    assert np.shares_memory(cs.cmds['date'], commands.idx_cmds['date'])
+    assert np.all(cs['pos'] == commands.get_cmds('2012:029', '2012:030')['pos'])
+
+
+def test_deprecated_loaders():
+    """Former LazyVal loaders and reset of kadi.cmds still work"""
+    import pytest
+
+    with pytest.warns(DeprecationWarning):
+        idx_cmds = cmds.load_idx_cmds()
+    assert len(idx_cmds) == len(cmds.idx_cmds)
+    with pytest.warns(DeprecationWarning):
+        pars_dict = cmds.load_pars_dict()
+    assert pars_dict == cmds.pars_dict._val
+
+    archive = cmds.ARCHIVE.get()
+    with pytest.warns(DeprecationWarning):
+        del cmds.idx_cmds._val
+    assert cmds.ARCHIVE.get() is not archive
+    assert len(cmds.idx_cmds) == len(idx_cmds)
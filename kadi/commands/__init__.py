@@ -1,2 +1,3 @@
 # Licensed under a 3-clause BSD style license - see LICENSE.rst
 from .commands import *  # noqa
+from .commands import ARCHIVE, CMDS_CACHE  # noqa
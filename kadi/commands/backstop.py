@@ -0,0 +1,289 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Fast reading of backstop files, with a persistent cache of parsed results.
+"""
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+from astropy.table import Table
+
+from ..paths import BACKSTOP_CACHE_DIR
+
+__all__ = ['read_backstop', 'read_backstop_as_list']
+
+# Version of the parsed backstop format in the cache.  Increment this if the
+# output of parse_backstop_lines() or the cache file format changes.
+CACHE_VERSION = 3
+
+# Maximum total size of the backstop cache files (bytes).  The least recently
+# used files are removed when a new file takes the cache over this size.
+CACHE_MAX_BYTES = int(float(os.environ.get('KADI_BACKSTOP_CACHE_MAX_MB', 1000)) * 1e6)
+
+# Estimated total size of the files in each cache directory (see _write_cache)
+_cache_bytes = {}
+
+
+def _coerce_type(val):
+    """Coerce the supplied ``val`` (typically a string) into an int or float if
+    possible, otherwise as a string.
+    """
+    try:
+        val = int(val)
+    except ValueError:
+        try:
+            val = float(val)
+        except ValueError:
+            val = str(val)
+    return val
+
+
+def read_backstop_as_list(filename, cache=True):
+    """
+    Read commands from backstop file.
+
+    Create dict with keys date, type, params, tlmsid, scs, step and vcdu for
+    each command.  ``params`` is the dict of key=val pairs from the parameters
+    string, with keys as in the backstop file (upper case).
+
+    If ``cache`` is True then the parsed commands are saved in the per-user
+    backstop cache directory (``~/.kadi/backstop_cache`` or
+    ``$KADI_BACKSTOP_CACHE``) and subsequent reads of a file with the same
+    contents are taken from there.  Cache entries are ``.npy`` files (read
+    without pickle) keyed by the MD5 hash of the file contents.  The cache is
+    limited in size to ``CACHE_MAX_BYTES`` (``$KADI_BACKSTOP_CACHE_MAX_MB``,
+    default 1000 Mb) by removing the least recently used entries.
+
+    :param filename: Backstop file name
+    :param cache: use the persistent cache of parsed backstop files (default=True)
+    :returns: list of dict for each command
+    """
+    filename = Path(filename)
+    with open(filename, 'rb') as fh:
+        text = fh.read()
+
+    if not cache:
+        return parse_backstop_lines(text.decode('ascii').splitlines(keepends=True))
+
+    cache_path = _get_cache_path(text)
+    cmds = _read_cache(cache_path)
+    if cmds is None:
+        cmds = parse_backstop_lines(text.decode('ascii').splitlines(keepends=True))
+        _write_cache(cache_path, cmds)
+
+    return cmds
+
+
+def read_backstop(filename, cache=True):
+    """
+    Read commands from backstop file into a Table.
+
+    This gives the same table format as ``parse_cm.read_backstop``, namely
+    columns ``date``, ``vcdu``, ``type``, ``params``, ``tlmsid``, ``scs`` and
+    ``step``, with lower-case parameter keys.  See ``read_backstop_as_list``
+    for the ``cache`` argument.
+
+    :param filename: Backstop file name
+    :param cache: use the persistent cache of parsed backstop files (default=True)
+    :returns: Table of commands
+    """
+    cmds = read_backstop_as_list(filename, cache=cache)
+
+    lower_keys = {}
+    params_list = []
+    for cmd in cmds:
+        params = {}
+        for key, val in cmd['params'].items():
+            try:
+                params[lower_keys[key]] = val
+            except KeyError:
+                lower_keys[key] = key.lower()
+                params[lower_keys[key]] = val
+        params_list.append(params)
+
+    out = Table()
+    out['date'] = [cmd['date'] for cmd in cmds]
+    out['vcdu'] = np.array([cmd['vcdu'] for cmd in cmds], dtype=np.int64)
+    out['type'] = [cmd['type'] for cmd in cmds]
+    params_col = np.empty(len(cmds), dtype=object)
+    params_col[:] = params_list
+    out['params'] = params_col
+    out['tlmsid'] = [str(cmd['tlmsid']) for cmd in cmds]
+    out['scs'] = np.array([cmd['scs'] or 0 for cmd in cmds], dtype=np.int64)
+    out['step'] = np.array([cmd['step'] or 0 for cmd in cmds], dtype=np.int64)
+
+    return out
+
+
+def parse_backstop_lines(lines):
+    """
+    Parse backstop file ``lines`` into a list of dict for each command.
+
+    The parameters are parsed in bulk: each distinct ``key=val`` string in the
+    file is split and the value coerced to int, float or str only once.
+
+    As for the original line by line reading of the file, ``lines`` includes
+    the line endings, so the last parameter value of each line keeps the
+    newline if it is a string.
+
+    :param lines: list of str lines from backstop file
+    :returns: list of dict for each command
+    """
+    rows = [line.replace(' ', '').split('|') for line in lines if line.strip()]
+    opt_strs = [row[3].split(',') for row in rows]
+
+    # Map each distinct "key=val" string to (key, val), or None if it is not
+    # a valid key=val pair (backstop has some quirks like blank or '??????' fields).
+    opts = set()
+    for opt_str in opt_strs:
+        opts.update(opt_str)
+    keys = {}
+    opt_map = {}
+    for opt in opts:
+        key_val = opt.split('=')
+        if len(key_val) != 2:
+            opt_map[opt] = None
+            continue
+        key, val = key_val
+        key = keys.setdefault(key, key)
+        opt_map[opt] = (key, val if key == 'HEX' else _coerce_type(val))
+    get_opt = opt_map.__getitem__
+
+    params_list = [dict(filter(None, map(get_opt, opt_str))) for opt_str in opt_strs]
+    # Get rid of final '0' from '8023268 0' (where space was stripped)
+    return _make_cmds([row[0] for row in rows], [row[2] for row in rows],
+                      params_list, [int(row[1][:-1]) for row in rows])
+
+
+def _make_cmds(dates, types, params_list, vcdus):
+    """
+    Make the list of dict for each command from the values of each field.
+    """
+    return [{'date': date,
+             'type': cmd_type,
+             'params': params,
+             'tlmsid': params.get('TLMSID'),
+             'scs': params.get('SCS'),
+             'step': params.get('STEP'),
+             'vcdu': vcdu}
+            for date, cmd_type, params, vcdu in zip(dates, types, params_list, vcdus)]
+
+
+def _get_cache_path(text):
+    """
+    Get the cache file path for backstop file contents ``text``.
+
+    :returns: cache path
+    """
+    md5 = hashlib.md5(text).hexdigest()
+    return Path(BACKSTOP_CACHE_DIR(), f'{md5}.v{CACHE_VERSION}.npy')
+
+
+def _read_cache(cache_path):
+    """
+    Read parsed backstop commands from ``cache_path``.
+
+    The cache file is a structured array with the ``date``, ``type`` and
+    ``vcdu`` of each command and its ``params`` as a JSON string.
+
+    :returns: list of dict or None if not in the cache
+    """
+    try:
+        cached = np.load(cache_path, allow_pickle=False)
+        params_list = json.loads(b'[' + b','.join(cached['params'].tolist()) + b']')
+    except Exception:
+        return None
+
+    # Mark as recently used for the cache size limit
+    try:
+        os.utime(cache_path)
+    except OSError:
+        pass
+    return _make_cmds(np.char.decode(cached['date'], 'ascii').tolist(),
+                      np.char.decode(cached['type'], 'ascii').tolist(),
+                      params_list, cached['vcdu'].tolist())
+
+
+def _write_cache(cache_path, cmds):
+    """
+    Write parsed backstop commands ``cmds`` to ``cache_path``.
+
+    The file is written in place atomically.  Failure to write (e.g. no write
+    access to the cache directory) is ignored.
+
+    The total size of the cache directory is found once per process and then
+    kept up to date with the size of each file written.  Only when this
+    exceeds ``CACHE_MAX_BYTES`` is the directory scanned and pruned.
+    """
+    cols = {'date': np.array([cmd['date'] for cmd in cmds], dtype=bytes),
+            'type': np.array([cmd['type'] for cmd in cmds], dtype=bytes),
+            'vcdu': np.array([cmd['vcdu'] for cmd in cmds], dtype=np.int64),
+            'params': np.array([json.dumps(cmd['params']) for cmd in cmds], dtype=bytes)}
+    cached = np.empty(len(cmds), dtype=[(name, col.dtype) for name, col in cols.items()])
+    for name, col in cols.items():
+        cached[name] = col
+
+    tmp_path = cache_path.with_name(f'{cache_path.name}.{os.getpid()}.tmp')
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(tmp_path, 'wb') as fh:
+            np.save(fh, cached, allow_pickle=False)
+            n_bytes = fh.tell()
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        return
+
+    cache_dir = cache_path.parent
+    if cache_dir in _cache_bytes:
+        _cache_bytes[cache_dir] += n_bytes
+    else:
+        _cache_bytes[cache_dir] = sum(size for _, size, _ in _get_cache_entries(cache_dir))
+    if _cache_bytes[cache_dir] > CACHE_MAX_BYTES:
+        _cache_bytes[cache_dir] = _prune_cache(cache_dir, CACHE_MAX_BYTES)
+
+
+def _get_cache_entries(cache_dir):
+    """
+    Get (mtime_ns, size, path) for each file in backstop cache directory
+    ``cache_dir``, skipping files that other processes remove meanwhile.
+    """
+    entries = []
+    for path in Path(cache_dir).glob('*.npy'):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime_ns, stat.st_size, path))
+    return entries
+
+
+def _prune_cache(cache_dir, max_bytes):
+    """
+    Remove the least recently used (by modification time) files in backstop
+    cache directory ``cache_dir`` until the total size is at most ``max_bytes``.
+
+    Processes pruning at the same time remove the same files in the same
+    order, and a file already removed by another process counts as removed.
+
+    :returns: total size of the remaining files
+    """
+    entries = _get_cache_entries(cache_dir)
+    n_bytes = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if n_bytes <= max_bytes:
+            break
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+        except OSError:
+            continue
+        n_bytes -= size
+
+    return n_bytes
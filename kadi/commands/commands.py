@@ -1,28 +1,70 @@
 # Licensed under a 3-clause BSD style license - see LICENSE.rst
+import collections
+import collections.abc
+import hashlib
+import json
+import operator
+import os
+import threading
+import time
+import warnings
 import tables
 from pathlib import Path
 
 import numpy as np
 
-from astropy.table import Table, Row, Column, vstack
+from astropy.table import Table, Row, Column, MaskedColumn, vstack
 from Chandra.Time import DateTime
 import pickle
 
-from ..paths import IDX_CMDS_PATH, PARS_DICT_PATH
+from ..paths import IDX_CMDS_PATH, IDX_CMDS_NPY_DIR, PARS_DICT_PATH
+from .backstop import read_backstop
 
-__all__ = ['get_cmds', 'get_cmds_from_backstop', 'CommandTable']
+__all__ = ['get_cmds', 'iter_cmds', 'get_cmds_from_backstop', 'CommandTable', 'prefetch']
+
+# Comparison operators for ``key__op=val`` filters in get_cmds.  The ``in`` and
+# ``startswith`` operators are handled separately.
+FILTER_OPS = {'exact': operator.eq,
+              'ne': operator.ne,
+              'gt': operator.gt,
+              'gte': operator.ge,
+              'lt': operator.lt,
+              'lte': operator.le,
+              'in': None,
+              'startswith': None}
+
+# Archive columns with a value index (built on first use) for get_cmds filters
+INDEX_COLS = ('type', 'tlmsid')
+
+# Archive columns in sorted order, where range filters are a binary search
+RANGE_COLS = ('date', 'time')
+
+# Looking up the rows for each matching code in an index costs about as much
+# as scanning this many archive rows, so a filter that matches more codes than
+# (number of rows / INDEX_ROWS_PER_CODE) is evaluated by a scan instead.
+INDEX_ROWS_PER_CODE = 1000
 
 
 class LazyVal(object):
+    """
+    Proxy for the value returned by ``load_func``, which is called once on
+    first access.  Concurrent first accesses from several threads wait for
+    the one load.
+    """
     def __init__(self, load_func):
         self._load_func = load_func
+        self._lock = threading.Lock()
 
     def __getattribute__(self, name):
         try:
             val = object.__getattribute__(self, '_val')
         except AttributeError:
-            val = object.__getattribute__(self, '_load_func')()
-            self._val = val
+            with object.__getattribute__(self, '_lock'):
+                try:
+                    val = object.__getattribute__(self, '_val')
+                except AttributeError:
+                    val = object.__getattribute__(self, '_load_func')()
+                    self._val = val
 
         if name == '_val':
             return val
@@ -41,28 +83,1439 @@ class LazyVal(object):
     def __len__(self):
         return self._val.__len__()
 
+    def __contains__(self, item):
+        return item in self._val
+
+    def __iter__(self):
+        return iter(self._val)
+
 
 def load_idx_cmds():
-    h5 = tables.open_file(IDX_CMDS_PATH(), mode='r')
-    idx_cmds = Table(h5.root.data[:])
-    h5.close()
+    """
+    Load the commands archive table.
+
+    If the column-per-file version of the archive written by ``update_cmds``
+    is available then each column is memory-mapped.  In this case data are
+    read from disk only when touched and the pages are shared between
+    processes by the OS file cache.  Otherwise the full HDF5 table is read.
+
+    The ``version`` stamp of the archive files at the time of loading is stored
+    in the table ``meta``.  If the archive does not have the ``time`` column
+    (CXC seconds) then it is computed from ``date``, with a warning since this
+    is slow.  Running ``update_cmds`` adds the column to the archive.
+
+    :returns: Table of commands
+    """
+    version = get_archive_version()
+    idx_cmds = _load_idx_cmds_npy()
+    if idx_cmds is None:
+        h5 = tables.open_file(IDX_CMDS_PATH(), mode='r')
+        idx_cmds = Table(h5.root.data[:])
+        h5.close()
+    if 'time' not in idx_cmds.colnames:
+        # Archive written by an older version of update_cmds
+        warnings.warn(f'commands archive {IDX_CMDS_PATH()} has no time column, '
+                      'computing it from date (slow).  Run update_cmds to add it.')
+        times = DateTime(np.char.decode(idx_cmds['date'], 'ascii')).secs
+        idx_cmds.add_column(Column(times, name='time'), index=2)
+    idx_cmds.meta['version'] = version
     return idx_cmds
 
 
+def get_archive_version():
+    """
+    Get the version stamp of the commands archive files.
+
+    This is the file modification time (ns) and size of each of the HDF5
+    archive, the pickled parameters dict and the ``.npy`` archive header, with
+    ``None`` for a file that does not exist.  Any update of the archive by
+    ``update_cmds`` changes the version.
+
+    :returns: tuple
+    """
+    return tuple(get_file_stat(path) for path in
+                 (IDX_CMDS_PATH(), PARS_DICT_PATH(), Path(IDX_CMDS_NPY_DIR(), 'header.json')))
+
+
+def get_file_stat(path):
+    """
+    Get the modification time (ns) and size of file ``path``.
+
+    :param path: file name
+    :returns: (mtime_ns, size) tuple or None if the file does not exist
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def get_cmds_digest(cmds, n_tail=100):
+    """
+    Get the MD5 digest of the ``date`` and ``idx`` columns in the last ``n_tail``
+    rows of commands archive table ``cmds``.
+
+    An update of the archive replaces or appends the commands at the end of
+    the table, so this changes even if the number of rows does not.
+
+    :param cmds: structured array, Table or dict of columns of commands
+    :param n_tail: number of rows at the end of ``cmds`` (default=100)
+    :returns: str hex digest
+    """
+    md5 = hashlib.md5()
+    md5.update(np.asarray(cmds['date'][-n_tail:], dtype='S21').tobytes())
+    md5.update(np.asarray(cmds['idx'][-n_tail:], dtype=np.uint16).tobytes())
+    return md5.hexdigest()
+
+
+def _load_idx_cmds_npy(n_tries=3):
+    """
+    Load the commands archive as memory-mapped ``.npy`` columns.
+
+    ``update_cmds`` replaces the ``.npy`` archive directory while it may be
+    in use, so if the files disappear while loading or the columns do not
+    match the header then the load is tried again with the new header.
+
+    :param n_tries: number of tries (default=3)
+    :returns: Table of commands or None if the ``.npy`` archive is not available
+    """
+    npy_dir = Path(IDX_CMDS_NPY_DIR())
+    for _ in range(n_tries):
+        header = _get_npy_header()
+        if header is None:
+            return None
+        try:
+            cols = {name: np.load(npy_dir / f'{name}.npy', mmap_mode='r')
+                    for name in header['colnames']}
+        except OSError:
+            continue
+        if (all(len(col) == header['n_rows'] for col in cols.values())
+                and get_cmds_digest(cols, header['n_tail']) == header['digest']):
+            return Table(list(cols.values()), names=header['colnames'], copy=False)
+
+    return None
+
+
+def _get_npy_header():
+    """
+    Get the header of the ``.npy`` version of the commands archive.
+
+    Returns ``None`` if the ``.npy`` archive is not available or it is not
+    consistent with the HDF5 archive and pickled ``pars_dict`` it was written
+    from (e.g. these were updated by an older version of ``update_cmds``, an
+    update did not complete, or the files were edited).  This checks the
+    number of rows and digest of the last rows of the HDF5 archive (see
+    ``get_cmds_digest``) and the modification time and size of the
+    ``pars_dict`` file.
+
+    :returns: dict or None
+    """
+    try:
+        with open(Path(IDX_CMDS_NPY_DIR(), 'header.json'), 'r') as fh:
+            header = json.load(fh)
+    except FileNotFoundError:
+        return None
+    if 'digest' not in header:
+        # Written by an older version of update_cmds
+        return None
+
+    pars_stat = get_file_stat(PARS_DICT_PATH())
+    if header.get('pars_dict_stat') != (None if pars_stat is None else list(pars_stat)):
+        return None
+
+    if os.path.exists(IDX_CMDS_PATH()):
+        with tables.open_file(IDX_CMDS_PATH(), mode='r') as h5:
+            n_rows = h5.root.data.nrows
+            if n_rows != header['n_rows']:
+                return None
+            tail = h5.root.data.read(start=max(n_rows - header['n_tail'], 0))
+        if get_cmds_digest(tail, header['n_tail']) != header['digest']:
+            return None
+
+    return header
+
+
+def load_index(name):
+    """
+    Load the persisted index of archive column ``name`` (``idx`` or one of
+    ``INDEX_COLS``) that is written by ``update_cmds``.
+
+    The index is memory-mapped from the ``.npy`` archive if available there,
+    otherwise it is read from the HDF5 archive.
+
+    :param name: column name
+    :returns: RowIndex (for ``idx``), ColumnIndex or None if not available
+    """
+    cls = RowIndex if name == 'idx' else ColumnIndex
+    header = _get_npy_header()
+    if header is not None and name in header.get('indexes', []):
+        npy_dir = Path(IDX_CMDS_NPY_DIR())
+        try:
+            arrays = {arr: np.load(npy_dir / f'index_{name}_{arr}.npy', mmap_mode='r')
+                      for arr in cls.array_names}
+        except OSError:
+            # .npy archive replaced by update_cmds meanwhile, use HDF5
+            pass
+        else:
+            if arrays['offsets'][-1] == header['n_rows']:
+                return cls(**arrays)
+
+    if not os.path.exists(IDX_CMDS_PATH()):
+        return None
+    with tables.open_file(IDX_CMDS_PATH(), mode='r') as h5:
+        arrays = read_h5_index(h5, name)
+    return None if arrays is None else cls(**arrays)
+
+
+def read_h5_index(h5, name, n_rows=None):
+    """
+    Read the arrays of the index of column ``name`` from the ``/index`` group of
+    the open HDF5 commands archive ``h5``.
+
+    :param h5: tables.File
+    :param name: column name
+    :param n_rows: number of rows of the commands table (default=current)
+    :returns: dict of arrays or None if the index is not available or not up
+        to date with the commands table
+    """
+    try:
+        group = h5.get_node('/index', name)
+    except tables.NoSuchNodeError:
+        return None
+    if n_rows is None:
+        n_rows = h5.root.data.nrows
+    if h5.root.index._v_attrs.n_rows != n_rows:
+        return None
+    return {node.name: node.read() for node in group._f_iter_nodes()}
+
+
 def load_pars_dict():
     with open(PARS_DICT_PATH(), 'rb') as fh:
         pars_dict = pickle.load(fh, encoding='ascii')
     return pars_dict
 
 
-# Globals that contain the entire commands table and the parameters index
-# dictionary.
-idx_cmds = LazyVal(load_idx_cmds)
-pars_dict = LazyVal(load_pars_dict)
-rev_pars_dict = LazyVal(lambda: {v: k for k, v in pars_dict.items()})
+def load_pars_store():
+    """
+    Load the command parameters store.
 
+    This memory-maps the columnar store written with the ``.npy`` commands
+    archive if available, otherwise it is built from the pickled ``pars_dict``.
 
-def get_cmds(start=None, stop=None, **kwargs):
+    :returns: :class:`~kadi.commands.commands.ParsStore`
+    """
+    header = _get_npy_header()
+    if header is not None and header.get('n_pars') is not None:
+        try:
+            pars_store = ParsStore.read(IDX_CMDS_NPY_DIR())
+        except OSError:
+            # .npy archive replaced by update_cmds meanwhile
+            pass
+        else:
+            if len(pars_store) == header['n_pars']:
+                return pars_store
+    return ParsStore.from_pars_dict(load_pars_dict())
+
+
+class ParsStore(collections.abc.Mapping):
+    """
+    Columnar store of command parameters, indexed by parameter ``idx`` code.
+
+    The parameters for code ``idx`` are the entries ``offsets[idx]:offsets[idx + 1]``
+    of the flat ``keys``, ``kinds`` and ``val_pos`` arrays.  For each entry,
+    ``keys`` is a code into ``key_names``, ``kinds`` selects the typed value
+    array (0 => ``ints``, 1 => ``floats``, 2 => ``strs``) and ``val_pos`` is the
+    position of the value within that array.
+
+    All the data are in numpy arrays, so reading the store creates no Python
+    objects per parameter.  Indexing with an ``idx`` code returns the same
+    tuple of ``(key, value)`` pairs as the keys of the original ``pars_dict``,
+    and raises ``KeyError`` for an unknown code.  The store is a read-only
+    mapping of ``idx`` code => parameters tuple, so it can be used in place of
+    the former ``rev_pars_dict`` dict (``in``, ``get()``, ``keys()``,
+    ``items()`` etc).
+
+    :param arrays: dict of arrays with keys ``ParsStore.array_names``
+    """
+    array_names = ('offsets', 'keys', 'kinds', 'val_pos', 'key_names',
+                   'ints', 'floats', 'strs')
+
+    def __init__(self, arrays):
+        for name in self.array_names:
+            setattr(self, name, arrays[name])
+        self._key_names = [key.decode('ascii') for key in self.key_names]
+        self._key_values = {}
+
+    @classmethod
+    def from_pars_dict(cls, pars_dict):
+        """
+        Create store from ``pars_dict`` (dict of parameters tuple => idx code).
+
+        :param pars_dict: dict
+        :returns: ParsStore
+        """
+        n_pars = max(pars_dict.values()) + 1 if pars_dict else 0
+        rev_pars = [()] * n_pars
+        for pars_tuple, idx in pars_dict.items():
+            rev_pars[idx] = pars_tuple
+
+        key_codes = {}
+        val_codes = ({}, {}, {})  # int, float, str value => position
+        offsets = [0]
+        keys = []
+        kinds = []
+        val_pos = []
+        for pars_tuple in rev_pars:
+            for key, val in pars_tuple:
+                if isinstance(val, str):
+                    kind = 2
+                elif isinstance(val, (int, np.integer)):
+                    kind = 0
+                elif isinstance(val, (float, np.floating)):
+                    kind = 1
+                else:
+                    raise TypeError(f'parameter {key}={val!r} has unsupported type')
+                keys.append(key_codes.setdefault(key, len(key_codes)))
+                kinds.append(kind)
+                val_pos.append(val_codes[kind].setdefault(val, len(val_codes[kind])))
+            offsets.append(len(keys))
+
+        arrays = {'offsets': np.array(offsets, dtype=np.int64),
+                  'keys': np.array(keys, dtype=np.uint16),
+                  'kinds': np.array(kinds, dtype=np.uint8),
+                  'val_pos': np.array(val_pos, dtype=np.uint32),
+                  'key_names': np.array([key.encode('ascii') for key in key_codes],
+                                        dtype=bytes),
+                  'ints': np.array(list(val_codes[0]), dtype=np.int64),
+                  'floats': np.array(list(val_codes[1]), dtype=np.float64),
+                  'strs': np.array([val.encode('ascii') for val in val_codes[2]],
+                                   dtype=bytes)}
+        return cls(arrays)
+
+    @classmethod
+    def read(cls, npy_dir):
+        """
+        Read store from ``pars_<name>.npy`` files in ``npy_dir`` (memory-mapped).
+
+        :param npy_dir: directory name
+        :returns: ParsStore
+        """
+        npy_dir = Path(npy_dir)
+        arrays = {name: np.load(npy_dir / f'pars_{name}.npy', mmap_mode='r')
+                  for name in cls.array_names}
+        return cls(arrays)
+
+    def write(self, npy_dir):
+        """
+        Write store to ``pars_<name>.npy`` files in ``npy_dir``.
+
+        :param npy_dir: directory name
+        """
+        npy_dir = Path(npy_dir)
+        for name in self.array_names:
+            np.save(npy_dir / f'pars_{name}.npy', getattr(self, name))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        return iter(range(len(self)))
+
+    def __contains__(self, idx):
+        try:
+            idx = operator.index(idx)
+        except TypeError:
+            return False
+        return 0 <= idx < len(self)
+
+    def __getitem__(self, idx):
+        if idx not in self:
+            raise KeyError(idx)
+        i0, i1 = self.offsets[idx], self.offsets[idx + 1]
+        return tuple((self._key_names[key], self.get_value(kind, pos))
+                     for key, kind, pos in zip(self.keys[i0:i1],
+                                               self.kinds[i0:i1],
+                                               self.val_pos[i0:i1]))
+
+    def get_value(self, kind, pos):
+        """
+        Get the Python value at position ``pos`` of the typed value array ``kind``.
+
+        :param kind: 0 (int), 1 (float) or 2 (str)
+        :param pos: position in typed value array
+        :returns: int, float or str
+        """
+        if kind == 0:
+            return int(self.ints[pos])
+        elif kind == 1:
+            return float(self.floats[pos])
+        else:
+            return self.strs[pos].decode('ascii')
+
+    def get_key_values(self, key):
+        """
+        Get the value of parameter ``key`` for every idx code.
+
+        The values array is typed (int, float or str) if the parameter values
+        have a common type, otherwise it is an object array.  Entries for codes
+        that do not have ``key`` are zero (or empty).  The result is cached.
+
+        :param key: parameter name (lower case)
+        :returns: values array, bool array of codes which have ``key``
+        """
+        if key in self._key_values:
+            return self._key_values[key]
+
+        n_pars = len(self)
+        has_key = np.zeros(n_pars, dtype=bool)
+        if key not in self._key_names:
+            values = np.zeros(n_pars, dtype=object)
+        else:
+            sel = self.keys == self._key_names.index(key)
+            entry_idxs = np.repeat(np.arange(n_pars), np.diff(self.offsets))[sel]
+            kinds = self.kinds[sel]
+            val_pos = self.val_pos[sel]
+            kinds_set = set(np.unique(kinds).tolist())
+
+            if kinds_set == {0}:
+                vals = self.ints[val_pos]
+            elif kinds_set <= {0, 1}:
+                is_int = kinds == 0
+                vals = np.empty(len(kinds), dtype=np.float64)
+                vals[is_int] = self.ints[val_pos[is_int]]
+                vals[~is_int] = self.floats[val_pos[~is_int]]
+            elif kinds_set == {2}:
+                vals = np.char.decode(self.strs[val_pos], 'ascii')
+            else:
+                vals = np.array([self.get_value(kind, pos)
+                                 for kind, pos in zip(kinds, val_pos)], dtype=object)
+
+            values = np.zeros(n_pars, dtype=vals.dtype)
+            values[entry_idxs] = vals
+            has_key[entry_idxs] = True
+
+        self._key_values[key] = values, has_key
+        return values, has_key
+
+    def get_keys(self, idxs):
+        """
+        Get the names of all parameters for the idx codes ``idxs``.
+
+        :param idxs: array of idx codes
+        :returns: sorted list of parameter names
+        """
+        idxs = np.unique(idxs)
+        counts = self.offsets[idxs + 1] - self.offsets[idxs]
+        # Positions of all the store entries for the codes
+        starts = np.repeat(self.offsets[idxs] - np.cumsum(counts) + counts, counts)
+        entries = starts + np.arange(np.sum(counts))
+        return sorted(self._key_names[key] for key in np.unique(self.keys[entries]))
+
+    def items(self):
+        for idx in range(len(self)):
+            yield idx, self[idx]
+
+    def to_pars_dict(self):
+        """
+        Convert to the original ``pars_dict`` (dict of parameters tuple => idx code).
+
+        :returns: dict
+        """
+        return {pars_tuple: idx for idx, pars_tuple in self.items()}
+
+
+class RowIndex(object):
+    """
+    Posting lists of archive row positions for integer codes.
+
+    ``rows`` is the archive row positions sorted by code, and the rows for code
+    ``code`` are ``rows[offsets[code]:offsets[code + 1]]``, in ascending order.
+
+    :param rows: int array of row positions sorted by code
+    :param offsets: int array of start of the rows for each code, plus the end
+    """
+    array_names = ('rows', 'offsets')
+
+    def __init__(self, rows, offsets):
+        self.rows = rows
+        self.offsets = offsets
+
+    @classmethod
+    def from_codes(cls, codes, n_codes=None):
+        """
+        Create index from the code for each archive row.
+
+        :param codes: int array of code for each archive row
+        :param n_codes: number of codes (default=max code + 1)
+        :returns: RowIndex
+        """
+        rows, offsets = _get_rows_offsets(codes, n_codes)
+        return cls(rows, offsets)
+
+    @property
+    def n_rows(self):
+        """Number of archive rows in the index"""
+        return int(self.offsets[-1]) if len(self.offsets) > 0 else 0
+
+    def get_arrays(self):
+        """Dict of the index arrays (for writing)"""
+        return {name: getattr(self, name) for name in self.array_names}
+
+    def truncate_append(self, n_keep, codes):
+        """
+        Get index for the archive truncated to ``n_keep`` rows and then with
+        rows having ``codes`` appended.
+
+        This only re-sorts the posting lists, using that the appended rows come
+        after all the kept rows.
+
+        :param n_keep: number of archive rows kept
+        :param codes: int array of code for each appended row
+        :returns: RowIndex
+        """
+        rows, offsets = self._truncate_append(n_keep, codes)
+        return self.__class__(rows, offsets)
+
+    def _truncate_append(self, n_keep, codes, code_map=None, n_codes=None):
+        """
+        Rows and offsets for ``truncate_append()``, where ``code_map`` maps the
+        current codes to new codes in the same order (optional) and ``n_codes``
+        is the new number of codes (default=current number or max code + 1).
+        """
+        codes = np.asarray(codes, dtype=np.int64)
+        old_codes = np.repeat(np.arange(len(self.offsets) - 1), np.diff(self.offsets))
+        if code_map is not None:
+            old_codes = code_map[old_codes]
+        if n_codes is None:
+            n_codes = max(len(self.offsets) - 1,
+                          int(codes.max()) + 1 if len(codes) > 0 else 0)
+
+        keep = np.asarray(self.rows) < n_keep
+        all_codes = np.concatenate([old_codes[keep], codes])
+        all_rows = np.concatenate([np.asarray(self.rows)[keep],
+                                   n_keep + np.arange(len(codes))])
+        # The stable sort keeps the rows for each code in ascending order since
+        # the appended rows come after the kept rows.
+        order = np.argsort(all_codes, kind='stable')
+        offsets = np.searchsorted(all_codes[order], np.arange(n_codes + 1))
+        return all_rows[order], offsets
+
+    def _code_rows(self, code, i0, i1):
+        """Rows for ``code`` in the range ``i0 <= row < i1``"""
+        code = int(code)
+        if code + 1 >= len(self.offsets):
+            return self.rows[:0]
+        code_rows = self.rows[self.offsets[code]:self.offsets[code + 1]]
+        j0, j1 = np.searchsorted(code_rows, [i0, i1])
+        return code_rows[j0:j1]
+
+    def get_rows(self, codes, i0, i1):
+        """
+        Get archive row positions in the range ``i0 <= row < i1`` for ``codes``.
+
+        :param codes: iterable of codes
+        :param i0: first row
+        :param i1: row after last row
+        :returns: array of row positions (not sorted)
+        """
+        rows = [np.zeros(0, dtype=self.rows.dtype)]
+        rows.extend(self._code_rows(code, i0, i1) for code in codes)
+        return np.concatenate(rows)
+
+    def count_rows(self, codes, i0, i1):
+        """
+        Count archive rows in the range ``i0 <= row < i1`` for ``codes``.
+
+        :param codes: iterable of codes
+        :param i0: first row
+        :param i1: row after last row
+        :returns: int
+        """
+        return sum(len(self._code_rows(code, i0, i1)) for code in codes)
+
+    def count_all_rows(self, codes):
+        """
+        Count all archive rows for ``codes``, without a loop over the codes.
+
+        :param codes: int array of codes
+        :returns: int
+        """
+        counts = np.diff(self.offsets)
+        codes = np.asarray(codes, dtype=np.int64)
+        return int(counts[codes[codes < len(counts)]].sum())
+
+
+class ColumnIndex(RowIndex):
+    """
+    Index of the values of an archive column such as ``tlmsid``.
+
+    The column is encoded as codes into ``values``, the sorted unique column
+    values, and the row positions are indexed by code (see
+    :class:`~kadi.commands.commands.RowIndex`).  A filter on the column is then
+    matched against ``values`` and the rows for the matching codes are looked
+    up directly.
+
+    :param values: sorted array of unique column values
+    :param rows: int array of row positions sorted by code
+    :param offsets: int array of start of the rows for each code, plus the end
+    """
+    array_names = ('values', 'rows', 'offsets')
+
+    def __init__(self, values, rows, offsets):
+        self.values = values
+        super(ColumnIndex, self).__init__(rows, offsets)
+
+    @classmethod
+    def from_codes(cls, values, codes):
+        """
+        Create index from the code into ``values`` for each archive row.
+
+        :param values: sorted array of unique column values
+        :param codes: int array of code for each archive row
+        :returns: ColumnIndex
+        """
+        rows, offsets = _get_rows_offsets(codes, len(values))
+        return cls(values, rows, offsets)
+
+    @classmethod
+    def from_column(cls, col):
+        """
+        Create index for the values of archive column ``col``.
+
+        :param col: Column or array
+        :returns: ColumnIndex
+        """
+        values, codes = np.unique(np.asarray(col), return_inverse=True)
+        return cls.from_codes(values, codes)
+
+    def truncate_append(self, n_keep, col):
+        """
+        Get index for the archive truncated to ``n_keep`` rows and then with
+        rows having column values ``col`` appended.
+
+        Values that are no longer in the column are kept in ``values``, with
+        no rows.
+
+        :param n_keep: number of archive rows kept
+        :param col: array of column values for the appended rows
+        :returns: ColumnIndex
+        """
+        col = np.asarray(col)
+        values = np.union1d(self.values, col)
+        code_map = np.searchsorted(values, self.values)
+        rows, offsets = self._truncate_append(n_keep, np.searchsorted(values, col),
+                                              code_map, len(values))
+        return self.__class__(values, rows, offsets)
+
+    def get_codes(self, val, op='exact'):
+        """
+        Get codes of the column values that match ``val`` for the filter
+        operator ``op`` (see ``FILTER_OPS``).
+
+        :param val: filter value
+        :param op: filter operator (default='exact')
+        :returns: sorted array of codes
+        """
+        return np.flatnonzero(_match_column(self.values, op, val))
+
+
+def _get_rows_offsets(codes, n_codes=None):
+    """
+    Posting-list ``rows`` and ``offsets`` arrays (see ``RowIndex``) for the code
+    of each archive row ``codes``.
+    """
+    codes = np.asarray(codes)
+    if n_codes is None:
+        n_codes = int(codes.max()) + 1 if len(codes) > 0 else 0
+    # The stable sort keeps the rows for each code in ascending order
+    rows = np.argsort(codes, kind='stable')
+    offsets = np.searchsorted(codes[rows], np.arange(n_codes + 1))
+    return rows, offsets
+
+
+class ParsIndex(RowIndex):
+    """
+    Inverted index of command parameters for the commands archive.
+
+    This provides two mappings that are built once from ``idx_cmds`` and the
+    parameters store:
+
+    - Parameter key => value => sorted array of parameter ``idx`` codes for
+      which the parameters include ``key=value``.
+    - Parameter ``idx`` code => sorted array of the archive row positions with
+      that code (see :class:`~kadi.commands.commands.RowIndex`).
+
+    With these a parameter filter like ``msid='AFLCRSET'`` is a pair of dict
+    lookups followed by a merge of the matching row positions.
+
+    :param idx_cmds: Table of commands archive
+    :param pars_store: :class:`~kadi.commands.commands.ParsStore`
+    :param row_index: :class:`~kadi.commands.commands.RowIndex` of the archive
+        ``idx`` column (default=build from ``idx_cmds``)
+    """
+    def __init__(self, idx_cmds, pars_store, row_index=None):
+        # Group the store entries by unique (key, kind, value position) and
+        # collect the idx codes for each group.
+        entry_idxs = np.repeat(np.arange(len(pars_store), dtype=np.uint16),
+                               np.diff(pars_store.offsets))
+        entry_codes = ((pars_store.keys.astype(np.int64) << 40)
+                       | (pars_store.kinds.astype(np.int64) << 32)
+                       | pars_store.val_pos)
+        codes, inverse = np.unique(entry_codes, return_inverse=True)
+        order = np.argsort(inverse, kind='stable')
+        bounds = np.searchsorted(inverse[order], np.arange(len(codes) + 1))
+
+        self.key_vals = collections.defaultdict(dict)
+        for ii, code in enumerate(codes):
+            key = pars_store.key_names[code >> 40].decode('ascii')
+            val = pars_store.get_value((code >> 32) & 0xff, code & 0xffffffff)
+            idxs = entry_idxs[order[bounds[ii]:bounds[ii + 1]]]
+            # Equal int and float values (e.g. 1 and 1.0) share a dict key
+            if val in self.key_vals[key]:
+                idxs = np.union1d(self.key_vals[key][val], idxs)
+            self.key_vals[key][val] = idxs
+        self.key_vals = dict(self.key_vals)
+        self.all_idxs = np.arange(len(pars_store), dtype=np.uint16)
+
+        if row_index is None:
+            row_index = RowIndex.from_codes(idx_cmds['idx'])
+        super(ParsIndex, self).__init__(row_index.rows, row_index.offsets)
+
+    def get_idxs(self, key, val, op='exact'):
+        """
+        Get parameter ``idx`` codes for commands where parameter ``key`` matches
+        ``val`` for the filter operator ``op`` (see ``FILTER_OPS``).
+
+        As for a dict ``pars.get(key) == val`` test, ``val=None`` matches the
+        codes that do not have ``key`` at all, and ``op='ne'`` matches every
+        code that does not match ``op='exact'``.
+
+        :param key: parameter name (lower case)
+        :param val: parameter value
+        :param op: filter operator (default='exact')
+        :returns: sorted array of idx codes
+        """
+        vals = self.key_vals.get(key, {})
+        empty = np.zeros(0, dtype=np.uint16)
+
+        if op == 'exact':
+            if val is None:
+                has_key = np.concatenate([empty] + list(vals.values()))
+                return np.setdiff1d(self.all_idxs, has_key)
+            try:
+                return vals.get(val, empty)
+            except TypeError:
+                # Unhashable value (e.g. a list) cannot match any parameter value
+                return empty
+
+        elif op == 'ne':
+            return np.setdiff1d(self.all_idxs, self.get_idxs(key, val))
+
+        elif op == 'in':
+            return np.unique(np.concatenate(
+                [empty] + [self.get_idxs(key, item) for item in val]))
+
+        # Other operators: test each distinct value of the parameter
+        matches = [empty]
+        for par_val, idxs in vals.items():
+            try:
+                if op == 'startswith':
+                    match = isinstance(par_val, str) and par_val.startswith(val)
+                else:
+                    match = FILTER_OPS[op](par_val, val)
+            except TypeError:
+                match = False
+            if match:
+                matches.append(idxs)
+        return np.unique(np.concatenate(matches))
+
+
+class CmdsCache(object):
+    """
+    Bounded least-recently-used cache of commands query results.
+
+    Results are keyed by the normalized query, namely the range of archive
+    rows from ``start`` / ``stop`` plus the sorted filter arguments, so
+    different date formats for the same interval share an entry.  The cache
+    is bounded by both the number of entries and the total bytes of cached
+    result data, and is cleared automatically when the version of the loaded
+    commands archive changes.
+
+    Cached tables are made read-only and each lookup returns a new table that
+    views the cached data, so callers cannot corrupt the cache.
+
+    The cache is disabled if ``max_entries`` is 0.  The module global
+    ``CMDS_CACHE`` is used by ``get_cmds`` and is disabled by default.  To
+    enable it::
+
+      >>> from kadi import commands
+      >>> commands.CMDS_CACHE.max_entries = 128
+      >>> commands.CMDS_CACHE.info()
+
+    :param max_entries: maximum number of cached results (default=0)
+    :param max_bytes: maximum total bytes of cached results (default=200 Mb)
+    """
+    def __init__(self, max_entries=0, max_bytes=200e6):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.n_bytes = 0
+        self.version = None
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(i0, i1, kwargs):
+        """
+        Make cache key for archive rows ``i0:i1`` and filters ``kwargs``.
+
+        :returns: hashable key or None if the query cannot be cached
+        """
+        filters = []
+        for key, val in kwargs.items():
+            key, op = _parse_filter_key(key)
+            val = _upper(val)
+            if isinstance(val, list):
+                val = tuple(val)
+            filters.append((key, op, type(val).__name__, val))
+        key = (i0, i1, tuple(sorted(filters, key=repr)))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def get(self, key, version):
+        """
+        Get cached result for ``key`` for archive ``version``.
+
+        :returns: Table (view of cached result) or None
+        """
+        if self.max_entries <= 0 or key is None:
+            return None
+
+        with self._lock:
+            if version != self.version:
+                self._clear()
+                self.version = version
+            try:
+                cmds, _ = self._cache[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._cache.move_to_end(key)
+            self.hits += 1
+        return cmds[:]
+
+    def set(self, key, version, cmds, n_bytes):
+        """
+        Cache result ``cmds`` for ``key`` and archive ``version``.
+
+        :param n_bytes: memory used by ``cmds`` (0 for a view of the archive)
+        """
+        if self.max_entries <= 0 or key is None or n_bytes > self.max_bytes:
+            return
+
+        for col in cmds.itercols():
+            col.flags.writeable = False
+
+        with self._lock:
+            if version != self.version:
+                self._clear()
+                self.version = version
+            if key in self._cache:
+                self.n_bytes -= self._cache[key][1]
+            self._cache[key] = (cmds, n_bytes)
+            self.n_bytes += n_bytes
+            while (len(self._cache) > self.max_entries
+                   or self.n_bytes > self.max_bytes):
+                _, (_, old_n_bytes) = self._cache.popitem(last=False)
+                self.n_bytes -= old_n_bytes
+
+    def clear(self):
+        """Clear the cache and the hit / miss counters"""
+        with self._lock:
+            self._clear()
+            self.hits = 0
+            self.misses = 0
+
+    def _clear(self):
+        self._cache.clear()
+        self.n_bytes = 0
+
+    def info(self):
+        """
+        Get cache statistics.
+
+        :returns: dict with hits, misses, n_entries, n_bytes
+        """
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'n_entries': len(self._cache),
+                'n_bytes': self.n_bytes}
+
+
+class CommandsArchive(object):
+    """
+    One generation of the loaded commands archive.
+
+    This bundles the commands table and the parameters store that were loaded
+    together from the archive files, along with the parameters index which is
+    built on first use.  An archive is not modified after loading, so a query
+    that holds a reference to it sees a consistent archive even if a newer
+    generation gets loaded meanwhile.
+
+    The ``type`` / ``tlmsid`` column indexes and the row index of the parameters
+    index are taken from ``indexes`` if given, else loaded from the archive
+    files if ``update_cmds`` has written them there, and otherwise built from
+    the commands table.
+
+    If ``compact`` is True then the commands table is held in the compact
+    encoding of :class:`~kadi.commands.compact.CompactCmds`, which uses less
+    than half the memory and matches ``type`` and ``tlmsid`` filters as integer
+    compares.  Query results are the same either way.
+
+    :param generation: generation number of this archive
+    :param idx_cmds: commands table (default=load from archive files)
+    :param pars_store: parameters store (default=load from archive files)
+    :param compact: use compact encoding of the commands table (default=False)
+    :param indexes: dict of column name => RowIndex (``idx``) or ColumnIndex
+        for ``idx_cmds`` (optional, e.g. from shared memory)
+    """
+    def __init__(self, generation=1, idx_cmds=None, pars_store=None, compact=False,
+                 indexes=None):
+        self.generation = generation
+        self.compact = compact
+        self.from_files = idx_cmds is None
+        self.idx_cmds = load_idx_cmds() if idx_cmds is None else idx_cmds
+        if compact:
+            from .compact import CompactCmds
+            self.idx_cmds = CompactCmds.from_table(self.idx_cmds)
+        self.version = self.idx_cmds.meta.get('version')
+        self.pars_store = load_pars_store() if pars_store is None else pars_store
+        self._pars_index = None
+        self._pars_dict = None
+        self._column_indexes = {}
+        self._indexes = indexes or {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return (f'<{self.__class__.__name__} generation={self.generation} '
+                f'n_cmds={len(self.idx_cmds)}>')
+
+    @property
+    def pars_index(self):
+        """Parameters index :class:`~kadi.commands.commands.ParsIndex`"""
+        if self._pars_index is None:
+            with self._lock:
+                if self._pars_index is None:
+                    self._pars_index = ParsIndex(self.idx_cmds, self.pars_store,
+                                                 self._load_index('idx'))
+        return self._pars_index
+
+    @property
+    def pars_dict(self):
+        """Parameters dict that maps parameters tuple => idx code"""
+        if self._pars_dict is None:
+            with self._lock:
+                if self._pars_dict is None:
+                    self._pars_dict = self.pars_store.to_pars_dict()
+        return self._pars_dict
+
+    def get_column_index(self, name):
+        """
+        Get the value index of archive column ``name`` (one of ``INDEX_COLS``).
+
+        :param name: column name
+        :returns: :class:`~kadi.commands.commands.ColumnIndex`
+        """
+        if name not in self._column_indexes:
+            with self._lock:
+                if name not in self._column_indexes:
+                    if self.compact:
+                        # Compact columns are already encoded as codes into the values
+                        index = ColumnIndex.from_codes(self.idx_cmds.values[name],
+                                                       self.idx_cmds.cols[name])
+                    else:
+                        index = self._load_index(name)
+                        if index is None:
+                            index = ColumnIndex.from_column(self.idx_cmds[name])
+                    self._column_indexes[name] = index
+        return self._column_indexes[name]
+
+    def _load_index(self, name):
+        """
+        Get the index of column ``name`` that was given to the archive, or load
+        the persisted index from the archive files.
+
+        :returns: RowIndex, ColumnIndex or None if not available or if it does
+            not match this archive
+        """
+        if name in self._indexes:
+            return self._indexes[name]
+        if not self.from_files:
+            return None
+        index = load_index(name)
+        if (index is None or index.n_rows != len(self.idx_cmds)
+                or get_archive_version() != self.version):
+            return None
+        return index
+
+    def get_row_range(self, start=None, stop=None, date=None):
+        """
+        Get the range of archive rows ``i0:i1`` with ``start`` <= time < ``stop``,
+        or with the exact ``date`` if that is given.
+
+        The archive is sorted by date, so this is a binary search.
+
+        :param start: DateTime format (optional)
+        :param stop: DateTime format (optional)
+        :param date: DateTime format (optional)
+        :returns: i0, i1
+        """
+        if date:
+            if self.compact:
+                return self.idx_cmds.date_range(date)
+            date = DateTime(date).date.encode('ascii')  # clip resolution to nearest msec
+            dates = self.idx_cmds['date']
+            return (np.searchsorted(dates, date, side='left'),
+                    np.searchsorted(dates, date, side='right'))
+
+        i0 = self.date_index(start) if start else 0
+        i1 = max(i0, self.date_index(stop) if stop else len(self.idx_cmds))
+        return i0, i1
+
+    def filter_rows(self, i0, i1, plan=None, **kwargs):
+        """
+        Get archive rows ``i0:i1`` that match the ``key=val`` filters in ``kwargs``.
+
+        Slicing the archive table gives views of the archive columns, and the
+        filters are applied only within the slice.
+
+        The filters are evaluated in order of increasing estimated number of
+        matching rows, as a set of matching row positions that is narrowed down
+        by each filter in turn:
+
+        - Range filters on the sorted ``date`` and ``time`` columns narrow
+          ``i0:i1`` by binary search.
+        - Filters on the ``INDEX_COLS`` columns and on command parameters are
+          estimated exactly from the index posting lists within ``i0:i1``.
+          If a filter matches many codes (see ``INDEX_ROWS_PER_CODE``), e.g.
+          ``__ne`` or a range of parameter values, looking up each code would
+          cost more than a scan, so it is estimated from the total counts of
+          the codes and evaluated like an unindexed filter.
+        - Filters on other columns need a scan and come last.
+
+        The first filter gives the initial rows, from the index or a scan of
+        ``i0:i1``.  A parameter filter is scanned as a lookup of the parameter
+        ``idx`` codes of the rows.  Each subsequent indexed filter is
+        intersected with the index rows if that is smaller than the current
+        rows, otherwise it is matched only for the current rows.  Evaluation
+        stops if no rows are left.
+
+        :param i0: first row
+        :param i1: row after last row
+        :param plan: list to which the query plan steps are appended (optional)
+        :param kwargs: key=val keyword argument pairs
+        :returns: astropy Table of commands (a view into the archive if no filters)
+        """
+        filters = []
+        for key, val in kwargs.items():
+            key, op = _parse_filter_key(key)
+            val = _upper(val)
+            t0 = time.perf_counter()
+            range_i0_i1 = self._get_filter_range(key, op, val, i0, i1)
+            if range_i0_i1 is None:
+                filters.append((key, op, val))
+            else:
+                i0, i1 = range_i0_i1
+                _add_plan_step(plan, f'{key}__{op}', 'range', i1 - i0, i1 - i0, t0)
+
+        if not filters:
+            return self.idx_cmds[i0:i1]
+
+        # Estimate the number of rows matching each filter
+        steps = []
+        for key, op, val in filters:
+            t0 = time.perf_counter()
+            if key in INDEX_COLS and key in self.idx_cmds.colnames:
+                index = self.get_column_index(key)
+                codes = index.get_codes(val, op)
+            elif key in self.idx_cmds.colnames:
+                index = codes = None
+            else:
+                index = self.pars_index
+                codes = index.get_idxs(key, val, op)
+
+            use_index = (index is not None
+                         and len(codes) * INDEX_ROWS_PER_CODE <= i1 - i0)
+            if use_index:
+                n_est = index.count_rows(codes, i0, i1)
+            elif index is not None:
+                n_est = index.count_all_rows(codes) * (i1 - i0) // max(index.n_rows, 1)
+            else:
+                n_est = i1 - i0
+            steps.append((n_est, key, op, val, index if use_index else None, codes,
+                          time.perf_counter() - t0))
+
+        rows = None
+        for n_est, key, op, val, index, codes, t_est in sorted(steps, key=lambda step: step[0]):
+            # Step time includes estimating the filter
+            t0 = time.perf_counter() - t_est
+            if index is not None and (rows is None or n_est < len(rows)):
+                index_rows = np.sort(index.get_rows(codes, i0, i1))
+                rows = (index_rows if rows is None
+                        else np.intersect1d(rows, index_rows, assume_unique=True))
+                method = 'index'
+            elif rows is None:
+                rows = np.flatnonzero(self._match_filter(key, op, val, codes,
+                                                         slice(i0, i1))) + i0
+                method = 'scan'
+            else:
+                rows = rows[self._match_filter(key, op, val, codes, rows)]
+                method = 'filter'
+            _add_plan_step(plan, f'{key}__{op}', method, n_est, len(rows), t0)
+            if len(rows) == 0:
+                break
+
+        if self.compact:
+            # Decode only the selected rows
+            ok = np.zeros(i1 - i0, dtype=bool)
+            ok[rows - i0] = True
+            return self.idx_cmds.get_rows(i0, i1, ok)
+        return self.idx_cmds[rows]
+
+    def _get_filter_range(self, key, op, val, i0, i1):
+        """
+        Narrow archive rows ``i0:i1`` by binary search for a range filter on one
+        of the sorted ``RANGE_COLS`` columns.
+
+        :returns: i0, i1 or None if the filter is not a range filter
+        """
+        if (key not in RANGE_COLS or op not in ('gt', 'gte', 'lt', 'lte')
+                or self.compact or key not in self.idx_cmds.colnames):
+            return None
+        if key == 'date' and isinstance(val, str):
+            val = val.encode('ascii')
+        elif not (key == 'time' and isinstance(val, (int, float, np.number))
+                  and not isinstance(val, bool)):
+            return None
+
+        side = 'right' if op in ('gt', 'lte') else 'left'
+        idx = np.searchsorted(self.idx_cmds[key], val, side=side)
+        if op in ('gt', 'gte'):
+            i0 = max(i0, idx)
+        else:
+            i1 = min(i1, idx)
+        return i0, max(i0, i1)
+
+    def _get_col(self, name, rows):
+        """Values of archive column ``name`` for ``rows`` (slice or row positions)"""
+        if self.compact:
+            return self.idx_cmds.take(name, rows)
+        return self.idx_cmds[name][rows]
+
+    def _match_filter(self, key, op, val, codes, rows):
+        """
+        Match filter ``key``, ``op``, ``val`` for ``rows`` (slice or row
+        positions), where ``codes`` are the matching parameter ``idx`` codes
+        for a parameter filter.
+
+        :returns: bool array
+        """
+        if key in self.idx_cmds.colnames:
+            return self._match_rows(key, op, val, rows)
+        lookup = np.zeros(2 ** 16, dtype=bool)
+        lookup[codes] = True
+        return lookup[np.asarray(self._get_col('idx', rows))]
+
+    def _match_rows(self, key, op, val, rows):
+        """
+        Match archive column ``key`` against ``val`` for filter operator ``op``
+        for ``rows`` (slice or row positions).
+
+        :returns: bool array
+        """
+        if self.compact:
+            return self.idx_cmds.match(key, op, val, rows, _match_column)
+        return _match_column(self._get_col(key, rows), op, val)
+
+    def date_index(self, date):
+        """
+        Index of the first archive command with time >= ``date``.
+
+        :param date: DateTime format
+        :returns: int
+        """
+        if self.compact:
+            return self.idx_cmds.date_index(DateTime(date).secs)
+        return np.searchsorted(self.idx_cmds['time'], DateTime(date).secs, side='left')
+
+
+class ArchiveHandle(object):
+    """
+    Generation-aware handle to the commands archive.
+
+    The ``get()`` method returns the current
+    :class:`~kadi.commands.commands.CommandsArchive`, loading it on first use.
+    Each load of the archive files is a new generation.
+
+    For long-running processes, set ``check_interval`` to have ``get()`` check
+    the archive version stamp (see ``get_archive_version()``) at most every
+    ``check_interval`` seconds.  When the archive files have changed a new
+    generation is loaded in a background thread and swapped in only once it
+    is fully loaded.  Until then ``get()`` returns the previous generation,
+    and queries that are in progress keep using the generation they started
+    with.  Automatic checks are disabled by default, but the default
+    ``check_interval`` for the module global ``ARCHIVE`` can be set with the
+    ``KADI_CMDS_RELOAD_INTERVAL`` environment variable.  Example::
+
+      >>> from kadi import commands
+      >>> commands.ARCHIVE.check_interval = 60
+      >>> commands.ARCHIVE.generation
+      1
+      >>> commands.ARCHIVE.reload()  # Force reload now
+      2
+
+    Loading the archive on first use is thread-safe, and ``prefetch()`` starts
+    loading it in a background thread ahead of the first query (by default at
+    import if the ``KADI_CMDS_PREFETCH`` environment variable is set).
+
+    To share one copy of the archive between worker processes, one process can
+    ``publish()`` the archive to POSIX shared memory and the workers then
+    ``attach()`` to it (see :class:`~kadi.commands.shared_archive.SharedArchive`).
+    If ``shm_name`` is set (by default from the ``KADI_CMDS_SHM`` environment
+    variable) then the archive is loaded from that shared memory and there are
+    no automatic checks for archive updates.
+
+    If ``compact`` is True (by default if the ``KADI_CMDS_COMPACT`` environment
+    variable is set) then each generation loaded from the archive files uses
+    the compact encoding of the commands table (see
+    :class:`~kadi.commands.commands.CommandsArchive`).
+
+    :param check_interval: seconds between checks for archive updates (default=None)
+    :param shm_name: name of shared memory archive to attach (default=None)
+    :param compact: use compact encoding of the commands table (default=False)
+    """
+    def __init__(self, check_interval=None, shm_name=None, compact=False):
+        self.check_interval = check_interval
+        self.shm_name = shm_name
+        self.compact = compact
+        self._archive = None
+        self._generation = 0
+        self._last_check = 0.0
+        self._thread = None
+        self._lock = threading.Lock()
+        self._thread_lock = threading.Lock()
+
+    @property
+    def generation(self):
+        """Generation number of the current archive (0 if not loaded)"""
+        archive = self._archive
+        return 0 if archive is None else archive.generation
+
+    @property
+    def version(self):
+        """Version stamp of the current archive (None if not loaded)"""
+        archive = self._archive
+        return None if archive is None else archive.version
+
+    def get(self):
+        """
+        Get the current generation of the commands archive.
+
+        :returns: :class:`~kadi.commands.commands.CommandsArchive`
+        """
+        archive = self._archive
+        if archive is None:
+            with self._lock:
+                if self._archive is None:
+                    self._load()
+                archive = self._archive
+
+        elif self.check_interval is not None and self.shm_name is None:
+            now = time.time()
+            if now - self._last_check >= self.check_interval:
+                self._last_check = now
+                if get_archive_version() != archive.version:
+                    self.reload(wait=False)
+
+        return archive
+
+    def reload(self, wait=True):
+        """
+        Load a new generation of the commands archive.
+
+        :param wait: wait for the load to finish (default=True), otherwise load
+            in a background thread if one is not already running
+        :returns: new generation number or None if not waiting
+        """
+        if wait:
+            with self._lock:
+                self._load()
+            return self.generation
+
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._reload_background,
+                                                name='kadi-cmds-reload', daemon=True)
+                self._thread.start()
+
+    def prefetch(self, indexes=True):
+        """
+        Start loading the archive in a background thread, so that it is ready
+        for the first query.
+
+        A query that comes while the archive is loading waits for that load to
+        finish instead of loading the archive again.
+
+        :param indexes: also build (or load) the parameters and column indexes
+            (default=True)
+        :returns: threading.Thread that is loading the archive
+        """
+        thread = threading.Thread(target=self._prefetch, args=(indexes,),
+                                  name='kadi-cmds-prefetch', daemon=True)
+        thread.start()
+        return thread
+
+    def _prefetch(self, indexes):
+        try:
+            archive = self.get()
+            if indexes:
+                archive.pars_index
+                for name in INDEX_COLS:
+                    archive.get_column_index(name)
+        except Exception as err:
+            # Leave it to the first query to load the archive and raise the error
+            warnings.warn(f'failed to prefetch commands archive: {err}')
+
+    def publish(self, name=None):
+        """
+        Publish the current archive to POSIX shared memory for other processes
+        to ``attach()``.
+
+        The returned object must be kept by the caller while the shared memory
+        is in use and then freed with its ``unlink()`` method.
+
+        :param name: shared memory name (default=random name)
+        :returns: :class:`~kadi.commands.shared_archive.SharedArchive`
+        """
+        from .shared_archive import SharedArchive
+        return SharedArchive.publish(self.get(), name)
+
+    def attach(self, name):
+        """
+        Use the archive published to shared memory ``name`` by another process.
+
+        :param name: shared memory name
+        :returns: new generation number
+        """
+        self.shm_name = name
+        return self.reload()
+
+    def reset(self):
+        """Unload the archive so that the next ``get()`` loads it (e.g. after changing $KADI)"""
+        with self._lock:
+            self._archive = None
+
+    def _load(self):
+        """Load a new generation and swap it in.  Must be called with ``_lock`` held."""
+        old_archive = self._archive
+        if self.shm_name is not None:
+            from .shared_archive import SharedArchive
+            archive = SharedArchive.attach(self.shm_name).get_archive(self._generation + 1)
+        else:
+            archive = CommandsArchive(self._generation + 1, compact=self.compact)
+        if old_archive is not None:
+            # Indexes of the current generation are in use, so build the new
+            # ones before swapping in the new generation.
+            if old_archive._pars_index is not None:
+                archive.pars_index
+            for name in list(old_archive._column_indexes):
+                archive.get_column_index(name)
+        self._archive = archive
+        self._generation = archive.generation
+
+    def _reload_background(self):
+        try:
+            with self._lock:
+                self._load()
+        except Exception as err:
+            # Most likely the archive files are being updated.  Keep the current
+            # generation and try again at the next check.
+            warnings.warn(f'failed to reload commands archive: {err}')
+            return
+
+        if get_archive_version() != self.version:
+            # Files changed while loading so check again at the next get()
+            self._last_check = 0.0
+
+
+class ArchiveVal(LazyVal):
+    """
+    Proxy for the ``name`` attribute (e.g. ``idx_cmds``) of the current
+    generation of the commands archive ``ARCHIVE``.
+    """
+    def __init__(self, name):
+        self._name = name
+
+    def __getattribute__(self, name):
+        val = getattr(ARCHIVE.get(), object.__getattribute__(self, '_name'))
+        if name == '_val':
+            return val
+        else:
+            return val.__getattribute__(name)
+
+    def __delattr__(self, name):
+        # Deleting ``_val`` used to make a LazyVal global load the archive again
+        if name == '_val':
+            warnings.warn('deleting _val to reload the commands archive is deprecated, '
+                          'use kadi.commands.ARCHIVE.reload()', DeprecationWarning)
+            ARCHIVE.reset()
+        else:
+            object.__delattr__(self, name)
+
+
+# Handle to the commands archive (shared by kadi.commands and kadi.cmds), with
+# the default interval (secs) for checking for archive updates, shared memory
+# archive name and compact encoding option from the environment.
+ARCHIVE = ArchiveHandle(float(os.environ['KADI_CMDS_RELOAD_INTERVAL'])
+                        if os.environ.get('KADI_CMDS_RELOAD_INTERVAL') else None,
+                        shm_name=os.environ.get('KADI_CMDS_SHM') or None,
+                        compact=bool(os.environ.get('KADI_CMDS_COMPACT')))
+
+# Globals that contain the entire commands table, the parameters store (which
+# maps idx code => parameters tuple) and the parameters index dictionary for
+# the current generation of the archive.
+idx_cmds = ArchiveVal('idx_cmds')
+pars_store = ArchiveVal('pars_store')
+rev_pars_dict = pars_store
+pars_dict = ArchiveVal('pars_dict')
+pars_index = ArchiveVal('pars_index')
+
+# Cache of get_cmds query results (disabled by default)
+CMDS_CACHE = CmdsCache()
+
+
+def prefetch(indexes=True):
+    """
+    Start loading the commands archive in a background thread.
+
+    This is for interactive sessions and web application workers, so that
+    the archive is already loaded (or loading) by the time of the first
+    query.  Setting the ``KADI_CMDS_PREFETCH`` environment variable does this
+    at import of ``kadi.commands``.
+
+    :param indexes: also build (or load) the parameters and column indexes
+        (default=True)
+    :returns: threading.Thread that is loading the archive
+    """
+    return ARCHIVE.prefetch(indexes)
+
+
+def get_cmds(start=None, stop=None, explain=False, **kwargs):
     """
     Get commands with ``start`` <= date < ``stop``.  Additional ``key=val`` pairs
     can be supplied to further filter the results.  Both ``key`` and ``val``
@@ -73,9 +1526,27 @@ def get_cmds(start=None, stop=None, **kwargs):
       Command type e.g. COMMAND_SW, COMMAND_HW, ACISPKT, SIMTRANS
     date
       Exact date of command e.g. '2013:003:22:11:45.530'
+    time
+      Command time in CXC seconds, typically with an operator e.g. ``time__lt=441763266.0``
 
     If ``date`` is provided then ``start`` and ``stop`` values are ignored.
 
+    Similar to Django field lookups, the ``key`` can have a double-underscore
+    suffix that specifies the match operator:
+
+    ================ =============================================
+    Suffix           Match
+    ================ =============================================
+    ``__exact``      Equal (default if no suffix)
+    ``__ne``         Not equal
+    ``__in``         Equal to any item in ``val`` (a list)
+    ``__gt``         Greater than
+    ``__gte``        Greater than or equal
+    ``__lt``         Less than
+    ``__lte``        Less than or equal
+    ``__startswith`` String starts with ``val``
+    ================ =============================================
+
     Examples::
 
       >>> from kadi import commands
@@ -83,28 +1554,114 @@ def get_cmds(start=None, stop=None, **kwargs):
       >>> cmds = commands.get_cmds('2012:001', '2012:030', type='simtrans')
       >>> cmds = commands.get_cmds(type='acispkt', tlmsid='wsvidalldn')
       >>> cmds = commands.get_cmds(msid='aflcrset')
+      >>> cmds = commands.get_cmds('2012:001', '2012:030', tlmsid__startswith='wspow')
+      >>> cmds = commands.get_cmds('2012:001', '2012:030',
+      ...                          tlmsid__in=['aonmmode', 'aonpmode'])
+      >>> cmds = commands.get_cmds('2012:001', '2012:030', type='simtrans', pos__lt=0)
       >>> print(cmds)
 
+    The filters are evaluated most selective first using the archive indexes.
+    With ``explain=True`` the query plan is reported in ``cmds.meta['query_plan']``
+    as a list of steps, each a dict giving the ``filter``, the evaluation
+    ``method`` (``range``, ``index``, ``scan`` or ``filter``), the estimated
+    number of matching rows ``n_est``, the number of rows left ``n_rows``, and
+    the step time ``secs``::
+
+      >>> cmds = commands.get_cmds(tlmsid='aomanuvr', explain=True)
+      >>> Table(cmds.meta['query_plan'])
+
     :param start: DateTime format (optional)
         Start time, defaults to beginning of available commands (2002:001)
     :param stop: DateTime format (optional)
         Stop time, defaults to end of available commands
+    :param explain: report the query plan in the output ``meta`` (default=False)
     :param kwargs: key=val keyword argument pairs
 
     :returns: :class:`~kadi.commands.commands.CommandTable` of commands
     """
-    cmds = _find(start, stop, **kwargs)
-    out = CommandTable(cmds)
-    out['params'] = None if len(out) > 0 else Column([], dtype=object)
+    cmds = _find(start, stop, explain=explain, **kwargs)
+    out = _as_command_table(cmds)
 
     return out
 
 
+def iter_cmds(start=None, stop=None, chunk=100000, chunk_days=None, **kwargs):
+    """
+    Iterate over commands with ``start`` <= date < ``stop`` in chunks.
+
+    This yields a :class:`~kadi.commands.commands.CommandTable` for each chunk
+    of the commands archive, with the same ``key=val`` filtering as
+    :func:`~kadi.commands.commands.get_cmds`.  Chunks are either ``chunk``
+    archive rows or, if ``chunk_days`` is given, that many days of commands.
+    This allows processing mission-long spans of commands with flat memory
+    use.  Chunks with no commands after filtering are skipped.
+
+    Without filters each chunk is a view into the archive, so do not modify
+    the chunk values in place.
+
+    Examples::
+
+      >>> from kadi import commands
+      >>> n_manvr = 0
+      >>> for cmds in commands.iter_cmds(tlmsid='aomanuvr'):
+      ...     n_manvr += len(cmds)
+      >>> for cmds in commands.iter_cmds('2012:001', '2013:001', chunk_days=30):
+      ...     print(cmds['date'][0], len(cmds))
+
+    :param start: DateTime format (optional)
+        Start time, defaults to beginning of available commands (2002:001)
+    :param stop: DateTime format (optional)
+        Stop time, defaults to end of available commands
+    :param chunk: number of archive rows per chunk (default=100000)
+    :param chunk_days: days per chunk (optional, overrides ``chunk``)
+    :param kwargs: key=val keyword argument pairs
+
+    :returns: generator of :class:`~kadi.commands.commands.CommandTable`
+    """
+    archive = ARCHIVE.get()
+    i0, i1 = archive.get_row_range(start, stop, kwargs.pop('date', None))
+
+    if chunk_days is None:
+        bounds = list(range(i0, i1, chunk)) + [i1]
+    else:
+        bounds = [i0]
+        if i0 < i1:
+            secs0 = DateTime(start if start else archive.idx_cmds[i0:i0 + 1]['date'][0]).secs
+        while bounds[-1] < i1:
+            secs0 += chunk_days * 86400
+            bounds.append(min(i1, max(bounds[-1], archive.date_index(secs0))))
+
+    for row0, row1 in zip(bounds[:-1], bounds[1:]):
+        cmds = archive.filter_rows(row0, row1, **kwargs)
+        if len(cmds) > 0:
+            yield _as_command_table(cmds, copy=False)
+
+
+def _as_command_table(cmds, copy=True):
+    """
+    Make a CommandTable from archive commands ``cmds``, with an initially empty
+    ``params`` column.
+
+    :param cmds: Table of archive commands
+    :param copy: copy the archive columns (default=True)
+    :returns: :class:`~kadi.commands.commands.CommandTable`
+    """
+    out = CommandTable(cmds, copy=copy)
+    out['params'] = None if len(out) > 0 else Column([], dtype=object)
+    return out
+
+
 def get_cmds_from_backstop(backstop, remove_starcat=True):
     """
     Initialize a ``CommandTable`` from ``backstop``, which can either
     be a string file name or a backstop table from ``parse_cm.read_backstop``.
 
+    A backstop file is read with :func:`~kadi.commands.backstop.read_backstop`,
+    which caches the parsed file in ``~/.kadi/backstop_cache`` (or the directory
+    ``$KADI_BACKSTOP_CACHE``).  The total size of the cache is limited to 1000 Mb
+    by default, or ``$KADI_BACKSTOP_CACHE_MAX_MB`` Mb if set, by removing the
+    least recently used files.
+
     :param backstop: str or Table
     :param remove_starcat: remove star catalog commands (default=True)
     :returns: :class:`~kadi.commands.commands.CommandTable` of commands
@@ -113,7 +1670,6 @@ def get_cmds_from_backstop(backstop, remove_starcat=True):
         backstop = str(backstop)
 
     if isinstance(backstop, str):
-        from parse_cm import read_backstop
         bs = read_backstop(backstop)
     elif isinstance(backstop, Table):
         bs = backstop
@@ -129,9 +1685,11 @@ def get_cmds_from_backstop(backstop, remove_starcat=True):
     out = {}
     # Set idx to max (2**16 -1) so it does not match any real idx
     out['idx'] = np.full(n_bs, fill_value=65535, dtype=np.uint16)
-    out['date'] = np.chararray.encode(bs['date'])
-    out['type'] = np.chararray.encode(bs['type'])
-    out['tlmsid'] = np.chararray.encode(bs['tlmsid'])
+    # Use the string column widths of the commands archive
+    out['date'] = np.char.encode(bs['date']).astype('S21')
+    out['time'] = DateTime(bs['date']).secs
+    out['type'] = np.char.encode(bs['type']).astype('S12')
+    out['tlmsid'] = np.char.encode(bs['tlmsid']).astype('S10')
     out['scs'] = bs['scs'].astype(np.uint8)
     out['step'] = bs['step'].astype(np.uint16)
     # Set timeline_id to 0, does not match any real timeline id
@@ -153,7 +1711,7 @@ def get_cmds_from_backstop(backstop, remove_starcat=True):
     return CommandTable(out)
 
 
-def _find(start=None, stop=None, **kwargs):
+def _find(start=None, stop=None, explain=False, **kwargs):
     """
     Get commands ``start`` <= date < ``stop``.  Additional ``key=val`` pairs
     can be supplied to further filter the results.  Both ``key`` and ``val``
@@ -175,37 +1733,110 @@ def _find(start=None, stop=None, **kwargs):
         Start time, defaults to beginning of available commands (2002:001)
     :param stop: DateTime format (optional)
         Stop time, defaults to end of available commands
+    :param explain: report the query plan in ``meta['query_plan']`` (default=False)
     :param kwargs: key=val keyword argument pairs
 
-    :returns: astropy Table of commands
+    :returns: astropy Table of commands (a view into the archive if only
+        ``start`` and ``stop`` are given)
+    """
+    # Use one generation of the archive throughout even if it gets reloaded
+    archive = ARCHIVE.get()
+    t0 = time.perf_counter()
+    i0, i1 = archive.get_row_range(start, stop, kwargs.pop('date', None))
+
+    if explain:
+        # Always run the query (not cached) to get the plan
+        plan = []
+        _add_plan_step(plan, 'start/stop', 'range', i1 - i0, i1 - i0, t0)
+        cmds = archive.filter_rows(i0, i1, plan=plan, **kwargs)
+        cmds.meta = dict(cmds.meta, query_plan=plan)
+        return cmds
+
+    # The generation number alone can repeat if ARCHIVE is replaced (e.g. a new
+    # handle or attach()), so also identify the archive object and its files.
+    version = (id(archive), archive.generation, archive.version)
+    key = CMDS_CACHE.make_key(i0, i1, kwargs) if CMDS_CACHE.max_entries > 0 else None
+    cmds = CMDS_CACHE.get(key, version)
+    if cmds is None:
+        cmds = archive.filter_rows(i0, i1, **kwargs)
+        # Without filters the result is a view of the archive and uses no memory,
+        # unless the archive is compact and the result is decoded.
+        n_bytes = (sum(col.nbytes for col in cmds.itercols())
+                   if kwargs or archive.compact else 0)
+        CMDS_CACHE.set(key, version, cmds, n_bytes)
+    return cmds
+
+
+def _add_plan_step(plan, name, method, n_est, n_rows, t0):
+    """
+    Append a query plan step to ``plan`` (if not None) for filter ``name``.
+
+    :param method: 'range', 'index', 'scan' or 'filter'
+    :param n_est: estimated number of rows matching the filter
+    :param n_rows: number of rows left after the step
+    :param t0: ``time.perf_counter()`` at the start of the step
     """
-    date = kwargs.pop('date', None)
-    if date:
-        start = DateTime(date).date  # clip resolution to nearest msec
-        stop = DateTime(start) + 0.001 / 86400  # exactly 1 msec later
+    if plan is not None:
+        plan.append({'filter': name,
+                     'method': method,
+                     'n_est': int(n_est),
+                     'n_rows': int(n_rows),
+                     'secs': time.perf_counter() - t0})
 
-    ok = np.ones(len(idx_cmds), dtype=bool)
-    par_ok = np.zeros(len(idx_cmds), dtype=bool)
 
-    if start:
-        ok &= idx_cmds['date'] >= DateTime(start).date
-    if stop:
-        ok &= idx_cmds['date'] < DateTime(stop).date
-    for key, val in kwargs.items():
-        key = key.lower()
+def _parse_filter_key(key):
+    """
+    Split filter ``key`` like ``tlmsid__startswith`` into lower-case key and
+    operator (``exact`` if no operator is given).
+
+    :param key: filter key
+    :returns: key, op
+    """
+    key = key.lower()
+    if '__' not in key:
+        return key, 'exact'
+
+    key, op = key.rsplit('__', 1)
+    if op not in FILTER_OPS:
+        raise ValueError(f'unknown filter operator {op!r}, must be one of '
+                         f'{", ".join(FILTER_OPS)}')
+    return key, op
+
+
+def _upper(val):
+    """Upper-case filter value ``val`` if it is a str or a list of str."""
+    if isinstance(val, str):
+        return val.upper()
+    elif isinstance(val, (list, tuple, set, np.ndarray)):
+        return [_upper(item) for item in val]
+    return val
+
+
+def _match_column(col, op, val):
+    """
+    Vectorized match of archive column ``col`` against ``val`` for filter
+    operator ``op``.
+
+    :param col: Column or array
+    :param op: filter operator (see ``FILTER_OPS``)
+    :param val: filter value
+    :returns: bool array
+    """
+    col = np.asarray(col)
+    if col.dtype.kind == 'S':
+        # Archive string columns are bytes
         if isinstance(val, str):
-            val = val.upper()
-        if key in idx_cmds.dtype.names:
-            ok &= idx_cmds[key] == val
-        else:
-            par_ok[:] = False
-            for pars_tuple, idx in pars_dict.items():
-                pars = dict(pars_tuple)
-                if pars.get(key) == val:
-                    par_ok |= (idx_cmds['idx'] == idx)
-            ok &= par_ok
-    cmds = idx_cmds[ok]
-    return cmds
+            val = val.encode('ascii')
+        elif isinstance(val, list):
+            val = [item.encode('ascii') if isinstance(item, str) else item
+                   for item in val]
+
+    if op == 'in':
+        return np.isin(col, val)
+    elif op == 'startswith':
+        return np.char.startswith(col, val)
+    else:
+        return FILTER_OPS[op](col, val)
 
 
 class CommandRow(Row):
@@ -241,6 +1872,8 @@ class CommandRow(Row):
         keys = self.keys()
         keys.remove('date')
         keys.remove('type')
+        if 'time' in keys:
+            keys.remove('time')
         if 'idx' in keys:
             keys.remove('idx')
 
@@ -264,7 +1897,7 @@ class CommandTable(Table):
             if item in self.colnames:
                 return self.columns[item]
             else:
-                return Column([cmd['params'].get(item) for cmd in self], name=item)
+                return self._get_param_column(item)
 
         elif isinstance(item, int):
             return CommandRow(self, item)
@@ -292,23 +1925,113 @@ class CommandTable(Table):
             raise ValueError('Illegal type {0} for table item access'
                              .format(type(item)))
 
+    def _get_param_column(self, key):
+        """
+        Get column of parameter ``key`` values, with ``None`` where a command
+        does not have the parameter.
+
+        :param key: parameter name
+        :returns: Column
+        """
+        values, ok = self._get_param_values(key)
+        if np.all(ok):
+            if values.dtype.kind == 'O':
+                # All commands have the parameter but some are not from the
+                # archive, so let Column infer the common type.
+                values = values.tolist()
+            return Column(values, name=key)
+
+        out = np.full(len(self), None, dtype=object)
+        out[ok] = values[ok]
+        return Column(out, name=key)
+
+    def _get_param_values(self, key):
+        """
+        Get the values of parameter ``key`` for every command.
+
+        For archive commands this maps the ``idx`` column through the
+        per-parameter values array of the parameters store.  Only commands
+        not from the archive (e.g. from backstop, with idx=65535) get the value
+        from the ``params`` dict.
+
+        :param key: parameter name
+        :returns: values array, bool array of commands that have ``key``
+        """
+        if 'idx' in self.colnames:
+            idxs = np.asarray(self['idx'])
+            values, has_key = pars_store.get_key_values(key)
+            in_store = idxs < len(values)
+            if np.all(in_store):
+                return values[idxs], has_key[idxs]
+        else:
+            in_store = np.zeros(len(self), dtype=bool)
+
+        out = np.full(len(self), None, dtype=object)
+        ok = in_store.copy()
+        if np.any(in_store):
+            ok[in_store] = has_key[idxs[in_store]]
+            out[ok] = values[idxs[ok]]
+        for ii in np.flatnonzero(~in_store):
+            out[ii] = self._get_row_params(ii).get(key)
+            ok[ii] = out[ii] is not None
+        return out, ok
+
+    def _get_row_params(self, row):
+        """Params dict for command in ``row``"""
+        params = self.columns['params'][row]
+        return self[int(row)]['params'] if params is None else params
+
+    def _get_param_keys(self):
+        """Sorted names of all the parameters of the commands"""
+        keys = set()
+        if 'idx' in self.colnames:
+            idxs = np.asarray(self['idx'])
+            in_store = idxs < len(pars_store)
+            keys.update(pars_store.get_keys(idxs[in_store]))
+            rows = np.flatnonzero(~in_store)
+        else:
+            rows = range(len(self))
+        for row in rows:
+            keys.update(self._get_row_params(row))
+        return sorted(keys)
+
+    def params_table(self, keys=None):
+        """
+        Get table of command parameters with one column per parameter.
+
+        The parameters of all the commands are resolved in one pass over the
+        parameters store, without creating a ``params`` dict for each command.
+        Each column is masked for commands that do not have that parameter, and
+        the rows correspond to the rows of this table::
+
+          >>> cmds = commands.get_cmds('2013:001:00:00:00', '2013:001:01:00:00')
+          >>> params = cmds.params_table(['msid', 'pos'])
+          >>> params['date'] = cmds['date']
+
+        :param keys: list of parameter names (default=all parameters of the commands)
+        :returns: masked Table
+        """
+        if keys is None:
+            keys = self._get_param_keys()
+
+        cols = []
+        for key in keys:
+            values, ok = self._get_param_values(key)
+            cols.append(MaskedColumn(values, name=key, mask=~ok))
+
+        return Table(cols, masked=True)
+
     def __str__(self):
         # Cut out params column for printing
         colnames = self.colnames
-        if 'idx' in colnames:
-            colnames.remove('idx')
+        for name in ('idx', 'time'):
+            if name in colnames:
+                colnames.remove(name)
 
-        # Nice repr of parameters.  This forces all cmd params to get resolved.
+        # Nice repr of parameters that have been resolved
         tmp_params = None
         if 'params' in colnames:
-            params_list = []
-            for params in self['params']:
-                if params is None:
-                    params_list.append('N/A')
-                else:
-                    param_strs = ['{}={}'.format(key, val) for key, val in params.items()]
-                    params_list.append(' '.join(param_strs))
-            tmp_params = params_list
+            tmp_params = self._get_params_strs()
             colnames.remove('params')
 
         tmp = self[colnames]
@@ -321,24 +2044,165 @@ class CommandTable(Table):
     def __bytes__(self):
         return str(self).encode('utf-8')
 
+    def _get_params_strs(self):
+        """
+        List of ``key=val`` strings of the resolved ``params`` of each command,
+        or 'N/A' if not resolved.  The string for archive commands is made once
+        per parameters idx code.
+        """
+        params_col = self.columns['params']
+        out = np.full(len(self), 'N/A', dtype=object)
+        resolved = np.array([params is not None for params in params_col], dtype=bool)
+        in_store = np.zeros(len(self), dtype=bool)
+
+        if 'idx' in self.colnames:
+            idxs = np.asarray(self['idx'])
+            in_store = resolved & (idxs < len(pars_store))
+            codes, inverse = np.unique(idxs[in_store], return_inverse=True)
+            strs = np.array([' '.join(f'{key}={val}' for key, val in pars_store[code])
+                             for code in codes], dtype=object)
+            out[in_store] = strs[inverse]
+
+        for row in np.flatnonzero(resolved & ~in_store):
+            out[row] = ' '.join(f'{key}={val}' for key, val in params_col[row].items())
+
+        return out.tolist()
+
     def fetch_params(self):
         """
         Fetch all ``params`` for every row and force resolution of actual values.
 
         This is handy for printing a command table and seeing all the parameters at once.
+        The parameters are looked up once per parameters idx code.  See also
+        ``params_table()`` for the parameter values as columns.
         """
-        for cmd in self:
-            cmd['params']
+        params_col = self.columns['params']
+        rows = np.flatnonzero([params is None for params in params_col])
+        if len(rows) == 0:
+            return
+
+        codes, inverse = np.unique(np.asarray(self['idx'])[rows], return_inverse=True)
+        pars_tuples = [rev_pars_dict[code] for code in codes]
+        for row, ii in zip(rows, inverse):
+            params_col[row] = dict(pars_tuples[ii])
 
-    def add_cmds(self, cmds):
+    def add_cmds(self, cmds, replace=False):
         """
         Add CommandTable ``cmds`` to self and return the new CommandTable. The
         commands table is maintained in order (date, step, scs).
 
+        Both tables are normally already in this order (e.g. from ``get_cmds``
+        or ``get_cmds_from_backstop``), so they are merged in linear time
+        instead of sorting the combined table.  Commands in self come before
+        commands in ``cmds`` with the same (date, step, scs).
+
+        If ``replace`` is True then the commands in self within the date range
+        of ``cmds`` are dropped, for instance to replace archived commands with
+        the commands from a new backstop file.
+
         :param cmds: :class:`~kadi.commands.commands.CommandTable` of commands
+        :param replace: replace commands in self within the date range of ``cmds``
+            (default=False)
         :returns: :class:`~kadi.commands.commands.CommandTable` of commands
         """
-        out = vstack([self, cmds])
-        out.sort(['date', 'step', 'scs'])
+        base = self._sorted_cmds()
+        cmds = cmds._sorted_cmds() if isinstance(cmds, CommandTable) else cmds
+
+        # Rows of base to keep (all if None)
+        keep = None
+        if replace and len(cmds) > 0:
+            dates = base['date']
+            i0 = np.searchsorted(dates, cmds['date'][0], side='left')
+            i1 = np.searchsorted(dates, cmds['date'][-1], side='right')
+            keep = np.r_[0:i0, i1:len(base)]
+
+        if (base.colnames != cmds.colnames or base.masked or cmds.masked
+                or base['date'].dtype.kind != cmds['date'].dtype.kind):
+            out = vstack([base if keep is None else base[keep], cmds])
+            out.sort(['date', 'step', 'scs'])
+            return out
 
+        if keep is None:
+            n_base = len(base)
+            ins = base._merge_index(cmds)
+        else:
+            # All the new commands go in place of the replaced commands
+            n_base = len(keep)
+            ins = np.full(len(cmds), i0)
+        new_rows = ins + np.arange(len(cmds))
+        base_rows = np.arange(n_base) + np.searchsorted(ins, np.arange(n_base), side='right')
+
+        cols = []
+        for name in base.colnames:
+            base_col = base.columns[name]
+            col = cmds.columns[name]
+            vals = np.empty(n_base + len(cmds),
+                            dtype=np.result_type(base_col.dtype, col.dtype))
+            vals[base_rows] = base_col if keep is None else base_col[keep]
+            vals[new_rows] = col
+            cols.append(Column(vals, name=name))
+
+        out = self.__class__(cols, copy=False)
+        out.meta.update(base.meta)
+        out.meta.update(cmds.meta)
         return out
+
+    def _sorted_cmds(self):
+        """
+        Self if sorted by (date, step, scs), otherwise a sorted copy.
+
+        The commands archive is sorted by date but commands with the same date
+        are not necessarily sorted by (step, scs), so only those runs of
+        commands are sorted in that case.
+        """
+        dates = np.asarray(self['date'])
+        if not np.all(dates[1:] >= dates[:-1]):
+            out = self.copy()
+            out.sort(['date', 'step', 'scs'])
+            return out
+
+        same_date = dates[1:] == dates[:-1]
+        keys = _step_scs_keys(self)
+        bad = same_date & (keys[1:] < keys[:-1])
+        if not np.any(bad):
+            return self
+
+        run_ids = np.cumsum(np.r_[True, ~same_date]) - 1
+        rows = np.flatnonzero(np.isin(run_ids, run_ids[1:][bad]))
+        order = np.arange(len(self))
+        order[rows] = rows[np.lexsort((keys[rows], run_ids[rows]))]
+        return self[order]
+
+    def _merge_index(self, cmds):
+        """
+        Indices of rows in self (sorted by date, step, scs) before which to
+        insert each of the sorted commands ``cmds``, after any equal commands.
+
+        :param cmds: CommandTable of commands
+        :returns: int array
+        """
+        dates = np.asarray(self['date'])
+        cmd_dates = np.asarray(cmds['date'])
+        idx0 = np.searchsorted(dates, cmd_dates, side='left')
+        idx = np.searchsorted(dates, cmd_dates, side='right')
+
+        # Commands with the same date as commands in self are placed by (step, scs)
+        ties = np.flatnonzero(idx0 < idx)
+        if len(ties) > 0:
+            keys = _step_scs_keys(self)
+            cmd_keys = _step_scs_keys(cmds)
+            for ii in ties:
+                j0, j1 = idx0[ii], idx[ii]
+                idx[ii] = j0 + np.count_nonzero(keys[j0:j1] <= cmd_keys[ii])
+
+        return idx
+
+
+def _step_scs_keys(cmds):
+    """Integer sort keys for (step, scs) of ``cmds``"""
+    return np.asarray(cmds['step'], dtype=np.int64) * 256 + np.asarray(cmds['scs'])
+
+
+# Start loading the archive in the background at import if requested
+if os.environ.get('KADI_CMDS_PREFETCH'):
+    prefetch()
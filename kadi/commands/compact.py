@@ -0,0 +1,185 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Compact in-memory encoding of the commands archive table.
+"""
+import numpy as np
+from astropy.table import Table
+from Chandra.Time import DateTime
+
+__all__ = ['CompactCmds']
+
+# Archive string columns that are encoded as codes into a dictionary of values
+CODE_COLS = ('type', 'tlmsid')
+
+
+class CompactCmds(object):
+    """
+    Commands archive table with the ``type`` and ``tlmsid`` columns encoded as
+    uint16 codes into a sorted dictionary of the unique values, and ``date``
+    and ``time`` replaced by a single int64 column of CXC milliseconds.  The
+    other columns are kept as is.
+
+    This uses less than half the memory of the archive table, and filters on
+    ``type`` and ``tlmsid`` are matched against the (small) dictionary and
+    then applied to the codes as integer compares.  Columns are decoded only
+    for the rows that are output.
+
+    Indexing with a column name gives the full decoded column and indexing
+    with a slice gives a decoded Table, so this can stand in for the archive
+    table where needed.
+
+    :param cols: dict of encoded column arrays
+    :param values: dict of dictionary values for each of ``CODE_COLS``
+    :param colnames: column names of the archive table
+    :param meta: table meta (default=None)
+    """
+    def __init__(self, cols, values, colnames, meta=None):
+        self.cols = cols
+        self.values = values
+        self.colnames = list(colnames)
+        self.meta = {} if meta is None else meta
+
+    @classmethod
+    def from_table(cls, idx_cmds):
+        """
+        Encode commands archive table ``idx_cmds``.
+
+        :param idx_cmds: Table of commands
+        :returns: CompactCmds
+        """
+        cols = {}
+        values = {}
+        for name in idx_cmds.colnames:
+            col = np.asarray(idx_cmds[name])
+            if name == 'date':
+                continue
+            elif name == 'time':
+                cols['msecs'] = np.round(col * 1000).astype(np.int64)
+            elif name in CODE_COLS:
+                values[name], codes = np.unique(col, return_inverse=True)
+                if len(values[name]) > 2 ** 16:
+                    raise ValueError(f'too many unique values of {name} to encode')
+                cols[name] = codes.astype(np.uint16)
+            else:
+                cols[name] = np.array(col)
+        for col in cols.values():
+            col.flags.writeable = False
+        return cls(cols, values, idx_cmds.colnames, dict(idx_cmds.meta))
+
+    def __len__(self):
+        return len(self.cols['msecs'])
+
+    def __getitem__(self, item):
+        if isinstance(item, str):
+            return self.get_col(item, 0, len(self))
+        elif isinstance(item, slice):
+            i0, i1, step = item.indices(len(self))
+            if step != 1:
+                raise ValueError('only contiguous slices are supported')
+            return self.get_rows(i0, max(i0, i1))
+        raise TypeError(f'cannot index {self.__class__.__name__} with {item!r}')
+
+    @property
+    def nbytes(self):
+        """Memory used by the encoded columns and dictionaries (bytes)"""
+        return (sum(col.nbytes for col in self.cols.values())
+                + sum(vals.nbytes for vals in self.values.values()))
+
+    def date_index(self, secs):
+        """
+        Index of the first command with time >= ``secs``.
+
+        :param secs: CXC seconds
+        :returns: int
+        """
+        # Round to microsec first so that a command time given exactly (up to
+        # float precision) matches that command.
+        msecs = np.ceil(np.round(secs * 1000, 3))
+        return np.searchsorted(self.cols['msecs'], msecs, side='left')
+
+    def date_range(self, date):
+        """
+        Range of rows ``i0:i1`` with the exact ``date`` (to the nearest msec).
+
+        :param date: DateTime format
+        :returns: i0, i1
+        """
+        msecs = np.round(DateTime(date).secs * 1000)
+        return (np.searchsorted(self.cols['msecs'], msecs, side='left'),
+                np.searchsorted(self.cols['msecs'], msecs, side='right'))
+
+    def match(self, name, op, val, rows, match_column):
+        """
+        Match column ``name`` of ``rows`` against ``val`` for filter operator
+        ``op``.
+
+        Encoded columns are matched with ``match_column(values, op, val)``
+        against the dictionary of values and then by code.  The ``date`` and
+        ``time`` columns are decoded for the rows and then matched.
+
+        :param name: column name
+        :param op: filter operator
+        :param val: filter value
+        :param rows: slice or array of row positions
+        :param match_column: function that matches a column (array)
+        :returns: bool array
+        """
+        if name not in self.values:
+            return match_column(self.take(name, rows), op, val)
+
+        codes = self.cols[name][rows]
+        match_codes = np.flatnonzero(match_column(self.values[name], op, val))
+        if len(match_codes) == 0:
+            return np.zeros(len(codes), dtype=bool)
+        elif len(match_codes) == 1:
+            return codes == match_codes[0]
+
+        lookup = np.zeros(len(self.values[name]), dtype=bool)
+        lookup[match_codes] = True
+        return lookup[codes]
+
+    def take(self, name, rows):
+        """
+        Decode column ``name`` for ``rows``.
+
+        :param name: column name
+        :param rows: slice or array of row positions
+        :returns: array
+        """
+        col = self.cols['msecs' if name in ('date', 'time') else name][rows]
+        if name in self.values:
+            return self.values[name][col]
+        elif name == 'time':
+            return col / 1000
+        elif name == 'date':
+            if len(col) == 0:
+                return np.array([], dtype='S21')
+            return np.asarray(DateTime(col / 1000).date).astype('S21')
+        return col
+
+    def get_col(self, name, i0, i1, ok=None):
+        """
+        Decode column ``name`` for rows ``i0:i1``, optionally selecting only
+        rows where bool array ``ok`` is True.
+
+        :param name: column name
+        :param i0: first row
+        :param i1: row after last row
+        :param ok: bool array of length ``i1 - i0`` (optional)
+        :returns: array
+        """
+        rows = slice(i0, i1) if ok is None else np.flatnonzero(ok) + i0
+        return self.take(name, rows)
+
+    def get_rows(self, i0, i1, ok=None):
+        """
+        Decode rows ``i0:i1`` as a Table with the columns of the archive table,
+        optionally selecting only rows where bool array ``ok`` is True.
+
+        :param i0: first row
+        :param i1: row after last row
+        :param ok: bool array of length ``i1 - i0`` (optional)
+        :returns: Table
+        """
+        cols = [self.get_col(name, i0, i1, ok) for name in self.colnames]
+        return Table(cols, names=self.colnames, copy=False, meta=self.meta)
@@ -0,0 +1,178 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Commands archive in POSIX shared memory, for sharing one copy of the archive
+between many worker processes.
+"""
+import json
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+from astropy.table import Table
+
+__all__ = ['SharedArchive']
+
+# Byte alignment of each array in the shared memory block
+ALIGN = 64
+
+
+class SharedArchive(object):
+    """
+    Commands archive (commands table, parameters store and the row indexes
+    used for queries) in a block of POSIX shared memory.
+
+    One process publishes the archive and any number of processes on the same
+    node then attach to it, using the arrays in shared memory directly (no
+    copy) and read-only.  Normally this is done through the commands archive
+    handle ``kadi.commands.ARCHIVE``::
+
+      >>> from kadi import commands
+      >>> shared = commands.ARCHIVE.publish('kadi_cmds')  # Main process
+
+      >>> commands.ARCHIVE.attach('kadi_cmds')  # Each worker process
+
+    Workers can also attach automatically on first use of the archive by
+    setting the ``KADI_CMDS_SHM`` environment variable to the shared memory
+    name.  The publishing process must keep ``shared`` until the workers are
+    done and then call ``shared.unlink()`` to free the memory.  This requires
+    Python 3.8 or later (``multiprocessing.shared_memory``).
+
+    The parameters index row index and the ``INDEX_COLS`` column indexes are
+    published too, so workers do not need to build them.
+
+    The block starts with the length (8 bytes) of a JSON header that gives the
+    dtype, shape and offset of each array, followed by the arrays starting at
+    the next multiple of ``ALIGN`` bytes.
+
+    :param shm: SharedMemory object
+    :param owner: True if this process created the shared memory
+    """
+    def __init__(self, shm, owner=False):
+        self.shm = shm
+        self.owner = owner
+        n_header = int.from_bytes(shm.buf[:8], 'little')
+        self.header = json.loads(bytes(shm.buf[8:8 + n_header]).decode('utf-8'))
+        self.data_offset = _aligned(8 + n_header)
+
+    @property
+    def name(self):
+        """Name of the shared memory block"""
+        return self.shm.name
+
+    @classmethod
+    def publish(cls, archive, name=None):
+        """
+        Copy ``archive`` into a new shared memory block.
+
+        :param archive: :class:`~kadi.commands.commands.CommandsArchive`
+        :param name: shared memory name (default=random name)
+        :returns: SharedArchive
+        """
+        from .commands import INDEX_COLS
+
+        arrays = [('cmds', colname, np.asarray(archive.idx_cmds[colname]))
+                  for colname in archive.idx_cmds.colnames]
+        arrays += [('pars', array_name, np.asarray(getattr(archive.pars_store, array_name)))
+                   for array_name in archive.pars_store.array_names]
+        for name in ('idx',) + INDEX_COLS:
+            index = archive.pars_index if name == 'idx' else archive.get_column_index(name)
+            arrays += [('index_' + name, array_name, np.asarray(array))
+                       for array_name, array in index.get_arrays().items()]
+
+        specs = []
+        offset = 0
+        for group, array_name, array in arrays:
+            specs.append({'group': group,
+                          'name': array_name,
+                          'dtype': array.dtype.str,
+                          'shape': list(array.shape),
+                          'offset': offset})
+            offset += _aligned(array.nbytes)
+        header = {'arrays': specs,
+                  'version': archive.version,
+                  'generation': archive.generation}
+        header_bytes = json.dumps(header).encode('utf-8')
+        data_offset = _aligned(8 + len(header_bytes))
+
+        shm = shared_memory.SharedMemory(name=name, create=True, size=data_offset + offset)
+        shm.buf[:8] = len(header_bytes).to_bytes(8, 'little')
+        shm.buf[8:8 + len(header_bytes)] = header_bytes
+        for spec, (_, _, array) in zip(specs, arrays):
+            out = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf,
+                             offset=data_offset + spec['offset'])
+            out[...] = array
+
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        """
+        Attach to the shared archive ``name`` published by another process.
+
+        :param name: shared memory name
+        :returns: SharedArchive
+        """
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Before Python 3.13 the shared memory always gets registered with
+            # the resource tracker, which would then unlink it when this
+            # process exits.
+            shm = shared_memory.SharedMemory(name=name)
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return cls(shm)
+
+    def get_arrays(self, group):
+        """
+        Get read-only arrays in ``group`` ('cmds', 'pars' or 'index_<name>' for
+        the index of column ``name``) that use the shared memory.
+
+        :param group: array group name
+        :returns: dict of name => array
+        """
+        out = {}
+        for spec in self.header['arrays']:
+            if spec['group'] == group:
+                array = np.ndarray(spec['shape'], dtype=np.dtype(spec['dtype']),
+                                   buffer=self.shm.buf,
+                                   offset=self.data_offset + spec['offset'])
+                array.flags.writeable = False
+                out[spec['name']] = array
+        return out
+
+    def get_archive(self, generation=1):
+        """
+        Get commands archive that uses the shared memory arrays.
+
+        :param generation: generation number of the archive
+        :returns: :class:`~kadi.commands.commands.CommandsArchive`
+        """
+        from .commands import CommandsArchive, ParsStore, RowIndex, ColumnIndex, INDEX_COLS
+
+        cols = self.get_arrays('cmds')
+        idx_cmds = Table(list(cols.values()), names=list(cols), copy=False)
+        version = self.header['version']
+        idx_cmds.meta['version'] = None if version is None else tuple(
+            None if ver is None else tuple(ver) for ver in version)
+        pars_store = ParsStore(self.get_arrays('pars'))
+        indexes = {}
+        for name in ('idx',) + INDEX_COLS:
+            arrays = self.get_arrays('index_' + name)
+            if arrays:
+                indexes[name] = (RowIndex if name == 'idx' else ColumnIndex)(**arrays)
+        archive = CommandsArchive(generation, idx_cmds=idx_cmds, pars_store=pars_store,
+                                  indexes=indexes)
+        archive.shared = self  # Keep the shared memory open while archive is in use
+        return archive
+
+    def close(self):
+        """Close access to the shared memory from this process"""
+        self.shm.close()
+
+    def unlink(self):
+        """Free the shared memory (only by the publishing process)"""
+        self.shm.unlink()
+
+
+def _aligned(n_bytes):
+    """Round up ``n_bytes`` to a multiple of ``ALIGN``"""
+    return -(-n_bytes // ALIGN) * ALIGN
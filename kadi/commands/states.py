@@ -530,21 +530,27 @@ class SPMEclipseEnableTransition(BaseTransition):
         # Preselect only commands that might have an impact here.
         ok = (cmds['tlmsid'] == 'EOESTECN') | (cmds['type'] == 'ORBPOINT')
         cmds = cmds[ok]
+        if len(cmds) == 0:
+            return
+
+        # User-supplied commands may not have the time column
+        times = (cmds['time'] if 'time' in cmds.colnames
+                 else DateTime(cmds['date']).secs)
 
         connect_time = 0
         connect_flag = False
 
-        for cmd in cmds:
+        for cmd, time in zip(cmds, times):
             if cmd['tlmsid'] == 'EOESTECN':
-                connect_time = DateTime(cmd['date']).secs
+                connect_time = time
 
             elif cmd['type'] == 'ORBPOINT':
                 if cmd['event_type'] in ('PENTRY', 'LSPENTRY'):
-                    entry_time = DateTime(cmd['date']).secs
+                    entry_time = time
                     connect_flag = (entry_time - connect_time < 125)
 
                 elif cmd['event_type'] in ('PEXIT', 'LSPEXIT') and connect_flag:
-                    scs33 = DateTime(cmd['date']) + 11 * 60 / 86400  # 11 minutes in days
+                    scs33 = DateTime(time + 11 * 60)  # 11 minutes
                     transitions_dict[scs33.date]['sun_pos_mon'] = 'ENAB'
                     connect_flag = False
 
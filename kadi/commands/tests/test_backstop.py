@@ -0,0 +1,134 @@
+import time
+from pathlib import Path
+
+import numpy as np
+
+# Use data file from parse_cm.test for backstop tests.  This package is a dependency
+import parse_cm
+import parse_cm.tests
+
+from .. import backstop
+
+BS_FILE = Path(parse_cm.tests.__file__).parent / 'data' / 'CR182_0803.backstop'
+
+
+def _coerce_type_baseline(val):
+    """Original update_cmds._coerce_type"""
+    try:
+        val = int(val)
+    except ValueError:
+        try:
+            val = float(val)
+        except ValueError:
+            val = str(val)
+    return val
+
+
+def _parse_params_baseline(paramstr):
+    """Original update_cmds.parse_params"""
+    params = {}
+    for opt in paramstr.split(','):
+        try:
+            key, val = opt.split('=')
+            params[key] = val if key == 'HEX' else _coerce_type_baseline(val)
+        except Exception:
+            pass  # backstop has some quirks like blank or '??????' fields
+
+    return params
+
+
+def _read_backstop_baseline(filename):
+    """Original update_cmds.read_backstop (one line at a time)"""
+    bs = []
+    for bs_line in open(filename):
+        bs_line = bs_line.replace(' ', '')
+        date, vcdu, cmd_type, paramstr = [x for x in bs_line.split('|')]
+        vcdu = int(vcdu[:-1])  # Get rid of final '0' from '8023268 0' (where space was stripped)
+        params = _parse_params_baseline(paramstr)
+        bs.append({'date': date,
+                   'type': cmd_type,
+                   'params': params,
+                   'tlmsid': params.get('TLMSID'),
+                   'scs': params.get('SCS'),
+                   'step': params.get('STEP'),
+                   'vcdu': vcdu
+                   })
+    return bs
+
+
+def test_read_backstop_as_list():
+    """Bulk parser gives the same as the original update_cmds.read_backstop"""
+    cmds = backstop.read_backstop_as_list(BS_FILE, cache=False)
+    assert cmds == _read_backstop_baseline(BS_FILE)
+
+
+def test_read_backstop():
+    """Backstop table is the same as from parse_cm"""
+    bs = backstop.read_backstop(BS_FILE, cache=False)
+    exp_bs = parse_cm.read_backstop(str(BS_FILE))
+    assert len(bs) == len(exp_bs)
+    for name in ('date', 'type', 'tlmsid', 'scs', 'step', 'vcdu'):
+        assert np.all(bs[name] == exp_bs[name])
+    assert list(bs['params']) == list(exp_bs['params'])
+
+
+def test_read_backstop_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv('KADI_BACKSTOP_CACHE', str(tmp_path / 'cache'))
+    bs_file = tmp_path / 'test.backstop'
+    bs_file.write_text(BS_FILE.read_text())
+
+    cmds = backstop.read_backstop_as_list(bs_file)
+    cache_files = list((tmp_path / 'cache').glob('*.npy'))
+    assert len(cache_files) == 1
+    assert backstop.read_backstop_as_list(bs_file) == cmds
+
+    # Cache file is keyed by the file content hash and read without pickle
+    cache_path = backstop._get_cache_path(bs_file.read_bytes())
+    assert cache_path == cache_files[0]
+    assert backstop._read_cache(cache_path) == cmds
+    assert np.load(cache_path, allow_pickle=False).dtype.names == ('date', 'type', 'vcdu',
+                                                                   'params')
+    np.save(cache_path, np.array([{'date': 'bad'}], dtype=object))
+    assert backstop._read_cache(cache_path) is None
+    assert backstop.read_backstop_as_list(bs_file) == cmds
+
+    # Modified file is parsed again
+    lines = BS_FILE.read_text().splitlines(keepends=True)
+    bs_file.write_text(''.join(lines[:10]))
+    assert backstop.read_backstop_as_list(bs_file) == cmds[:10]
+
+
+def test_read_backstop_cache_lru(tmp_path, monkeypatch):
+    """Backstop cache is limited in size by removing least recently used files"""
+    monkeypatch.setenv('KADI_BACKSTOP_CACHE', str(tmp_path / 'cache'))
+    monkeypatch.setattr(backstop, '_cache_bytes', {})
+    # Files with different contents but the same cache file size
+    lines = BS_FILE.read_text().splitlines()
+    bs_files = []
+    for ii in range(4):
+        bs_files.append(tmp_path / f'test{ii}.backstop')
+        bs_files[-1].write_text('\n'.join(lines[ii:] + lines[:ii]))
+    for bs_file in bs_files[:3]:
+        backstop.read_backstop_as_list(bs_file)
+        time.sleep(0.01)
+    cache_files = sorted((tmp_path / 'cache').glob('*.npy'), key=lambda pth: pth.stat().st_mtime)
+    size = cache_files[0].stat().st_size
+    # Cache size is tracked without scanning the directory on each write
+    assert backstop._cache_bytes[tmp_path / 'cache'] == 3 * size
+
+    # Reading the first file again makes it the most recently used
+    backstop.read_backstop_as_list(bs_files[0])
+    time.sleep(0.01)
+
+    monkeypatch.setattr(backstop, 'CACHE_MAX_BYTES', size * 3)
+    backstop.read_backstop_as_list(bs_files[3])
+    new_cache_files = set((tmp_path / 'cache').glob('*.npy'))
+    assert len(new_cache_files) == 3
+    assert cache_files[0] in new_cache_files
+    assert cache_files[1] not in new_cache_files
+    assert backstop._cache_bytes[tmp_path / 'cache'] == 3 * size
+
+    # Files removed by another process are skipped
+    cache_files[0].unlink()
+    assert backstop._prune_cache(tmp_path / 'cache', size) == size
+    assert len(list((tmp_path / 'cache').glob('*.npy'))) == 1
@@ -1,7 +1,15 @@
+import logging
+import pickle
+import shutil
+import threading
+import time
 from pathlib import Path
 
 import numpy as np
-from astropy.table import Table
+import pytest
+import tables
+from astropy.table import Table, vstack
+from Chandra.Time import DateTime
 
 # Use data file from parse_cm.test for get_cmds_from_backstop test.
 # This package is a dependency
@@ -9,6 +17,7 @@ import parse_cm.tests
 
 # Import cmds module directly (not kadi.cmds package, which is from ... import cmds)
 from .. import commands
+from ... import update_cmds
 
 
 def test_find():
@@ -34,6 +43,273 @@ def test_find():
     assert len(cs) == 2494
 
 
+def test_find_time_slice_is_view():
+    # With only start/stop the result is a contiguous slice of the archive
+    cs = commands._find('2012:029', '2012:030')
+    assert np.shares_memory(cs['date'], commands.idx_cmds['date'])
+
+    # Empty interval and inverted interval
+    assert len(commands._find('2012:029:12:00:00', '2012:029:12:00:00')) == 0
+    assert len(commands._find('2012:030', '2012:029')) == 0
+
+
+def test_pars_index():
+    """Parameter index gives same idx codes and rows as a brute force search"""
+    for key, val in (('msid', 'AFLCRSET'), ('pos', 73176), ('id', 13925)):
+        idxs = commands.pars_index.get_idxs(key, val)
+        exp_idxs = sorted(idx for pars, idx in commands.pars_dict.items()
+                          if dict(pars).get(key) == val)
+        assert np.all(idxs == exp_idxs)
+
+        rows = np.sort(commands.pars_index.get_rows(idxs, 0, len(commands.idx_cmds)))
+        exp_rows = np.flatnonzero(np.isin(commands.idx_cmds['idx'], exp_idxs))
+        assert np.all(rows == exp_rows)
+
+
+def test_load_idx_cmds_npy(tmp_path, monkeypatch):
+    """Memory-mapped .npy archive gives the same table as the HDF5 archive"""
+    cmds = np.array(commands._find('2012:029', '2012:030'))
+    pars_dict = commands.pars_dict._val
+    monkeypatch.setenv('KADI', str(tmp_path))
+    with tables.open_file(str(tmp_path / 'cmds.h5'), mode='w') as h5:
+        h5.create_table(h5.root, 'data', cmds, 'cmds')
+    update_cmds.write_npy_cmds(tmp_path / 'cmds.h5', pars_dict, tmp_path / 'cmds_npy')
+
+    idx_cmds = commands.load_idx_cmds()
+    assert idx_cmds.colnames == list(cmds.dtype.names)
+    for name in cmds.dtype.names:
+        assert np.all(idx_cmds[name] == cmds[name])
+        assert not idx_cmds[name].flags.writeable  # memory-mapped read-only
+    assert commands.load_pars_store().to_pars_dict() == pars_dict
+
+    # HDF5 archive updated without updating the .npy archive: fall back to HDF5
+    with tables.open_file(str(tmp_path / 'cmds.h5'), mode='a') as h5:
+        h5.root.data.append(cmds[-1:])
+    idx_cmds = commands.load_idx_cmds()
+    assert len(idx_cmds) == len(cmds) + 1
+    assert idx_cmds['date'].flags.writeable
+
+    # Same number of rows but last command replaced: fall back to HDF5
+    update_cmds.write_npy_cmds(tmp_path / 'cmds.h5', pars_dict, tmp_path / 'cmds_npy')
+    assert not commands.load_idx_cmds()['date'].flags.writeable
+    with tables.open_file(str(tmp_path / 'cmds.h5'), mode='a') as h5:
+        h5.root.data.remove_rows(len(cmds))
+        h5.root.data.append(cmds[:1])
+    idx_cmds = commands.load_idx_cmds()
+    assert idx_cmds['date'].flags.writeable
+    assert idx_cmds['date'][-1] == cmds['date'][0]
+
+    # pars_dict file written after the .npy archive: fall back to pars_dict
+    update_cmds.write_npy_cmds(tmp_path / 'cmds.h5', pars_dict, tmp_path / 'cmds_npy')
+    assert commands._get_npy_header() is not None
+    with open(tmp_path / 'cmds.pkl', 'wb') as fh:
+        pickle.dump(pars_dict, fh, protocol=2)
+    assert commands._get_npy_header() is None
+    assert commands.load_pars_store().to_pars_dict() == pars_dict
+
+    # Columns from another archive generation or missing (e.g. while the .npy
+    # archive is being replaced): fall back to HDF5
+    update_cmds.write_npy_cmds(tmp_path / 'cmds.h5', pars_dict, tmp_path / 'cmds_npy')
+    assert not commands.load_idx_cmds()['date'].flags.writeable
+    np.save(tmp_path / 'cmds_npy' / 'idx.npy', np.zeros(len(cmds) + 1, dtype=np.uint16))
+    assert commands.load_idx_cmds()['date'].flags.writeable
+    (tmp_path / 'cmds_npy' / 'idx.npy').unlink()
+    idx_cmds = commands.load_idx_cmds()
+    assert idx_cmds['date'].flags.writeable
+    assert np.all(idx_cmds['idx'][:len(cmds)] == cmds['idx'])
+
+
+def test_persisted_indexes(tmp_path, monkeypatch):
+    """Indexes written by update_cmds are loaded and updated incrementally"""
+    cmds = np.array(commands._find('2012:029', '2012:031'))
+    pars_dict = commands.pars_dict._val
+    indexes = update_cmds.get_indexes(cmds)
+
+    # Truncate and append gives the same index as building it
+    for name, index in update_cmds.get_indexes(cmds[:-30]).items():
+        index = index.truncate_append(len(cmds) - 50, cmds[name][-50:])
+        for arr_name, arr in index.get_arrays().items():
+            assert np.all(arr == getattr(indexes[name], arr_name))
+
+    monkeypatch.setenv('KADI', str(tmp_path))
+    with tables.open_file(str(tmp_path / 'cmds.h5'), mode='w') as h5:
+        h5.create_table(h5.root, 'data', cmds, 'cmds')
+        update_cmds.write_h5_indexes(h5, indexes, len(cmds))
+    for name in update_cmds.INDEX_NAMES:
+        index = commands.load_index(name)
+        assert np.all(index.rows == indexes[name].rows)
+
+    update_cmds.write_npy_cmds(tmp_path / 'cmds.h5', pars_dict, tmp_path / 'cmds_npy')
+    archive = commands.CommandsArchive()
+    index = archive.get_column_index('tlmsid')
+    assert isinstance(index.rows, np.memmap)
+    assert isinstance(archive.pars_index.rows, np.memmap)
+    cmds_idx = archive.filter_rows(0, len(cmds), tlmsid='aonmmode', msid='aflcrset')
+    idxs = archive.pars_index.get_idxs('msid', 'AFLCRSET')
+    ok = (cmds['tlmsid'] == b'AONMMODE') & np.isin(cmds['idx'], idxs)
+    assert np.all(cmds_idx['date'] == cmds['date'][ok])
+
+    # Index not up to date with the commands table is not used
+    with tables.open_file(str(tmp_path / 'cmds.h5'), mode='a') as h5:
+        h5.root.data.append(cmds[-1:])
+    (tmp_path / 'cmds_npy' / 'header.json').unlink()
+    assert commands.load_index('tlmsid') is None
+
+
+def test_archive_reload(tmp_path, monkeypatch):
+    """Archive handle loads a new generation when the archive files change"""
+    cmds = np.array(commands._find('2012:029', '2012:030'))
+    pars_dict = commands.pars_dict._val
+    monkeypatch.setenv('KADI', str(tmp_path))
+    with tables.open_file(str(tmp_path / 'cmds.h5'), mode='w') as h5:
+        h5.create_table(h5.root, 'data', cmds[:-10], 'cmds')
+    update_cmds.write_npy_cmds(tmp_path / 'cmds.h5', pars_dict, tmp_path / 'cmds_npy')
+
+    handle = commands.ArchiveHandle(check_interval=0)
+    archive1 = handle.get()
+    assert handle.generation == 1
+    assert handle.get() is archive1
+
+    with tables.open_file(str(tmp_path / 'cmds.h5'), mode='a') as h5:
+        h5.root.data.append(cmds[-10:])
+    update_cmds.write_npy_cmds(tmp_path / 'cmds.h5', pars_dict, tmp_path / 'cmds_npy')
+
+    # Change is detected and the new generation loads in the background
+    assert handle.get() is archive1
+    handle._thread.join()
+    archive2 = handle.get()
+    assert handle.generation == 2
+    assert len(archive2.idx_cmds) == len(cmds)
+
+    # Previous generation is still intact for in-flight queries
+    assert len(archive1.idx_cmds) == len(cmds) - 10
+    assert np.all(archive1.filter_rows(0, 5)['date'] == cmds['date'][:5])
+
+    assert handle.reload() == 3
+
+
+def test_lazy_val_threads():
+    """Concurrent first access of a LazyVal loads the value once"""
+    n_loads = []
+
+    def load():
+        n_loads.append(1)
+        time.sleep(0.1)
+        return [1, 2, 3]
+
+    val = commands.LazyVal(load)
+    threads = [threading.Thread(target=len, args=(val,)) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(n_loads) == 1
+    assert len(val) == 3
+
+
+def test_archive_prefetch():
+    archive = commands.ARCHIVE.get()
+    handle = commands.ArchiveHandle()
+    thread = handle.prefetch()
+    # Query while prefetch is in progress waits for the same load
+    prefetched = handle.get()
+    thread.join()
+    assert handle.generation == 1
+    assert handle.get() is prefetched
+    assert prefetched._pars_index is not None
+    assert set(prefetched._column_indexes) == set(commands.INDEX_COLS)
+    assert len(prefetched.idx_cmds) == len(archive.idx_cmds)
+
+
+def test_shared_archive():
+    """Archive published to shared memory is the same as the original"""
+    pytest.importorskip('multiprocessing.shared_memory')  # Python >= 3.8
+    from ..shared_archive import SharedArchive
+
+    archive = commands.ARCHIVE.get()
+    shared = commands.ARCHIVE.publish()
+    try:
+        shared_archive = SharedArchive.attach(shared.name).get_archive()
+        assert shared_archive.idx_cmds.colnames == archive.idx_cmds.colnames
+        for name in archive.idx_cmds.colnames:
+            assert np.all(shared_archive.idx_cmds[name] == archive.idx_cmds[name])
+            assert not shared_archive.idx_cmds[name].flags.writeable
+        assert shared_archive.pars_store.to_pars_dict() == archive.pars_store.to_pars_dict()
+
+        # Indexes come from the shared memory instead of being built
+        assert np.all(shared_archive.pars_index.rows == archive.pars_index.rows)
+        assert not shared_archive.pars_index.rows.flags.writeable
+        for name in commands.INDEX_COLS:
+            index = shared_archive.get_column_index(name)
+            assert not index.rows.flags.writeable
+            assert np.all(index.values == archive.get_column_index(name).values)
+
+        cmds = shared_archive.filter_rows(*shared_archive.get_row_range('2012:029', '2012:030'))
+        assert np.all(cmds['date'] == commands._find('2012:029', '2012:030')['date'])
+        shared_archive.shared.close()
+    finally:
+        shared.close()
+        shared.unlink()
+
+
+def test_compact_archive():
+    """Compact archive encoding gives the same query results as the archive table"""
+    archive = commands.ARCHIVE.get()
+    compact = commands.CommandsArchive(idx_cmds=archive.idx_cmds,
+                                       pars_store=archive.pars_store, compact=True)
+    n_bytes = sum(np.asarray(archive.idx_cmds[name]).nbytes
+                  for name in archive.idx_cmds.colnames)
+    assert compact.idx_cmds.nbytes < n_bytes / 2
+
+    for kwargs in ({}, {'type': 'simtrans'}, {'type__ne': 'command_sw'},
+                   {'tlmsid__in': ['aonmmode', 'aonpmode']}, {'tlmsid__startswith': 'aon'},
+                   {'tlmsid__lt': 'aonm'}, {'type': 'not_a_type'}, {'pos__gt': 74000},
+                   {'date__startswith': '2012:030'}):
+        exp = archive.filter_rows(*archive.get_row_range('2012:029', '2012:031'), **kwargs)
+        cmds = compact.filter_rows(*compact.get_row_range('2012:029', '2012:031'), **kwargs)
+        assert cmds.colnames == exp.colnames
+        for name in exp.colnames:
+            assert cmds[name].dtype == exp[name].dtype
+            if name == 'time':
+                assert np.allclose(cmds[name], exp[name], rtol=0, atol=1e-6)
+            else:
+                assert np.all(cmds[name] == exp[name])
+
+    date = archive.idx_cmds['date'][1000]
+    assert compact.get_row_range(date=date) == archive.get_row_range(date=date)
+    time = archive.idx_cmds['time'][1000]
+    assert compact.get_row_range(time, time + 1) == archive.get_row_range(time, time + 1)
+
+
+def test_pars_store():
+    """Columnar parameters store round-trips pars_dict"""
+    pars_dict = {(): 0,
+                 (('msid', 'AFLCRSET'), ('hex', '8030C00')): 1,
+                 (('pos', -99616),): 2,
+                 (('angp', 0.5), ('coefp', 1), ('msid', 'AODITPAR')): 3}
+    pars_store = commands.ParsStore.from_pars_dict(pars_dict)
+    assert len(pars_store) == 4
+    for pars_tuple, idx in pars_dict.items():
+        assert pars_store[idx] == pars_tuple
+        for (_, val), (_, exp_val) in zip(pars_store[idx], pars_tuple):
+            assert type(val) is type(exp_val)
+    assert pars_store.to_pars_dict() == pars_dict
+
+    with pytest.raises(KeyError):
+        pars_store[65535]
+
+    # Read-only mapping like the former rev_pars_dict
+    rev_pars_dict = {idx: pars_tuple for pars_tuple, idx in pars_dict.items()}
+    assert dict(pars_store.items()) == rev_pars_dict
+    assert list(pars_store.keys()) == [0, 1, 2, 3]
+    assert 1 in pars_store
+    assert np.uint16(1) in pars_store
+    assert 65535 not in pars_store
+    assert 'msid' not in pars_store
+    assert pars_store.get(3) == rev_pars_dict[3]
+    assert pars_store.get(65535) is None
+
+
 def test_get_cmds():
     cs = commands.get_cmds('2012:029', '2012:030')
     assert isinstance(cs, commands.CommandTable)
@@ -49,6 +325,11 @@ def test_get_cmds():
     assert np.all(cs['date'] == ['2012:030:02:00:00.000', '2012:030:08:27:02.000'])
     assert np.all(cs['pos'] == [75624, 73176])  # from params
 
+    # Table printout leaves out idx and time like the row repr
+    colnames = str(cs).splitlines()[0].split()
+    assert colnames == ['date', 'type', 'tlmsid', 'scs', 'step', 'timeline_id',
+                        'vcdu', 'params']
+
     cmd = cs[1]
 
     assert repr(cmd).startswith('<Cmd 2012:030:08:27:02.000 SIMTRANS')
@@ -60,13 +341,371 @@ def test_get_cmds():
     assert cmd['step'] == 161
 
 
+def test_get_param_column():
+    """Vectorized parameter column matches resolving params row by row"""
+    cmds = commands.get_cmds('2012:029', '2012:030')
+    for key in ('pos', 'id', 'msid', 'event_type', 'not_a_param'):
+        exp = [cmd['params'].get(key) for cmd in cmds]
+        assert cmds[key].tolist() == exp
+
+    cmds = commands.get_cmds('2012:029', '2012:030', type='simtrans')
+    assert cmds['pos'].dtype.kind == 'i'
+
+
+def test_params_table():
+    """Parameters table matches resolving params row by row"""
+    bs_file = Path(parse_cm.tests.__file__).parent / 'data' / 'CR182_0803.backstop'
+    cmds = commands.get_cmds('2012:029', '2012:030')
+    cmds = cmds.add_cmds(commands.get_cmds_from_backstop(bs_file)[:20])
+    params = cmds.params_table()
+    assert len(params) == len(cmds)
+
+    exp_keys = set()
+    for cmd, row in zip(cmds, params):
+        exp_keys.update(cmd['params'])
+        for key in params.colnames:
+            if key in cmd['params']:
+                assert row[key] == cmd['params'][key]
+            else:
+                assert row[key] is np.ma.masked
+    assert params.colnames == sorted(exp_keys)
+
+    params = cmds.params_table(['pos', 'not_a_param'])
+    assert params.colnames == ['pos', 'not_a_param']
+    assert np.all(params['not_a_param'].mask)
+
+    # String representation with params resolved
+    cmds = commands.get_cmds('2012:029', '2012:030', type='simtrans')
+    assert 'N/A' in str(cmds)
+    cmds.fetch_params()
+    assert 'N/A' not in str(cmds)
+    assert str(cmds).splitlines()[-1].endswith(' pos={}'.format(cmds['pos'][-1]))
+    assert cmds['params'][0] == {'pos': cmds['pos'][0]}
+
+
+def test_get_cmds_filter_operators():
+    """Filter operators match a brute force selection"""
+    cmds = commands.get_cmds('2012:029', '2012:030')
+    tlmsids = list(cmds['tlmsid'])
+    pos = list(cmds['pos'])
+
+    cs = commands.get_cmds('2012:029', '2012:030', tlmsid__startswith='aon')
+    assert len(cs) == sum(tlmsid.startswith('AON') for tlmsid in tlmsids)
+
+    cs = commands.get_cmds('2012:029', '2012:030', tlmsid__in=['aonmmode', 'aonpmode'])
+    assert len(cs) == sum(tlmsid in ('AONMMODE', 'AONPMODE') for tlmsid in tlmsids)
+
+    cs = commands.get_cmds('2012:029', '2012:030', type__ne='command_sw')
+    assert len(cs) == np.count_nonzero(cmds['type'] != 'COMMAND_SW')
+
+    cs = commands.get_cmds('2012:029', '2012:030', pos__gt=74000)
+    assert np.all(cs['pos'] == [75624])
+    assert len(cs) == sum(val is not None and val > 74000 for val in pos)
+
+    with pytest.raises(ValueError, match='unknown filter operator'):
+        commands.get_cmds('2012:029', '2012:030', tlmsid__startwith='aon')
+
+
+def test_get_cmds_query_plan():
+    """Planned query matches a brute force selection and reports the plan"""
+    cmds = commands.get_cmds('2012:001', '2012:030')
+    ok = ((cmds['type'] == 'COMMAND_SW') & (cmds['tlmsid'] == 'AOMANUVR')
+          & (cmds['scs'] > 130) & (cmds['time'] < cmds['time'][-100]))
+
+    cs = commands.get_cmds('2012:001', '2012:030', scs__gt=130, type='command_sw',
+                           time__lt=cmds['time'][-100], tlmsid='aomanuvr', explain=True)
+    assert np.all(cs['date'] == cmds['date'][ok])
+
+    plan = cs.meta['query_plan']
+    assert [step['filter'] for step in plan] == ['start/stop', 'time__lt', 'tlmsid__exact',
+                                                 'type__exact', 'scs__gt']
+    assert [step['method'] for step in plan] == ['range', 'range', 'index', 'filter',
+                                                 'filter']
+    assert plan[2]['n_est'] == plan[2]['n_rows'] == np.count_nonzero(ok)
+    assert plan[-1]['n_rows'] == len(cs)
+
+    # Parameter filter and index intersection
+    cs = commands.get_cmds('2012:001', '2012:030', msid='aflcrset', type='command_sw',
+                           explain=True)
+    assert np.all(cs['date'] == cmds['date'][cmds['msid'] == 'AFLCRSET'])
+    assert cs.meta['query_plan'][1]['filter'] == 'msid__exact'
+
+    # Filters matching many parameter codes on a short interval are a scan
+    cmds = commands.get_cmds('2012:029', '2012:030')
+    for kwargs, ok in (({'msid__ne': 'aflcrset'}, [val != 'AFLCRSET' for val in cmds['msid']]),
+                       ({'pos': None}, [val is None for val in cmds['pos']])):
+        cs = commands.get_cmds('2012:029', '2012:030', explain=True, **kwargs)
+        assert np.all(cs['date'] == cmds['date'][np.array(ok)])
+        assert cs.meta['query_plan'][1]['method'] == 'scan'
+
+    # No matching rows stops evaluation
+    cs = commands.get_cmds(tlmsid='not_a_tlmsid', type='command_sw', explain=True)
+    assert len(cs) == 0
+    assert len(cs.meta['query_plan']) == 2
+
+
+def test_iter_cmds():
+    cmds = commands.get_cmds('2012:001', '2012:030', type='simtrans')
+    for kwargs in ({'chunk': 1000}, {'chunk_days': 3}):
+        chunks = list(commands.iter_cmds('2012:001', '2012:030', type='simtrans', **kwargs))
+        assert len(chunks) > 1
+        assert all(isinstance(chunk, commands.CommandTable) for chunk in chunks)
+        assert np.all(vstack(chunks)['date'] == cmds['date'])
+
+    assert list(commands.iter_cmds('2012:001', '2012:001')) == []
+
+
+def test_cmds_cache(monkeypatch):
+    cache = commands.CmdsCache(max_entries=2)
+    monkeypatch.setattr(commands, 'CMDS_CACHE', cache)
+
+    cs1 = commands.get_cmds('2012:029', '2012:030', type='simtrans')
+    cs2 = commands.get_cmds('2012:029:00:00:00.000', '2012:030', type='SIMTRANS')
+    assert cache.info()['hits'] == 1
+    assert cache.info()['misses'] == 1
+    assert np.all(cs1['date'] == cs2['date'])
+
+    # Modifying output does not change the cache
+    cs2['step'][0] = 0
+    cs3 = commands.get_cmds('2012:029', '2012:030', type='simtrans')
+    assert np.all(cs3['step'] == cs1['step'])
+
+    # LRU eviction by number of entries
+    commands.get_cmds('2012:029', '2012:030', type='acispkt')
+    commands.get_cmds('2012:029', '2012:030', type='command_hw')
+    assert cache.info()['n_entries'] == 2
+    commands.get_cmds('2012:029', '2012:030', type='simtrans')
+    assert cache.info()['misses'] == 4
+
+    # New archive version clears the cache
+    key = cache.make_key(0, 10, {})
+    cache.set(key, 'new-version', commands._find(), 0)
+    assert cache.info()['n_entries'] == 1
+
+
+def test_cmds_cache_archive_swap(monkeypatch):
+    """Cached results are not used for a different archive with the same generation"""
+    cache = commands.CmdsCache(max_entries=2)
+    monkeypatch.setattr(commands, 'CMDS_CACHE', cache)
+    archive = commands.ARCHIVE.get()
+    cs1 = commands.get_cmds('2012:029', '2012:030', type='simtrans')
+    assert len(cs1) == 2
+
+    # Same commands except the first SIMTRANS, in an archive with the same generation
+    idx_cmds = Table(archive.idx_cmds, copy=True)
+    row = np.flatnonzero(idx_cmds['date'] == cs1['date'][0].encode('ascii'))[0]
+    idx_cmds['type'][row] = 'COMMAND_HW'
+    handle = commands.ArchiveHandle()
+    handle._archive = commands.CommandsArchive(archive.generation, idx_cmds=idx_cmds,
+                                               pars_store=archive.pars_store)
+    monkeypatch.setattr(commands, 'ARCHIVE', handle)
+
+    cs2 = commands.get_cmds('2012:029', '2012:030', type='simtrans')
+    assert np.all(cs2['date'] == cs1['date'][1:])
+    assert cache.info()['hits'] == 0
+
+
 def test_get_cmds_zero_length_result():
     cmds = commands.get_cmds(date='2017:001')
     assert len(cmds) == 0
-    assert cmds.colnames == ['idx', 'date', 'type', 'tlmsid', 'scs',
+    assert cmds.colnames == ['idx', 'date', 'time', 'type', 'tlmsid', 'scs',
                              'step', 'timeline_id', 'vcdu', 'params']
 
 
+def test_get_cmds_time(tmp_path, monkeypatch):
+    cmds = commands.get_cmds('2012:029', '2012:030')
+    assert cmds['time'].dtype == np.float64
+    assert np.allclose(cmds['time'], DateTime(cmds['date']).secs, rtol=0, atol=1e-6)
+
+    # Time range in CXC seconds is the same as by date
+    cmds2 = commands.get_cmds(DateTime('2012:029').secs, DateTime('2012:030').secs)
+    assert np.all(cmds2['date'] == cmds['date'])
+
+    # Filter on time
+    time0 = cmds['time'][10]
+    cmds2 = commands.get_cmds('2012:029', '2012:030', time__gte=time0)
+    assert np.all(cmds2['date'] == cmds['date'][10:])
+
+    # Archive from older update_cmds without the time column
+    names = [name for name in cmds.colnames if name not in ('time', 'params')]
+    old_cmds = np.array(cmds[names])
+    monkeypatch.setenv('KADI', str(tmp_path))
+    with tables.open_file(str(tmp_path / 'cmds.h5'), mode='w') as h5:
+        h5.create_table(h5.root, 'data', old_cmds, 'cmds')
+    with pytest.warns(UserWarning, match='Run update_cmds'):
+        idx_cmds = commands.load_idx_cmds()
+    assert idx_cmds.colnames[:3] == ['idx', 'date', 'time']
+    assert np.all(idx_cmds['time'] == cmds['time'])
+
+    # Migrate the HDF5 archive to include the time column
+    with tables.open_file(str(tmp_path / 'cmds.h5'), mode='a') as h5:
+        h5d = update_cmds.add_h5_time_column(h5)
+        assert h5d.colnames == [name for name, _ in update_cmds.CMDS_DTYPE]
+        assert np.all(h5d.cols.time[:] == cmds['time'])
+
+
+def test_get_matching_block():
+    """Hash-based matching block is the first large block found by difflib"""
+    import difflib
+
+    cmds = np.array(commands._find('2012:020', '2012:040'))
+    # Existing commands from a replanned schedule: a command removed and a
+    # different set of commands at the end.
+    rows_a = np.concatenate([cmds[:300], cmds[301:1500], cmds[-200:]])
+    key_names = list(update_cmds.KEY_NAMES)
+    for rows_b in (cmds[100:], cmds[100:1200], cmds[1000:1400]):
+        block = update_cmds.get_matching_block(rows_a, rows_b, 500)
+        vals_a = [tuple(row[key_names]) for row in rows_a]
+        vals_b = [tuple(row[key_names]) for row in rows_b]
+        diff = difflib.SequenceMatcher(a=vals_a, b=vals_b, autojunk=False)
+        exp_blocks = [blk for blk in diff.get_matching_blocks() if blk.size > 500]
+        if exp_blocks:
+            assert tuple(block) == tuple(exp_blocks[0])
+        else:
+            assert block is None
+
+    hashes = update_cmds.get_row_hashes(cmds)
+    assert len(np.unique(hashes)) == len({tuple(row[key_names]) for row in cmds})
+
+
+def test_get_matching_blocks_difflib():
+    """Matching blocks are the large difflib blocks for repeated rows and crossing blocks"""
+    import difflib
+
+    x = list(range(100))
+    x100 = [val + 100 for val in x]
+    dup = [1000, 1001, 1002] * 20  # Block with no rows that are unique
+    cases = [(x + dup, dup + x[::-1]),
+             (dup + x, x[:5] + dup + x),
+             # Crossing blocks, where difflib takes the longest first
+             (x, x[60:] + x[:60]),
+             (x + x100, x100 + x[:50] + x)]
+    for vals_a, vals_b in cases:
+        rows_a = np.zeros(len(vals_a), dtype=update_cmds.CMDS_DTYPE)
+        rows_a['step'] = vals_a
+        rows_b = np.zeros(len(vals_b), dtype=update_cmds.CMDS_DTYPE)
+        rows_b['step'] = vals_b
+
+        blocks = update_cmds.get_matching_blocks(rows_a, rows_b, 20)
+        diff = difflib.SequenceMatcher(a=vals_a, b=vals_b, autojunk=False)
+        exp_blocks = [tuple(blk) for blk in diff.get_matching_blocks() if blk.size > 20]
+        assert exp_blocks
+        assert [tuple(blk) for blk in blocks[:-1]] == exp_blocks
+        assert tuple(blocks[-1]) == (len(vals_a), len(vals_b), 0)
+        assert tuple(update_cmds.get_matching_block(rows_a, rows_b, 20)) == exp_blocks[0]
+
+    # Rows outside the blocks, as difflib opcodes
+    blocks = [update_cmds.Match(0, 40, 60), update_cmds.Match(100, 100, 0)]
+    assert update_cmds.get_diff_ranges(blocks) == [('insert', 0, 0, 0, 40),
+                                                   ('delete', 60, 100, 100, 100)]
+
+
+def test_get_unique_orbit_cmds():
+    """Vectorized orbit cmds de-duplication matches the original sequential one"""
+    def get_unique_orbit_cmds_seq(orbit_cmds):
+        orbit_cmds = sorted(orbit_cmds, key=lambda y: (y['params']['EVENT_TYPE'], y['date']))
+        uniq_cmds = [orbit_cmds[0]]
+        for cmd in orbit_cmds:
+            last_cmd = uniq_cmds[-1]
+            if (cmd['params']['EVENT_TYPE'] == last_cmd['params']['EVENT_TYPE'] and
+                    abs(DateTime(cmd['date']).secs - DateTime(last_cmd['date']).secs) < 180):
+                if cmd['timeline_id'] > last_cmd['timeline_id']:
+                    uniq_cmds[-1] = cmd
+            else:
+                uniq_cmds.append(cmd)
+        uniq_cmds.sort(key=lambda y: y['date'])
+        return uniq_cmds
+
+    # Orbit events from overlapping schedules, including chains of repeats
+    # within 3 minutes and exact duplicate dates.
+    np.random.seed(0)
+    n_cmds = 2000
+    secs = DateTime('2018:001').secs + np.sort(np.random.uniform(0, 86400 * 10, n_cmds))
+    secs[1::7] = secs[0:-1:7] + np.random.uniform(0, 200, len(secs[1::7]))
+    secs[2::11] = secs[1:-1:11]
+    dates = DateTime(secs).date
+    event_types = np.random.choice(['EPERIGEE', 'EAPOGEE', 'EEF1000', 'XEF1000'], n_cmds)
+    timeline_ids = np.random.randint(1, 20, n_cmds)
+    orbit_cmds = [{'date': date, 'type': 'ORBPOINT', 'timeline_id': int(timeline_id),
+                   'params': {'EVENT_TYPE': event_type}}
+                  for date, event_type, timeline_id in zip(dates, event_types, timeline_ids)]
+
+    uniq_cmds = update_cmds.get_unique_orbit_cmds(orbit_cmds)
+    exp = get_unique_orbit_cmds_seq(orbit_cmds)
+    assert len(exp) < n_cmds
+    assert len(uniq_cmds) == len(exp)
+    assert all(cmd is exp_cmd for cmd, exp_cmd in zip(uniq_cmds, exp))
+
+    assert update_cmds.get_unique_orbit_cmds([]) == []
+
+
+def test_get_idx_cmds(tmp_path, monkeypatch):
+    """Bulk parameter interning matches the original per-command conversion"""
+    def get_idx_cmds_seq(cmds, pars_dict):
+        idx_cmds = []
+        for cmd in cmds:
+            pars = cmd['params']
+            keys = set(pars.keys()) - set(('SCS', 'STEP', 'TLMSID'))
+            if cmd['tlmsid'] == 'AOSTRCAT':
+                pars_tup = ()
+            else:
+                pars_tup = tuple((key.lower(), pars[key]) for key in sorted(keys))
+            par_idx = pars_dict.setdefault(pars_tup, len(pars_dict))
+            idx_cmds.append((par_idx, cmd['date'], DateTime(cmd['date']).secs, cmd['type'],
+                             cmd.get('tlmsid'), cmd['scs'], cmd['step'], cmd['timeline_id'],
+                             cmd['vcdu']))
+        return np.array(idx_cmds, dtype=update_cmds.CMDS_DTYPE)
+
+    monkeypatch.setattr(update_cmds, 'logger', logging.getLogger('kadi'))
+    monkeypatch.setenv('KADI_BACKSTOP_CACHE', str(tmp_path / 'cache'))
+    bs_file = Path(parse_cm.tests.__file__).parent / 'data' / 'CR182_0803.backstop'
+    cmds = update_cmds.read_backstop(bs_file)
+    for cmd in cmds:
+        cmd['timeline_id'] = 1
+
+    # Start from existing parameter sets for part of the commands
+    exp_pars_dict = {}
+    get_idx_cmds_seq(cmds[100:200], exp_pars_dict)
+    n_pars = len(exp_pars_dict)
+    exp = get_idx_cmds_seq(cmds, exp_pars_dict)
+
+    pars_dict = update_cmds.UpdatedDict()
+    get_idx_cmds_seq(cmds[100:200], pars_dict)
+    pars_dict.n_updated = 0
+    idx_cmds = update_cmds.get_idx_cmds(cmds, pars_dict)
+    assert idx_cmds.dtype == np.dtype(update_cmds.CMDS_DTYPE)
+    assert np.all(idx_cmds == exp)
+    assert list(pars_dict.items()) == list(exp_pars_dict.items())
+    assert pars_dict.n_updated == len(exp_pars_dict) - n_pars
+
+    # Unique parameter tuples in order of first appearance
+    pars_tups, codes = update_cmds.get_pars_tups(cmds)
+    assert len(pars_tups) == len(set(pars_tups))
+    assert np.all(np.diff(np.maximum.accumulate(codes)) <= 1)
+    assert [exp_pars_dict[pars_tups[code]] for code in codes] == list(exp['idx'])
+
+
+def test_read_backstop_files(tmp_path, monkeypatch):
+    """Reading backstop files in a process pool gives the same as serial"""
+    monkeypatch.setattr(update_cmds, 'logger', logging.getLogger('kadi'))
+    monkeypatch.setenv('KADI_BACKSTOP_CACHE', str(tmp_path / 'cache'))
+    bs_file = Path(parse_cm.tests.__file__).parent / 'data' / 'CR182_0803.backstop'
+    bs_files = []
+    for ii in range(3):
+        bs_files.append(str(tmp_path / f'CR182_080{ii}.backstop'))
+        shutil.copy(bs_file, bs_files[-1])
+    bs_files.append(bs_files[0])
+
+    monkeypatch.setattr(update_cmds, 'BACKSTOP_CACHE', {})
+    exp = update_cmds.read_backstop_files(bs_files)
+    monkeypatch.setattr(update_cmds, 'BACKSTOP_CACHE', {})
+    bs_cmds_files = update_cmds.read_backstop_files(bs_files, jobs=2)
+    assert list(bs_cmds_files) == list(exp)
+    for bs_file in bs_files:
+        assert bs_cmds_files[bs_file] == exp[bs_file]
+    assert update_cmds.read_backstop_files(bs_files[:1])[bs_files[0]] is bs_cmds_files[bs_files[0]]
+
+
 def test_get_cmds_from_backstop_and_add_cmds():
     bs_file = Path(parse_cm.tests.__file__).parent / 'data' / 'CR182_0803.backstop'
     bs_cmds = commands.get_cmds_from_backstop(bs_file)
@@ -84,6 +723,18 @@ def test_get_cmds_from_backstop_and_add_cmds():
     new_cmds = cmds.add_cmds(bs_cmds)
     assert len(new_cmds) == len(cmds) + len(bs_cmds)
 
+    # Merge gives the same as stacking and sorting
+    exp_cmds = vstack([cmds, bs_cmds])
+    exp_cmds.sort(['date', 'step', 'scs'], kind='stable')
+    for name in ('date', 'step', 'scs', 'idx', 'tlmsid'):
+        assert np.all(new_cmds[name] == exp_cmds[name])
+
+    # Replace commands in the date range of the backstop commands
+    new_cmds = cmds.add_cmds(bs_cmds, replace=True)
+    ok = (cmds['date'] < bs_cmds['date'][0]) | (cmds['date'] > bs_cmds['date'][-1])
+    assert len(new_cmds) == np.count_nonzero(ok) + len(bs_cmds)
+    assert np.all(new_cmds['date'][1:] >= new_cmds['date'][:-1])
+
     # No MP_STARCAT commands by default
     assert not np.any(bs_cmds['type'] == 'MP_STARCAT')
 
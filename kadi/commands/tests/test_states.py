@@ -780,6 +780,12 @@ def test_backstop_sun_pos_mon_lunar():
     assert np.all(sts['datestart'] == spm['datestart'])
     assert np.all(sts['sun_pos_mon'] == spm['sun_pos_mon'])
 
+    # Same for user-supplied commands without a time column
+    cmds.remove_column('time')
+    sts = states.get_states(state_keys=['sun_pos_mon'], cmds=cmds)
+    assert np.all(sts['datestart'] == spm['datestart'])
+    assert np.all(sts['sun_pos_mon'] == spm['sun_pos_mon'])
+
 
 def test_backstop_ephem_update():
     history = """
@@ -18,5 +18,14 @@ def IDX_CMDS_PATH():
     return os.path.join(DATA_DIR(), 'cmds.h5')
 
 
+def IDX_CMDS_NPY_DIR():
+    return os.path.join(DATA_DIR(), 'cmds_npy')
+
+
 def PARS_DICT_PATH():
     return os.path.join(DATA_DIR(), 'cmds.pkl')
+
+
+def BACKSTOP_CACHE_DIR():
+    return os.environ.get('KADI_BACKSTOP_CACHE',
+                          os.path.join(os.path.expanduser('~'), '.kadi', 'backstop_cache'))
@@ -1,8 +1,11 @@
 # Licensed under a 3-clause BSD style license - see LICENSE.rst
 import os
 import argparse
-import difflib
+import collections
+import concurrent.futures
+import json
 import pickle
+import shutil
 from pathlib import Path
 
 import numpy as np
@@ -15,13 +18,15 @@ from Chandra.Time import DateTime
 from Chandra.cmd_states.cmd_states import _tl_to_bs_cmds
 from ska_helpers.run_info import log_run_info
 
-from .paths import IDX_CMDS_PATH, PARS_DICT_PATH
+from .paths import IDX_CMDS_PATH, IDX_CMDS_NPY_DIR, PARS_DICT_PATH
+from .commands import backstop
 from . import __version__
 
 MIN_MATCHING_BLOCK_SIZE = 500
 BACKSTOP_CACHE = {}
 CMDS_DTYPE = [('idx', np.uint16),
               ('date', '|S21'),
+              ('time', np.float64),
               ('type', '|S12'),
               ('tlmsid', '|S10'),
               ('scs', np.uint8),
@@ -29,6 +34,19 @@ CMDS_DTYPE = [('idx', np.uint16),
               ('timeline_id', np.uint32),
               ('vcdu', np.int32)]
 
+# Number of rows at the end of the commands table in the digest that
+# identifies the HDF5 archive in the .npy archive header
+NPY_DIGEST_ROWS = 100
+
+# Columns of the commands table with a persisted index in the archive
+INDEX_NAMES = ('type', 'tlmsid', 'idx')
+
+# Column names that specify a complete and unique row of the commands table
+KEY_NAMES = ('date', 'type', 'tlmsid', 'scs', 'step', 'timeline_id', 'vcdu')
+
+# Block of rows ``a[a:a + size]`` matching ``b[b:b + size]`` (as for difflib)
+Match = collections.namedtuple('Match', ['a', 'b', 'size'])
+
 logger = None  # This is set as a global in main.  Define here for pyflakes.
 
 
@@ -62,6 +80,10 @@ def get_opt(args=None):
     parser.add_argument("--data-root",
                         default='.',
                         help="Data root (default='.')")
+    parser.add_argument("--jobs",
+                        type=int,
+                        default=1,
+                        help="Number of processes for reading backstop files (default=1)")
     parser.add_argument('--version', action='version',
                         version='%(prog)s {version}'.format(version=__version__))
 
@@ -116,11 +138,15 @@ def fix_nonload_cmds(nl_cmds):
     return new_cmds
 
 
-def get_cmds(start, stop, mp_dir='/data/mpcrit1/mplogs'):
+def get_cmds(start, stop, mp_dir='/data/mpcrit1/mplogs', jobs=1):
     """
     Get backstop commands corresponding to the supplied timeline load segments.
     The timeline load segments must be ordered by 'id'.
 
+    The backstop files for the timelines are read in ``jobs`` processes (see
+    ``read_backstop_files()``) and then the commands for each timeline are
+    selected in timeline order, so the output does not depend on ``jobs``.
+
     Return cmds in the format defined by Ska.ParseCM.read_backstop().
     """
     # Get timeline_loads within date range.  Also get non-load commands
@@ -151,19 +177,22 @@ def get_cmds(start, stop, mp_dir='/data/mpcrit1/mplogs'):
     if np.min(np.diff(timeline_loads['id'])) < 1:
         raise ValueError('Timeline loads id not monotonically increasing')
 
+    bs_files = [Ska.File.get_globfiles(os.path.join(mp_dir + tl.mp_dir, '*.backstop'))[0]
+                for tl in timeline_loads]
+    bs_cmds_files = read_backstop_files(bs_files, jobs)
+
     cmds = []
     orbit_cmds = []
     orbit_cmd_files = set()
+    bs_dates_scs = {}
 
-    for tl in timeline_loads:
-        bs_file = Ska.File.get_globfiles(os.path.join(mp_dir + tl.mp_dir,
-                                                      '*.backstop'))[0]
-        if bs_file not in BACKSTOP_CACHE:
-            bs_cmds = read_backstop(bs_file)
-            logger.info('Read {} commands from {}'.format(len(bs_cmds), bs_file))
-            BACKSTOP_CACHE[bs_file] = bs_cmds
-        else:
-            bs_cmds = BACKSTOP_CACHE[bs_file]
+    for tl, bs_file in zip(timeline_loads, bs_files):
+        bs_cmds = bs_cmds_files[bs_file]
+        if bs_file not in bs_dates_scs:
+            bs_dates_scs[bs_file] = (
+                np.array([x['date'] for x in bs_cmds], dtype=str),
+                np.array([-1 if x['scs'] is None else x['scs'] for x in bs_cmds], dtype=int))
+        bs_dates, bs_scs = bs_dates_scs[bs_file]
 
         # Process ORBPOINT (orbit event) pseudo-commands in backstop.  These
         # have scs=0 and need to be treated separately since during a replan
@@ -180,9 +209,9 @@ def get_cmds(start, stop, mp_dir='/data/mpcrit1/mplogs'):
             orbit_cmd_files.add(bs_file)
 
         # Only store commands for this timeline (match SCS and date)
-        bs_cmds = [x for x in bs_cmds
-                   if tl['datestart'] <= x['date'] <= tl['datestop']
-                   and x['scs'] == tl['scs']]
+        ok = ((bs_dates >= tl['datestart']) & (bs_dates <= tl['datestop'])
+              & (bs_scs == tl['scs']))
+        bs_cmds = [bs_cmds[ii] for ii in np.flatnonzero(ok)]
 
         for bs_cmd in bs_cmds:
             bs_cmd['timeline_id'] = tl['id']
@@ -206,37 +235,125 @@ def get_cmds(start, stop, mp_dir='/data/mpcrit1/mplogs'):
     return cmds
 
 
+def read_backstop_files(bs_files, jobs=1):
+    """
+    Read backstop files ``bs_files``, using a pool of ``jobs`` processes if
+    ``jobs`` > 1.
+
+    Files are read once and kept in ``BACKSTOP_CACHE`` for this process.
+
+    :param bs_files: list of backstop file names (may have duplicates)
+    :param jobs: number of processes (default=1)
+    :returns: dict of file name => list of dict for each command
+    """
+    new_files = [bs_file for bs_file in dict.fromkeys(bs_files)
+                 if bs_file not in BACKSTOP_CACHE]
+    if jobs > 1 and len(new_files) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+            new_cmds = list(pool.map(read_backstop, new_files))
+    else:
+        new_cmds = (read_backstop(bs_file) for bs_file in new_files)
+
+    for bs_file, bs_cmds in zip(new_files, new_cmds):
+        logger.info('Read {} commands from {}'.format(len(bs_cmds), bs_file))
+        BACKSTOP_CACHE[bs_file] = bs_cmds
+
+    return {bs_file: BACKSTOP_CACHE[bs_file] for bs_file in bs_files}
+
+
 def get_unique_orbit_cmds(orbit_cmds):
     """
     Given list of ``orbit_cmds`` find the quasi-unique set.  In the event of a
     replan/reopen or other schedule oddity, it can happen that there are multiple cmds
     that describe the same orbit event.  Since the detailed timing might change between
     schedule runs, cmds are considered the same if the date is within 3 minutes.
+
+    Stepping through the cmds sorted by (event_type, date), a cmd is the same
+    event as the last unique cmd if it has the same event type and is within
+    3 minutes of it, and in that case it replaces the last unique cmd if it
+    has a larger timeline_id (more recent schedule).  A cmd that is 3 minutes
+    or more after the previous cmd of the same event type always starts a new
+    event, so the cmds are first split into groups at those gaps using numeric
+    arrays of event type, time and timeline_id, and only the (few) groups with
+    more than one cmd are stepped through.
     """
     if len(orbit_cmds) == 0:
         return []
 
+    event_types = np.array([cmd['params']['EVENT_TYPE'] for cmd in orbit_cmds])
+    dates = np.array([cmd['date'] for cmd in orbit_cmds])
     # Sort by (event_type, date)
-    orbit_cmds.sort(key=lambda y: (y['params']['EVENT_TYPE'], y['date']))
-
-    uniq_cmds = [orbit_cmds[0]]
-    # Step through one at a time and add to uniq_cmds only if the candidate is
-    # "different" from uniq_cmds[-1].
-    for cmd in orbit_cmds:
-        last_cmd = uniq_cmds[-1]
-        if (cmd['params']['EVENT_TYPE'] == last_cmd['params']['EVENT_TYPE']
-                and abs(DateTime(cmd['date']).secs - DateTime(last_cmd['date']).secs) < 180):
-            # Same event as last (even if date is a bit different).  Now if this one
-            # has a larger timeline_id that means it is from a more recent schedule, so
-            # use that one.
-            if cmd['timeline_id'] > last_cmd['timeline_id']:
-                uniq_cmds[-1] = cmd
+    order = np.lexsort((dates, event_types))
+    event_types = event_types[order]
+    dates = dates[order]
+    times = DateTime(dates).secs
+    timeline_ids = np.array([orbit_cmds[ii]['timeline_id'] for ii in order])
+
+    # Start a new group at each change of event type or gap of at least 180 sec
+    starts = np.flatnonzero(np.r_[True, (event_types[1:] != event_types[:-1])
+                                  | (np.abs(np.diff(times)) >= 180)])
+    stops = np.r_[starts[1:], len(times)]
+    single = stops - starts == 1
+    uniq_idxs = list(starts[single])
+
+    for i0, i1 in zip(starts[~single], stops[~single]):
+        last = i0
+        for ii in range(i0 + 1, i1):
+            if abs(times[ii] - times[last]) < 180:
+                # Same event as last (even if date is a bit different).  Now if this one
+                # has a larger timeline_id that means it is from a more recent schedule,
+                # so use that one.
+                if timeline_ids[ii] > timeline_ids[last]:
+                    last = ii
+            else:
+                uniq_idxs.append(last)
+                last = ii
+        uniq_idxs.append(last)
+
+    # Unique cmds in (event_type, date) order, then sorted by date
+    uniq_idxs = np.sort(uniq_idxs)
+    uniq_idxs = uniq_idxs[np.argsort(dates[uniq_idxs], kind='stable')]
+
+    return [orbit_cmds[order[ii]] for ii in uniq_idxs]
+
+
+def get_pars_tups(cmds):
+    """
+    Get the parameter tuples for ``cmds`` as the list of unique tuples and the
+    index of each cmd into that list.
+
+    The parameter tuple of a cmd is ``((key, val), ...)`` for the parameters
+    except SCS, STEP and TLMSID, with lower-case keys in sorted order, or ``()``
+    for a star catalog (AOSTRCAT) command.  The keys are sorted and lower-cased
+    once for each distinct set of parameter names, and equal tuples are shared.
+
+    :param cmds: list of dict for each command
+    :returns: list of unique parameter tuples in order of first appearance,
+        np.ndarray of index into that list for each cmd
+    """
+    key_orders = {}
+    pars_idxs = {}
+    codes = np.empty(len(cmds), dtype=np.int64)
+
+    for i, cmd in enumerate(cmds):
+        if cmd['tlmsid'] == 'AOSTRCAT':
+            # Skip star catalog command because that has many (uninteresting) parameters
+            # and increases the file size and load speed by an order of magnitude.
+            pars_tup = ()
         else:
-            uniq_cmds.append(cmd)
+            pars = cmd['params']
+            names = tuple(pars)
+            try:
+                keys, lower_keys = key_orders[names]
+            except KeyError:
+                keys = sorted(set(names) - set(('SCS', 'STEP', 'TLMSID')))
+                lower_keys = [key.lower() for key in keys]
+                key_orders[names] = keys, lower_keys
+            pars_tup = tuple(zip(lower_keys, map(pars.__getitem__, keys)))
 
-    uniq_cmds.sort(key=lambda y: y['date'])
+        codes[i] = pars_idxs.setdefault(pars_tup, len(pars_idxs))
 
-    return uniq_cmds
+    return list(pars_idxs), codes
 
 
 def get_idx_cmds(cmds, pars_dict):
@@ -245,33 +362,37 @@ def get_idx_cmds(cmds, pars_dict):
     parameters are specified as an index into `pars_dict`, a dict of unique parameter
     values.
 
-    Returns `idx_cmds` as a list of tuples:
-       (par_idx, date, time, cmd, tlmsid, scs, step, timeline_id, vcdu)
-    """
-    idx_cmds = []
+    The unique parameter tuples are found with ``get_pars_tups`` and only those
+    are looked up in ``pars_dict``, with new tuples added in order of first
+    appearance in ``cmds``.
 
-    for i, cmd in enumerate(cmds):
-        if i % 10000 == 9999:
-            logger.info('   Iteration {}'.format(i))
-
-        # Define a consistently ordered tuple that has all command parameter information
-        pars = cmd['params']
-        keys = set(pars.keys()) - set(('SCS', 'STEP', 'TLMSID'))
-        if cmd['tlmsid'] == 'AOSTRCAT':
-            # Skip star catalog command because that has many (uninteresting) parameters
-            # and increases the file size and load speed by an order of magnitude.
-            pars_tup = ()
-        else:
-            pars_tup = tuple((key.lower(), pars[key]) for key in sorted(keys))
+    Returns `idx_cmds` as a structured array with dtype ``CMDS_DTYPE``:
+       (idx, date, time, type, tlmsid, scs, step, timeline_id, vcdu)
+    """
+    idx_cmds = np.zeros(len(cmds), dtype=CMDS_DTYPE)
+    if len(cmds) == 0:
+        return idx_cmds
 
+    pars_tups, codes = get_pars_tups(cmds)
+    par_idxs = np.empty(len(pars_tups), dtype=np.int64)
+    for ii, pars_tup in enumerate(pars_tups):
         try:
             par_idx = pars_dict[pars_tup]
         except KeyError:
             par_idx = len(pars_dict)
             pars_dict[pars_tup] = par_idx
+        par_idxs[ii] = par_idx
+    idx_cmds['idx'] = par_idxs[codes]
+
+    dates = [cmd['date'] for cmd in cmds]
+    idx_cmds['date'] = dates
+    idx_cmds['time'] = DateTime(dates).secs
+    idx_cmds['tlmsid'] = [cmd.get('tlmsid') for cmd in cmds]
+    for name in ('type', 'scs', 'step', 'timeline_id', 'vcdu'):
+        idx_cmds[name] = [cmd[name] for cmd in cmds]
 
-        idx_cmds.append((par_idx, cmd['date'], cmd['type'], cmd.get('tlmsid'),
-                         cmd['scs'], cmd['step'], cmd['timeline_id'], cmd['vcdu']))
+    logger.info('Converted {} commands to indexed format ({} parameter sets)'
+                .format(len(cmds), len(pars_dict)))
 
     return idx_cmds
 
@@ -285,8 +406,8 @@ def add_h5_cmds(h5file, idx_cmds):
     # for read speed and do not use compression.
     h5 = tables.open_file(h5file, mode='a')
 
-    # Convert cmds (list of tuples) to numpy structured array.  This also works for an
-    # existing structured array.
+    # Convert cmds (structured array from get_idx_cmds or list of tuples) to numpy
+    # structured array.
     cmds = np.array(idx_cmds, dtype=CMDS_DTYPE)
 
     # TODO : make sure that changes in non-load commands triggers an update
@@ -294,42 +415,37 @@ def add_h5_cmds(h5file, idx_cmds):
     try:
         h5d = h5.root.data
         logger.info('Opened h5 cmds table {}'.format(h5file))
+        if 'time' not in h5d.colnames:
+            h5d = add_h5_time_column(h5)
+            logger.info('Added time column to h5 cmds table {}'.format(h5file))
     except tables.NoSuchNodeError:
         h5.create_table(h5.root, 'data', cmds, "cmds", expectedrows=2e6)
         logger.info('Created h5 cmds table {}'.format(h5file))
+        write_h5_indexes(h5, get_indexes(cmds), len(cmds))
     else:
-        date0 = min(idx_cmd[1] for idx_cmd in idx_cmds)
+        n_h5d = len(h5d)
+        date0 = min(cmds['date'])
         h5_date = h5d.cols.date[:]
         idx_recent = np.searchsorted(h5_date, date0)
         logger.info('Selecting commands from h5d[{}:]'.format(idx_recent))
         logger.info('  {}'.format(str(h5d[idx_recent])))
         h5d_recent = h5d[idx_recent:]  # recent h5d entries
 
-        # Define the column names that specify a complete and unique row
-        key_names = ('date', 'type', 'tlmsid', 'scs', 'step', 'timeline_id', 'vcdu')
-
-        h5d_recent_vals = [tuple(
-            row[x].decode('ascii') if isinstance(row[x], bytes) else str(row[x])
-            for x in key_names)
-            for row in h5d_recent]
-        idx_cmds_vals = [tuple(str(x) for x in row[1:]) for row in idx_cmds]
-
-        diff = difflib.SequenceMatcher(a=h5d_recent_vals, b=idx_cmds_vals, autojunk=False)
-        blocks = diff.get_matching_blocks()
+        # Find the first sufficiently long block of new commands that matches
+        # recent h5d entries.
+        blocks = get_matching_blocks(h5d_recent, cmds, MIN_MATCHING_BLOCK_SIZE)
         logger.info('Matching blocks for existing HDF5 and timeline commands')
         for block in blocks:
             logger.info('  {}'.format(block))
-        opcodes = diff.get_opcodes()
         logger.info('Diffs between existing HDF5 and timeline commands')
-        for opcode in opcodes:
-            logger.info('  {}'.format(opcode))
-        # Find the first matching block that is sufficiently long
-        for block in blocks:
-            if block.size > MIN_MATCHING_BLOCK_SIZE:
-                break
-        else:
+        for diff_range in get_diff_ranges(blocks):
+            logger.info('  {}'.format(diff_range))
+        if len(blocks) == 1:
             raise ValueError('No matching blocks at least {} long'
                              .format(MIN_MATCHING_BLOCK_SIZE))
+        block = blocks[0]
+        logger.info('  h5d[{}:{}] kept before block, cmds[0:{}] ignored before block'
+                    .format(idx_recent, idx_recent + block.a, block.b))
 
         # Index into idx_cmds at the end of the large matching block.  block.b is the
         # beginning of the match.
@@ -342,19 +458,308 @@ def add_h5_cmds(h5file, idx_cmds):
             if h5d_idx < len(h5d):
                 logger.debug('Deleted relative cmds indexes {} .. {}'.format(h5d_idx - idx_recent,
                                                                              len(h5d) - idx_recent))
-                logger.debug('Deleted cmds indexes {} .. {}'.format(h5d_idx, len(h5d)))
+                logger.info('Removed {} commands h5d[{}:{}] after block'
+                            .format(len(h5d) - h5d_idx, h5d_idx, len(h5d)))
                 h5d.truncate(h5d_idx)
 
             h5d.append(cmds[idx_cmds_idx:])
-            logger.info('Added {} commands to HDF5 cmds table'.format(len(cmds[idx_cmds_idx:])))
+            logger.info('Added {} commands cmds[{}:{}] after block to HDF5 cmds table'
+                        .format(len(cmds) - idx_cmds_idx, idx_cmds_idx, len(cmds)))
+            update_h5_indexes(h5, n_h5d, min(h5d_idx, n_h5d), cmds[idx_cmds_idx:])
         else:
             logger.info('No new timeline commands, HDF5 cmds table not updated')
+            update_h5_indexes(h5, n_h5d, n_h5d, cmds[:0])
 
     h5.flush()
     logger.info('Upated HDF5 cmds table {}'.format(h5file))
     h5.close()
 
 
+def get_row_hashes(rows):
+    """
+    Get a 64-bit hash (FNV-1a) of the ``KEY_NAMES`` columns of each row of the
+    commands structured array ``rows``.
+
+    :param rows: structured array with ``CMDS_DTYPE`` columns
+    :returns: uint64 array
+    """
+    dtypes = dict(CMDS_DTYPE)
+    hashes = np.full(len(rows), 14695981039346656037, dtype=np.uint64)
+    prime = np.uint64(1099511628211)
+    for name in KEY_NAMES:
+        col = np.ascontiguousarray(rows[name], dtype=dtypes[name])
+        col_bytes = col.view(np.uint8).reshape(len(rows), col.dtype.itemsize)
+        for ii in range(col.dtype.itemsize):
+            hashes ^= col_bytes[:, ii]
+            hashes *= prime
+    return hashes
+
+
+def get_matching_blocks(rows_a, rows_b, min_size):
+    """
+    Find the blocks of more than ``min_size`` consecutive commands in ``rows_b``
+    that are the same as consecutive commands in ``rows_a``.
+
+    Commands are the same if all the ``KEY_NAMES`` columns are equal.  This
+    gives the blocks larger than ``min_size`` from
+    ``difflib.SequenceMatcher(a=rows_a, b=rows_b, autojunk=False).get_matching_blocks()``
+    but without comparing every pair of rows:
+
+    - Any block of more than ``min_size`` rows includes a row of ``rows_b``
+      whose position is a multiple of ``min_size + 1``.  The rows of ``rows_a``
+      with the same hash as one of these sample rows give the candidate offsets
+      between the row positions.
+    - For each candidate offset, the rows are compared along that offset to
+      find the runs of equal rows.
+    - As in difflib, the longest run (then lowest ``a``, then lowest ``b``) is
+      a block and the same is repeated for the rows before and after it, with
+      each run clipped to those rows.
+
+    :param rows_a: structured array of commands (e.g. the HDF5 commands)
+    :param rows_b: structured array of commands (e.g. the new commands)
+    :param min_size: block size must be larger than this
+    :returns: list of Match(a, b, size) sorted by ``a`` and ``b``, followed by
+        ``Match(len(rows_a), len(rows_b), 0)`` as for difflib
+    """
+    n_a, n_b = len(rows_a), len(rows_b)
+    hashes_a = get_row_hashes(rows_a)
+    hashes_b = get_row_hashes(rows_b)
+    order = np.argsort(hashes_a, kind='stable')
+    samples = np.arange(0, n_b, min_size + 1)
+    lo = np.searchsorted(hashes_a[order], hashes_b[samples], side='left')
+    hi = np.searchsorted(hashes_a[order], hashes_b[samples], side='right')
+    offsets = np.unique(np.concatenate([np.zeros(0, dtype=np.int64)]
+                                       + [order[i0:i1] - j for i0, i1, j in zip(lo, hi, samples)]))
+
+    runs = []
+    for offset in offsets:
+        # Compare rows_a[j + offset] and rows_b[j] for j in j0:j1
+        j0, j1 = max(0, -offset), min(n_b, n_a - offset)
+        same = np.ones(j1 - j0, dtype=bool)
+        for name in KEY_NAMES:
+            same &= rows_a[name][j0 + offset:j1 + offset] == rows_b[name][j0:j1]
+        edges = np.diff(np.r_[0, same.astype(np.int8), 0])
+        starts = np.flatnonzero(edges == 1)
+        sizes = np.flatnonzero(edges == -1) - starts
+        runs.extend(Match(int(j0 + start + offset), int(j0 + start), int(size))
+                    for start, size in zip(starts, sizes) if size > min_size)
+
+    blocks = []
+    queue = [(0, n_a, 0, n_b)]
+    while queue:
+        alo, ahi, blo, bhi = queue.pop()
+        best = None
+        for run in runs:
+            k0 = max(0, alo - run.a, blo - run.b)
+            k1 = min(run.size, ahi - run.a, bhi - run.b)
+            if k1 - k0 > min_size:
+                key = (k0 - k1, run.a + k0, run.b + k0)
+                if best is None or key < best:
+                    best = key
+        if best is not None:
+            size, a, b = -best[0], best[1], best[2]
+            blocks.append(Match(a, b, size))
+            queue.append((alo, a, blo, b))
+            queue.append((a + size, ahi, b + size, bhi))
+
+    blocks.sort()
+    blocks.append(Match(n_a, n_b, 0))
+    return blocks
+
+
+def get_matching_block(rows_a, rows_b, min_size):
+    """
+    Find the first block of more than ``min_size`` consecutive commands in
+    ``rows_b`` that are the same as consecutive commands in ``rows_a`` (see
+    ``get_matching_blocks()``).
+
+    :param rows_a: structured array of commands (e.g. the HDF5 commands)
+    :param rows_b: structured array of commands (e.g. the new commands)
+    :param min_size: block size must be larger than this
+    :returns: Match(a, b, size) or None if no block
+    """
+    blocks = get_matching_blocks(rows_a, rows_b, min_size)
+    return blocks[0] if len(blocks) > 1 else None
+
+
+def get_diff_ranges(blocks):
+    """
+    Get the ranges of rows outside the matching ``blocks`` from
+    ``get_matching_blocks()``, as difflib opcodes ``(tag, i1, i2, j1, j2)``
+    with tag 'replace', 'delete' or 'insert'.
+
+    Rows in these ranges differ except for runs of at most ``min_size`` equal rows.
+
+    :param blocks: list of Match(a, b, size)
+    :returns: list of (tag, i1, i2, j1, j2)
+    """
+    ranges = []
+    i = j = 0
+    for block in blocks:
+        if i < block.a or j < block.b:
+            tag = ('replace' if i < block.a and j < block.b
+                   else 'delete' if i < block.a else 'insert')
+            ranges.append((tag, i, block.a, j, block.b))
+        i, j = block.a + block.size, block.b + block.size
+    return ranges
+
+
+def add_h5_time_column(h5):
+    """
+    Add the ``time`` column (CXC seconds) to the commands table in open HDF5
+    file ``h5`` that was created by an older version of this module.
+
+    :param h5: tables.File opened for writing
+    :returns: new commands table node
+    """
+    old_cmds = h5.root.data[:]
+    cmds = np.zeros(len(old_cmds), dtype=CMDS_DTYPE)
+    for name in old_cmds.dtype.names:
+        cmds[name] = old_cmds[name]
+    cmds['time'] = DateTime(np.char.decode(old_cmds['date'], 'ascii')).secs
+
+    h5.remove_node(h5.root, 'data')
+    return h5.create_table(h5.root, 'data', cmds, "cmds", expectedrows=2e6)
+
+
+def get_indexes(cmds):
+    """
+    Build the indexes of the ``INDEX_NAMES`` columns of commands ``cmds``.
+
+    :param cmds: structured array of commands
+    :returns: dict of column name => RowIndex (``idx``) or ColumnIndex
+    """
+    from .commands.commands import ColumnIndex, RowIndex
+
+    return {name: (RowIndex.from_codes(cmds[name]) if name == 'idx'
+                   else ColumnIndex.from_column(cmds[name]))
+            for name in INDEX_NAMES}
+
+
+def read_h5_indexes(h5, n_rows=None):
+    """
+    Read the indexes of the ``INDEX_NAMES`` columns from the open HDF5 commands
+    archive ``h5``.
+
+    :param h5: tables.File
+    :param n_rows: number of rows of the commands table (default=current)
+    :returns: dict of column name => index or None if any index is not
+        available or not up to date
+    """
+    from .commands.commands import ColumnIndex, RowIndex, read_h5_index
+
+    indexes = {}
+    for name in INDEX_NAMES:
+        arrays = read_h5_index(h5, name, n_rows)
+        if arrays is None:
+            return None
+        indexes[name] = (RowIndex if name == 'idx' else ColumnIndex)(**arrays)
+    return indexes
+
+
+def write_h5_indexes(h5, indexes, n_rows):
+    """
+    Write ``indexes`` (dict of column name => index) to the ``/index`` group of
+    the open HDF5 commands archive ``h5``, replacing any existing indexes.
+
+    Each index is a group of arrays (``rows``, ``offsets`` and for ``type`` and
+    ``tlmsid`` the column ``values``), see ``kadi.commands.commands.RowIndex``.
+
+    :param h5: tables.File opened for writing
+    :param indexes: dict of indexes
+    :param n_rows: number of rows of the commands table
+    """
+    if '/index' in h5:
+        h5.remove_node('/index', recursive=True)
+    group = h5.create_group('/', 'index', 'Posting-list indexes of cmds table')
+    for name, index in indexes.items():
+        index_group = h5.create_group(group, name)
+        for arr_name, arr in index.get_arrays().items():
+            h5.create_array(index_group, arr_name, np.asarray(arr))
+    group._v_attrs.n_rows = n_rows
+
+
+def update_h5_indexes(h5, n_old, n_keep, new_cmds):
+    """
+    Update the indexes in the open HDF5 commands archive ``h5`` after the
+    commands table of ``n_old`` rows was truncated to ``n_keep`` rows and then
+    ``new_cmds`` were appended.
+
+    The existing indexes are updated incrementally.  If they are missing or not
+    up to date (e.g. the archive was written by an older version of this
+    module) then they are built from the full commands table.
+
+    :param h5: tables.File opened for writing
+    :param n_old: number of rows before the update
+    :param n_keep: number of rows kept before appending ``new_cmds``
+    :param new_cmds: structured array of appended commands
+    """
+    indexes = read_h5_indexes(h5, n_old)
+    if indexes is None:
+        indexes = get_indexes(h5.root.data[:])
+        logger.info('Built indexes of HDF5 cmds table')
+    elif n_keep == n_old and len(new_cmds) == 0:
+        return
+    else:
+        indexes = {name: index.truncate_append(n_keep, new_cmds[name])
+                   for name, index in indexes.items()}
+    write_h5_indexes(h5, indexes, n_keep + len(new_cmds))
+
+
+def write_npy_cmds(h5file, pars_dict, npy_dir):
+    """
+    Write the commands archive in HDF5 file `h5file` as one ``.npy`` file per
+    column in directory `npy_dir`, along with a ``header.json`` file that gives
+    the column names and number of rows.  The parameters in `pars_dict` are
+    written alongside as a columnar parameters store (``pars_*.npy``), as are
+    the column indexes from `h5file` (``index_*.npy``).
+
+    This is the version of the archive that ``kadi.commands`` memory-maps.  The
+    files are written to a temporary directory that is then swapped in place of
+    `npy_dir`, so readers never see a partially written archive.
+    """
+    from .commands.commands import ParsStore, get_cmds_digest, get_file_stat
+
+    h5 = tables.open_file(h5file, mode='r')
+    cmds = h5.root.data[:]
+    indexes = read_h5_indexes(h5)
+    h5.close()
+    if indexes is None:
+        indexes = get_indexes(cmds)
+
+    npy_dir = Path(npy_dir)
+    tmp_dir = npy_dir.with_name(npy_dir.name + '.tmp')
+    old_dir = npy_dir.with_name(npy_dir.name + '.old')
+    for pth in (tmp_dir, old_dir):
+        shutil.rmtree(pth, ignore_errors=True)
+
+    tmp_dir.mkdir(parents=True)
+    for name in cmds.dtype.names:
+        np.save(tmp_dir / f'{name}.npy', cmds[name])
+    pars_store = ParsStore.from_pars_dict(pars_dict)
+    pars_store.write(tmp_dir)
+    for name, index in indexes.items():
+        for arr_name, arr in index.get_arrays().items():
+            np.save(tmp_dir / f'index_{name}_{arr_name}.npy', arr)
+    # Identify the HDF5 archive and pars_dict file that this was written from,
+    # so readers can check that the .npy archive is up to date.
+    pars_stat = get_file_stat(PARS_DICT_PATH())
+    header = {'colnames': list(cmds.dtype.names),
+              'n_rows': len(cmds),
+              'n_tail': NPY_DIGEST_ROWS,
+              'digest': get_cmds_digest(cmds, NPY_DIGEST_ROWS),
+              'pars_dict_stat': None if pars_stat is None else list(pars_stat),
+              'n_pars': len(pars_store),
+              'indexes': list(indexes)}
+    with open(tmp_dir / 'header.json', 'w') as fh:
+        json.dump(header, fh)
+
+    if npy_dir.exists():
+        npy_dir.rename(old_dir)
+    tmp_dir.rename(npy_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
 def main(args=None):
     global logger
 
@@ -397,7 +802,7 @@ def main(args=None):
     stop = DateTime(opt.stop) if opt.stop else DateTime() + 21
     start = DateTime(opt.start) if opt.start else stop - 42
 
-    cmds = get_cmds(start, stop, opt.mp_dir)
+    cmds = get_cmds(start, stop, opt.mp_dir, jobs=opt.jobs)
     idx_cmds = get_idx_cmds(cmds, pars_dict)
     add_h5_cmds(idx_cmds_path, idx_cmds)
 
@@ -409,68 +814,23 @@ def main(args=None):
     else:
         logger.info('pars_dict was unmodified, not writing')
 
-
-def _coerce_type(val):
-    """Coerce the supplied ``val`` (typically a string) into an int or float if
-    possible, otherwise as a string.
-    """
-    try:
-        val = int(val)
-    except ValueError:
-        try:
-            val = float(val)
-        except ValueError:
-            val = str(val)
-    return val
-
-
-def parse_params(paramstr):
-    """
-    Parse parameters key1=val1,key2=val2,... from ``paramstr``
-
-    Parameter values are cast to the first type (int, float, or str) that
-    succeeds.
-
-    :param paramstr: Comma separated string of key=val pairs
-    :rtype: dict of key=val pairs
-    """
-    params = {}
-    for opt in paramstr.split(','):
-        try:
-            key, val = opt.split('=')
-            params[key] = val if key == 'HEX' else _coerce_type(val)
-        except Exception:
-            pass  # backstop has some quirks like blank or '??????' fields
-
-    return params
+    write_npy_cmds(idx_cmds_path, pars_dict, IDX_CMDS_NPY_DIR())
+    logger.info('Wrote memory-mappable cmds archive {}'.format(IDX_CMDS_NPY_DIR()))
 
 
 def read_backstop(filename):
     """
     Read commands from backstop file.
 
-    Create dict with keys as follows for each command.  ``paramstr`` is the
-    actual string with comma-separated parameters and ``params`` is the
-    corresponding dict of key=val pairs.
+    Create dict with keys date, type, params, tlmsid, scs, step and vcdu for
+    each command.  ``params`` is the dict of key=val pairs from the parameters
+    string.  The parsed file is cached in the backstop cache directory, see
+    ``kadi.commands.backstop``.
 
     :param filename: Backstop file name
     :returns: list of dict for each command
     """
-    bs = []
-    for bs_line in open(filename):
-        bs_line = bs_line.replace(' ', '')
-        date, vcdu, cmd_type, paramstr = [x for x in bs_line.split('|')]
-        vcdu = int(vcdu[:-1])  # Get rid of final '0' from '8023268 0' (where space was stripped)
-        params = parse_params(paramstr)
-        bs.append({'date': date,
-                   'type': cmd_type,
-                   'params': params,
-                   'tlmsid': params.get('TLMSID'),
-                   'scs': params.get('SCS'),
-                   'step': params.get('STEP'),
-                   'vcdu': vcdu
-                   })
-    return bs
+    return backstop.read_backstop_as_list(filename)
 
 
 if __name__ == '__main__':
@@ -23,7 +23,7 @@ def test_ingest():
 
     # Some funkiness to be able to use two different data root values
     # within the same python session.  Inject the correct PATH and make
-    # sure the LazyVals will re-read.
+    # sure the commands archive gets re-read.
     data_root_tmp = Ska.File.TempDir()
     data_root = data_root_tmp.name
     update_cmds.main(['--start', '2011:340', '--stop', '2012:100',
@@ -34,10 +34,7 @@ def test_ingest():
     from kadi.cmds import cmds
 
     # Reset
-    if hasattr(cmds.idx_cmds, '_val'):
-        del cmds.idx_cmds._val
-    if hasattr(cmds.pars_dict, '_val'):
-        del cmds.pars_dict._val
+    cmds.ARCHIVE.reload()
 
     cmds_at_once = cmds.filter('2012:010', '2012:090')
     pars_at_once = {v: k for k, v in cmds.pars_dict.items()}
@@ -48,15 +45,11 @@ def test_ingest():
     data_root = data_root_tmp.name
     os.environ['KADI'] = os.path.abspath(data_root)
 
-    if hasattr(cmds.idx_cmds, '_val'):
-        del cmds.idx_cmds._val
-    if hasattr(cmds.pars_dict, '_val'):
-        del cmds.pars_dict._val
-
     stop0 = DateTime('2012:001')
     for dt in range(0, 100, 1):
         update_cmds.main(['--stop', (stop0 + dt).date,
                           '--data-root', data_root])
+    cmds.ARCHIVE.reload()
 
     cmds_per_day = cmds.filter('2012:010', '2012:090')
     pars_per_day = {v: k for k, v in cmds.pars_dict.items()}